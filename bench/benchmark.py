@@ -0,0 +1,236 @@
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from mocknexus import MockNexus, file_md5, settings_arguments, settings_from_args
+
+# Benchmark harness: runs the real download engines against the local mock (mocknexus.py) on
+# synthetic collections and prints files/sec, MB/s, p50/p95 per-file latency and peak RSS, so
+# a change that slows things down shows up as a number. The mock server runs in this process;
+# every case runs in a fresh worker process (this script with --worker) so its peak RSS and
+# connection pools are its own.
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), "src")
+GAME_DOMAIN = "benchgame"
+GAMEFOLDER = "benchgame"
+MB = 1024 * 1024
+
+# (file count, smallest size, largest size) groups; counts are multiplied by --scale
+PROFILES = {
+    "tiny": [(2000, 4 * 1024, 64 * 1024)],
+    "huge": [(4, 256 * MB, 256 * MB)],
+    "mixed": [(400, 16 * 1024, 256 * 1024), (40, 4 * MB, 16 * MB), (2, 128 * MB, 128 * MB)],
+}
+
+def build_collection(profile, path, scale=1.0, seed=0):
+    # Writes a collection.json for the profile and returns [(mod_id, file_id, size)]
+    rng = random.Random(f"{profile}:{seed}")
+    files = []
+    for count, smallest, largest in PROFILES[profile]:
+        for _ in range(max(1, round(count * scale))):
+            mod_id = len(files) + 1
+            files.append((mod_id, 1000 + mod_id, rng.randint(smallest, largest)))
+    entries = [{
+        "name": f"Benchmark mod {mod_id}",
+        "source": {"type": "nexus", "modId": mod_id, "fileId": file_id, "fileSize": size,
+                   "md5": file_md5(mod_id, file_id, size), "logicalFilename": f"bench_{mod_id}.7z"},
+    } for mod_id, file_id, size in files]
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({"info": {"name": f"Benchmark {profile}", "domainName": GAME_DOMAIN}, "mods": entries}, f)
+    return files
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def peak_rss_bytes():
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    if resource:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS
+        return peak if sys.platform == "darwin" else peak * 1024
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+    return None
+
+class FileTimer:
+    # Per-file latency: from the moment an engine starts on a file (first link lookup) to its
+    # completion being reported. Retries count towards the same file.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = {}
+        self.latencies = []
+
+    def start(self, mod_id, file_id):
+        with self.lock:
+            self.started.setdefault((int(mod_id), int(file_id)), time.perf_counter())
+
+    def finish(self, mod):
+        now = time.perf_counter()
+        with self.lock:
+            began = self.started.pop((mod.mod_id, mod.file_id), None)
+            if began is not None:
+                self.latencies.append(now - began)
+
+    def install(self, loadcollection, pipeline, asyncdownload):
+        # Wraps the engines' per-file entry points; the engines look them up by module global
+        timer = self
+        download_file = loadcollection.download_file
+        resolve_file = pipeline.resolve_file
+        download_file_async = asyncdownload.download_file_async
+        report_completed = loadcollection.report_completed
+
+        def timed_download_file(game_domain, gamefolder, mod_id, file_id, *args, **kwargs):
+            timer.start(mod_id, file_id)
+            return download_file(game_domain, gamefolder, mod_id, file_id, *args, **kwargs)
+
+        def timed_resolve_file(game_domain, gamefolder, mod_id, file_id, *args, **kwargs):
+            timer.start(mod_id, file_id)
+            return resolve_file(game_domain, gamefolder, mod_id, file_id, *args, **kwargs)
+
+        async def timed_download_file_async(session, game_domain, gamefolder, mod_id, file_id, *args, **kwargs):
+            timer.start(mod_id, file_id)
+            return await download_file_async(session, game_domain, gamefolder, mod_id, file_id, *args, **kwargs)
+
+        def timed_report_completed(total, logger=None, mod=None):
+            if mod is not None:
+                timer.finish(mod)
+            return report_completed(total, logger, mod)
+
+        loadcollection.download_file = timed_download_file
+        pipeline.resolve_file = timed_resolve_file
+        asyncdownload.download_file_async = timed_download_file_async
+        loadcollection.report_completed = timed_report_completed
+
+def run_worker(case):
+    # One benchmark case inside a fresh interpreter; prints its result as a JSON line
+    sys.path.insert(0, SRC_DIR)
+    from config import Config, AccessControl, VortexSettings, set_config
+    import loadcollection
+    import pipeline
+    import asyncdownload
+    from concurrency import threads_arg
+
+    set_config(Config(AccessControl("benchmark"), VortexSettings(case["downloads"], "")))
+    timer = FileTimer()
+    timer.install(loadcollection, pipeline, asyncdownload)
+
+    started = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        mods, logger = loadcollection.load_collection(case["json"])
+        loadcollection.run_collection(mods, GAMEFOLDER, threads_arg(case["threads"]), case["engine"],
+                                      ignore_manifest=True, skip_space_check=True, logger=logger)
+    seconds = time.perf_counter() - started
+
+    folder = os.path.join(case["downloads"], GAMEFOLDER)
+    on_disk = sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file()) if os.path.isdir(folder) else 0
+    print(json.dumps({
+        "files": loadcollection.COMPLETED_COUNTER,
+        "errors": loadcollection.ERROR_COUNTER,
+        "seconds": seconds,
+        "bytes": on_disk,
+        "latencies": timer.latencies,
+        "peak_rss": peak_rss_bytes(),
+    }))
+
+def run_case(server, json_path, profile, engine, threads, keep=False):
+    downloads = tempfile.mkdtemp(prefix="nexusbench_")
+    # Vortex creates the game folder; the downloader expects it to be there
+    os.makedirs(os.path.join(downloads, GAMEFOLDER))
+    case = {"json": json_path, "downloads": downloads, "engine": engine, "threads": threads}
+    env = dict(os.environ, NEXUS_API_BASE=server.api_base)
+    try:
+        completed = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", json.dumps(case)],
+                                   env=env, capture_output=True, text=True)
+    finally:
+        if not keep:
+            shutil.rmtree(downloads, ignore_errors=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"{profile}/{engine} worker failed:\n{completed.stderr.strip()}")
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    latencies = result.pop("latencies")
+    seconds = result["seconds"]
+    result.update(
+        profile=profile, engine=engine, threads=threads,
+        files_per_sec=result["files"] / seconds if seconds else 0,
+        mb_per_sec=result["bytes"] / MB / seconds if seconds else 0,
+        p50=percentile(latencies, 0.5), p95=percentile(latencies, 0.95),
+    )
+    return result
+
+def format_row(result):
+    def seconds(value):
+        return f"{value * 1000:.0f}ms" if value is not None else "n/a"
+
+    rss = f"{result['peak_rss'] / MB:.0f}MB" if result["peak_rss"] else "n/a"
+    return (f"{result['profile']:<7} {result['engine']:<9} {result['threads']:>7} {result['files']:>6} "
+            f"{result['errors']:>6} {result['seconds']:>8.2f} {result['files_per_sec']:>9.1f} "
+            f"{result['mb_per_sec']:>8.1f} {seconds(result['p50']):>8} {seconds(result['p95']):>8} {rss:>8}")
+
+HEADER = (f"{'profile':<7} {'engine':<9} {'threads':>7} {'files':>6} {'errors':>6} {'seconds':>8} "
+          f"{'files/s':>9} {'MB/s':>8} {'p50':>8} {'p95':>8} {'peakRSS':>8}")
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == "--worker":
+        run_worker(json.loads(sys.argv[2]))
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="Benchmark the download engines against a local mock of Nexus")
+    parser.add_argument('--profile', action='append', choices=sorted(PROFILES),
+                        help="Synthetic collection to run (repeatable; default: all)")
+    parser.add_argument('--engine', action='append', choices=['threads', 'async', 'pipeline'],
+                        help="Engine to run (repeatable; default: all)")
+    parser.add_argument('--maxthreads', default="10", help="Passed to the engine as --maxthreads (a number or 'auto')")
+    parser.add_argument('--scale', type=float, default=1.0, help="Multiplies the file counts of every profile")
+    parser.add_argument('--output', help="Also write the results to this JSON file, for comparing runs")
+    parser.add_argument('--keep', action='store_true', help="Keep the downloaded files in the temp folder")
+    settings_arguments(parser)
+    args = parser.parse_args()
+
+    server = MockNexus(settings=settings_from_args(args)).start()
+    workdir = tempfile.mkdtemp(prefix="nexusbench_collections_")
+    results = []
+    try:
+        print(HEADER)
+        for profile in args.profile or sorted(PROFILES):
+            json_path = os.path.join(workdir, f"{profile}.json")
+            for mod_id, file_id, size in build_collection(profile, json_path, args.scale, args.seed):
+                server.set_size(mod_id, file_id, size)
+            for engine in args.engine or ['threads', 'async', 'pipeline']:
+                result = run_case(server, json_path, profile, engine, args.maxthreads, args.keep)
+                results.append(result)
+                print(format_row(result), flush=True)
+    finally:
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(f"Server: {json.dumps(server.stats.as_dict())}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=2)
@@ -0,0 +1,410 @@
+import argparse
+import hashlib
+import http.server
+import json
+import random
+import re
+import socket
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+
+# Local stand-in for the Nexus API and CDN, for benchmarks and for trying changes without
+# spending real API quota. It answers download_link.json, endorse.json, user/endorsements.json
+# and validate.json the
+# way api.nexusmods.com does (including the X-RL-* rate-limit headers), and serves the files
+# themselves from /cdn/ with Range support, optionally from several mirrors on ports of their
+# own. File contents are generated from the mod and file ids, so nothing is stored and every run
+# serves identical bytes. Point the downloader at it with NEXUS_API_BASE=http://127.0.0.1:<port>/v1.
+
+# Size of the pseudo-random block each file's contents repeat
+BLOCK_SIZE = 64 * 1024
+# Bytes per socket write on the CDN side; also the granularity of the bandwidth cap
+SEND_CHUNK_SIZE = 64 * 1024
+# Size served for files that were never registered with set_size
+DEFAULT_FILE_SIZE = 100 * 1024
+
+@dataclass
+class MockSettings:
+    # Seconds before each API answer, and before the first byte of each CDN answer
+    api_latency: float = 0.0
+    cdn_latency: float = 0.0
+    # Per-connection CDN cap in bytes per second (0 = unlimited)
+    bandwidth: int = 0
+    # Quota reported in the X-RL-* headers; once both are used up every API call gets a 429
+    hourly_limit: int = 500
+    daily_limit: int = 20000
+    # Share of API calls answered with a 429 regardless of the quota, and the Retry-After sent
+    error_429_rate: float = 0.0
+    retry_after: int = 1
+    # Share of CDN answers whose connection is dropped part way through the body
+    drop_rate: float = 0.0
+    # Mirrors listed by download_link.json; the first one (Nexus's pick) can be made slow
+    mirrors: int = 1
+    slow_mirror_bandwidth: int = 0
+    # Seconds after a mod's first download link before Nexus accepts its endorsement (really 24 hours)
+    endorse_wait: float = 0.0
+    # Seconds a download link stays valid; the CDN answers 403 to a link past its expires=
+    link_ttl: int = 3600
+    seed: int = 0
+
+@dataclass
+class MockStats:
+    api_calls: int = 0
+    throttled: int = 0
+    cdn_requests: int = 0
+    range_requests: int = 0
+    dropped: int = 0
+    bytes_sent: int = 0
+    endorsements: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, name, count=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + count)
+
+    def as_dict(self):
+        with self.lock:
+            return {name: value for name, value in vars(self).items() if name != "lock"}
+
+def file_block(mod_id, file_id):
+    return random.Random(f"{mod_id}:{file_id}").randbytes(BLOCK_SIZE)
+
+def file_bytes(block, start, end):
+    # Bytes start..end (inclusive) of a file that is block repeated, in SEND_CHUNK_SIZE pieces
+    position = start
+    while position <= end:
+        offset = position % BLOCK_SIZE
+        piece = block[offset:offset + min(SEND_CHUNK_SIZE, BLOCK_SIZE - offset, end - position + 1)]
+        yield piece
+        position += len(piece)
+
+def file_md5(mod_id, file_id, size):
+    # The MD5 the collection should list for a generated file
+    digest = hashlib.md5()
+    for piece in file_bytes(file_block(mod_id, file_id), 0, size - 1):
+        digest.update(piece)
+    return digest.hexdigest()
+
+def parse_range(header, size):
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", header or "")
+    if not match or not (match[1] or match[2]):
+        return None
+    if not match[1]:
+        return max(0, size - int(match[2])), size - 1
+    start = int(match[1])
+    end = min(int(match[2]), size - 1) if match[2] else size - 1
+    return (start, end) if start <= end else None
+
+class MirrorServer(http.server.ThreadingHTTPServer):
+    # An extra CDN mirror: same files and settings as the MockNexus it belongs to, on its own port
+    daemon_threads = True
+
+    def __init__(self, nexus, index):
+        super().__init__((nexus.server_address[0], 0), nexus.RequestHandlerClass)
+        self.nexus = nexus
+        self.index = index
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+class MockNexus(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    index = 0
+
+    def __init__(self, address=("127.0.0.1", 0), settings=None, handler=None):
+        super().__init__(address, handler or MockHandler)
+        self.nexus = self
+        self.settings = settings or MockSettings()
+        self.stats = MockStats()
+        self.random = random.Random(self.settings.seed)
+        self.lock = threading.Lock()
+        self.sizes = {}
+        self.blocks = {}
+        # (game, mod_id) -> time of the mod's first download link, and -> endorsement status
+        self.downloaded = {}
+        self.endorsed = {}
+        self.hourly_remaining = self.settings.hourly_limit
+        self.daily_remaining = self.settings.daily_limit
+        self.mirrors = [self] + [MirrorServer(self, index) for index in range(1, max(1, self.settings.mirrors))]
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def api_base(self):
+        return f"{self.base_url}/v1"
+
+    def set_size(self, mod_id, file_id, size):
+        self.sizes[(int(mod_id), int(file_id))] = size
+
+    def size_of(self, mod_id, file_id):
+        return self.sizes.get((mod_id, file_id), DEFAULT_FILE_SIZE)
+
+    def block(self, mod_id, file_id):
+        key = (mod_id, file_id)
+        block = self.blocks.get(key)
+        if block is None:
+            block = self.blocks[key] = file_block(mod_id, file_id)
+        return block
+
+    def chance(self, rate):
+        if rate <= 0:
+            return False
+        with self.lock:
+            return self.random.random() < rate
+
+    def take_quota(self):
+        # Nexus spends the daily allowance first and falls back to the hourly one
+        with self.lock:
+            if self.daily_remaining > 0:
+                self.daily_remaining -= 1
+                return True
+            if self.hourly_remaining > 0:
+                self.hourly_remaining -= 1
+                return True
+            return False
+
+    def endorse(self, game_domain, mod_id):
+        # Refuses the way Nexus does: 403 with NOT_DOWNLOADED_MOD or TOO_SOON_AFTER_DOWNLOAD
+        with self.lock:
+            downloaded = self.downloaded.get((game_domain, mod_id))
+            if downloaded is None:
+                return 403, {"code": 403, "message": "NOT_DOWNLOADED_MOD"}
+            if time.time() - downloaded < self.settings.endorse_wait:
+                return 403, {"code": 403, "message": "TOO_SOON_AFTER_DOWNLOAD"}
+            self.endorsed[(game_domain, mod_id)] = "Endorsed"
+        self.stats.add("endorsements")
+        return {"message": "SUCCESS", "status": "Endorsed"}
+
+    def endorsement_list(self):
+        with self.lock:
+            return [{"mod_id": mod_id, "domain_name": game_domain, "date": int(time.time()), "version": "1.0", "status": status}
+                    for (game_domain, mod_id), status in self.endorsed.items()]
+
+    def rate_limit_headers(self):
+        now = datetime.now(timezone.utc)
+        hourly_reset = now.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+        daily_reset = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+        with self.lock:
+            return {
+                "X-RL-Hourly-Limit": str(self.settings.hourly_limit),
+                "X-RL-Hourly-Remaining": str(self.hourly_remaining),
+                "X-RL-Hourly-Reset": hourly_reset.isoformat(),
+                "X-RL-Daily-Limit": str(self.settings.daily_limit),
+                "X-RL-Daily-Remaining": str(self.daily_remaining),
+                "X-RL-Daily-Reset": daily_reset.isoformat(),
+            }
+
+    def start(self):
+        for mirror in self.mirrors:
+            threading.Thread(target=mirror.serve_forever, name=f"MockNexus-{mirror.index}", daemon=True).start()
+        return self
+
+    def stop(self):
+        for mirror in self.mirrors:
+            mirror.shutdown()
+            mirror.server_close()
+
+    def serve_mirrors(self):
+        # Foreground variant of start for the command line
+        for mirror in self.mirrors[1:]:
+            threading.Thread(target=mirror.serve_forever, name=f"MockNexus-{mirror.index}", daemon=True).start()
+        self.serve_forever()
+
+    def close_mirrors(self):
+        for mirror in self.mirrors:
+            mirror.server_close()
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        match = re.fullmatch(r"/v1/games/([^/]+)/mods/(\d+)/files/(\d+)/download_link\.json", path)
+        if match:
+            return self.api_call(lambda: self.download_links(match[1], int(match[2]), int(match[3])))
+        if path == "/v1/user/endorsements.json":
+            return self.api_call(self.nexus.endorsement_list)
+        if path == "/v1/users/validate.json":
+            return self.api_call(lambda: {"user_id": 1, "name": "benchmark", "is_premium": True})
+        match = re.fullmatch(r"/cdn/(\d+)/(\d+)/[^/]+", path)
+        if match:
+            expires = re.search(r"[?&]expires=(\d+)", self.path)
+            if expires and int(expires[1]) < time.time():
+                return self.send_empty(403)
+            return self.cdn(int(match[1]), int(match[2]))
+        self.send_empty(404)
+
+    @property
+    def nexus(self):
+        return self.server.nexus
+
+    def do_POST(self):
+        path = self.path.split("?", 1)[0]
+        match = re.fullmatch(r"/v1/games/([^/]+)/mods/(\d+)/endorse\.json", path)
+        if match:
+            return self.api_call(lambda: self.nexus.endorse(match[1], int(match[2])))
+        self.send_empty(404)
+
+    def download_links(self, game_domain, mod_id, file_id):
+        expires = int(time.time()) + self.nexus.settings.link_ttl
+        with self.nexus.lock:
+            self.nexus.downloaded.setdefault((game_domain, mod_id), time.time())
+        return [{"name": f"Mock CDN {mirror.index}", "short_name": f"mock{mirror.index}",
+                 "URI": f"{mirror.base_url}/cdn/{mod_id}/{file_id}/{game_domain}_{mod_id}_{file_id}.7z?expires={expires}"}
+                for mirror in self.nexus.mirrors]
+
+    def api_call(self, answer):
+        server = self.nexus
+        settings = server.settings
+        server.stats.add("api_calls")
+        if settings.api_latency:
+            time.sleep(settings.api_latency)
+        if server.chance(settings.error_429_rate) or not server.take_quota():
+            server.stats.add("throttled")
+            headers = server.rate_limit_headers()
+            headers["Retry-After"] = str(settings.retry_after)
+            return self.send_json(429, {"message": "Too Many Requests"}, headers)
+        # answer() returns the JSON body, or (status, body) for an error
+        result = answer()
+        status, body = result if isinstance(result, tuple) else (200, result)
+        self.send_json(status, body, server.rate_limit_headers())
+
+    def cdn(self, mod_id, file_id):
+        server = self.nexus
+        settings = server.settings
+        bandwidth = settings.bandwidth
+        if self.server.index == 0 and len(server.mirrors) > 1 and settings.slow_mirror_bandwidth:
+            bandwidth = settings.slow_mirror_bandwidth
+        server.stats.add("cdn_requests")
+        size = server.size_of(mod_id, file_id)
+        etag = f'"{mod_id}-{file_id}-{size}"'
+        if settings.cdn_latency:
+            time.sleep(settings.cdn_latency)
+
+        start, end = 0, size - 1
+        requested = parse_range(self.headers.get("Range"), size)
+        if_range = self.headers.get("If-Range")
+        if requested and (not if_range or if_range == etag):
+            start, end = requested
+            server.stats.add("range_requests")
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        length = end - start + 1
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.end_headers()
+
+        # A dropped connection stops somewhere in the body, like a CDN edge resetting mid-file
+        drop_at = None
+        if length > 1 and server.chance(settings.drop_rate):
+            with server.lock:
+                drop_at = server.random.randrange(1, length)
+        sent = 0
+        began = time.monotonic()
+        for piece in file_bytes(server.block(mod_id, file_id), start, end):
+            if drop_at is not None and sent + len(piece) >= drop_at:
+                self.wfile.write(piece[:drop_at - sent])
+                self.wfile.flush()
+                server.stats.add("bytes_sent", drop_at - sent)
+                server.stats.add("dropped")
+                self.connection.shutdown(socket.SHUT_RDWR)
+                self.close_connection = True
+                return
+            try:
+                self.wfile.write(piece)
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True
+                return
+            sent += len(piece)
+            server.stats.add("bytes_sent", len(piece))
+            if bandwidth:
+                ahead = sent / bandwidth - (time.monotonic() - began)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_empty(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+def settings_arguments(parser):
+    # Shared with benchmark.py
+    parser.add_argument('--api-latency', type=float, default=0.0, help="Seconds before each API answer")
+    parser.add_argument('--cdn-latency', type=float, default=0.0, help="Seconds before the first byte of each file")
+    parser.add_argument('--bandwidth', type=float, default=0.0, help="Per-connection CDN cap in MB/s (0 = unlimited)")
+    parser.add_argument('--hourly-limit', type=int, default=500, help="Hourly API quota reported to the client")
+    parser.add_argument('--daily-limit', type=int, default=20000, help="Daily API quota reported to the client")
+    parser.add_argument('--error-429-rate', type=float, default=0.0, help="Share of API calls answered with 429")
+    parser.add_argument('--retry-after', type=int, default=1, help="Retry-After seconds sent with a 429")
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="Share of CDN answers dropped part way through")
+    parser.add_argument('--mirrors', type=int, default=1, help="Number of CDN mirrors offered for each file")
+    parser.add_argument('--slow-mirror', type=float, default=0.0,
+                        help="Cap in MB/s for the first mirror offered (the others use --bandwidth), to exercise mirror selection")
+    parser.add_argument('--endorse-wait', type=float, default=0.0,
+                        help="Seconds after a mod's first download before it can be endorsed (Nexus: 24 hours)")
+    parser.add_argument('--link-ttl', type=int, default=3600, help="Seconds a download link stays valid before the CDN refuses it")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the 429 and drop decisions")
+
+def settings_from_args(args):
+    return MockSettings(
+        api_latency=args.api_latency, cdn_latency=args.cdn_latency,
+        bandwidth=int(args.bandwidth * 1024 * 1024),
+        hourly_limit=args.hourly_limit, daily_limit=args.daily_limit,
+        error_429_rate=args.error_429_rate, retry_after=args.retry_after,
+        drop_rate=args.drop_rate, mirrors=args.mirrors,
+        slow_mirror_bandwidth=int(args.slow_mirror * 1024 * 1024), endorse_wait=args.endorse_wait,
+        link_ttl=args.link_ttl, seed=args.seed,
+    )
+
+def register_collection(server, file_path):
+    # Serves every file of a collection.json at the size it lists
+    with open(file_path, 'r', encoding='utf-8-sig') as f:
+        data = json.load(f)
+    for entry in data.get("mods", []):
+        source = entry.get("source", {})
+        if "modId" in source and "fileId" in source:
+            server.set_size(source["modId"], source["fileId"], int(source.get("fileSize") or DEFAULT_FILE_SIZE))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local mock of the Nexus API and CDN")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--json', action='append', default=[],
+                        help="collection.json whose files should be served at their listed sizes (repeatable)")
+    settings_arguments(parser)
+    args = parser.parse_args()
+
+    server = MockNexus(("127.0.0.1", args.port), settings_from_args(args))
+    for path in args.json:
+        register_collection(server, path)
+    print(f"Mock Nexus listening; set NEXUS_API_BASE={server.api_base}")
+    try:
+        server.serve_mirrors()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(server.stats.as_dict()))
+        server.close_mirrors()
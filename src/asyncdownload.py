@@ -0,0 +1,433 @@
+import asyncio
+import os
+import time
+import aiohttp
+import download
+from download import Elapsed, download_dir, download_link_url, filename_from_url, record_manifest, existing_size, forget_existing, mirrors_to_probe, store_download, reject_links
+from manifest import STATUS_RESOLVED, STATUS_COMPLETE
+from transfer import transfers_paused, transfers_cancelled, TransferCancelled, RangeNotHonoured, part_paths, resume_state, write_part_state, finalize_part, transfer_headers, expected_total, add_transferred, verify_part, STATE_INTERVAL
+from checksum import new_hasher, update_from_file, md5_file, hash_pool, quarantine
+from session import api_headers, MAX_RATE_LIMIT_RETRIES, MAX_CONNECTIONS_PER_HOST
+from ratelimit import GOVERNOR
+from retry import BREAKER, host_of
+from mirrors import MIRRORS, RateWatch, SlowMirror, PROBE_BYTES, PROBE_SECONDS, PROBE_TIMEOUT
+from metrics import METRICS
+from bandwidth import BANDWIDTH
+from diskwriter import disk_writer
+
+# Event-loop download engine used by --engine async. Link resolution and streaming
+# transfers for every file run as coroutines on one thread, so hundreds of transfers
+# can be in flight without an OS thread (and its stack) per file.
+
+# Bytes read from the socket per write; larger than the threaded engine's 8 KB so the
+# single loop thread spends less time per byte switching between transfers
+CHUNK_SIZE = 64 * 1024
+
+# How often a paused coroutine checks whether the run was resumed
+PAUSE_POLL_INTERVAL = 0.2
+
+# No overall deadline: a multi-GB archive can legitimately take hours
+TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=120)
+
+LOGGER = None
+
+def set_async_logger(logger):
+    global LOGGER
+    LOGGER = logger
+
+async def wait_while_paused():
+    # Event-loop counterpart of transfer.transfer_checkpoint: yields to the loop instead of blocking it
+    while transfers_paused() and not transfers_cancelled():
+        await asyncio.sleep(PAUSE_POLL_INTERVAL)
+    if transfers_cancelled():
+        raise TransferCancelled("Download cancelled")
+
+async def sleep_unless_cancelled(delay):
+    # A retry backoff that ends early when the run is cancelled
+    deadline = time.monotonic() + delay
+    while not transfers_cancelled():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        await asyncio.sleep(min(remaining, PAUSE_POLL_INTERVAL))
+
+async def off_loop(function, *args):
+    # Runs a blocking call (sidecar and manifest writes, renames, SQLite commits) on the loop's
+    # executor, so one slow fsync or a locked database does not hold up every transfer
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+async def get_download_urls_async(session, game_domain, mod_id, file_id):
+    # Still-valid signed links from an earlier lookup need no API call (see download.get_download_urls)
+    links = await off_loop(download.LINKS.get, game_domain, mod_id, file_id) if download.LINKS else None
+    api_seconds = 0.0
+    if not links:
+        url = download_link_url(game_domain, mod_id, file_id)
+        for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+            # Same process-wide governor as the threaded engines; the wait is awaited, not slept,
+            # and a cancel cuts it short
+            await sleep_unless_cancelled(GOVERNOR.reserve())
+            if transfers_cancelled():
+                raise TransferCancelled("Download cancelled")
+            requested = time.monotonic()
+            async with session.get(url, headers=api_headers()) as response:
+                api_seconds = time.monotonic() - requested
+                GOVERNOR.update(response.status, response.headers)
+                if response.status == 429 and attempt < MAX_RATE_LIMIT_RETRIES:
+                    continue
+                response.raise_for_status()
+                download_info = await response.json()
+                break
+        links = download_info or []
+        if download.LINKS:
+            await off_loop(download.LINKS.put, game_domain, mod_id, file_id, links)
+
+    # Every mirror, best first (see download.rank_mirrors)
+    for url in mirrors_to_probe(links):
+        await probe_mirror_async(session, url)
+    urls = MIRRORS.rank(links, BREAKER.open_hosts())
+    if urls:
+        METRICS.resolved(filename_from_url(urls[0]), mod_id, file_id, api_seconds)
+        BANDWIDTH.bind(filename_from_url(urls[0]), game_domain, mod_id, file_id)
+    return urls
+
+async def probe_mirror_async(session, url):
+    # Async counterpart of transfer.probe_mirror
+    started = time.monotonic()
+    received = 0
+    headers = {'Accept-Encoding': 'identity', 'Range': f"bytes=0-{PROBE_BYTES - 1}"}
+    timeout = aiohttp.ClientTimeout(total=sum(PROBE_TIMEOUT))
+    try:
+        async with session.get(url, headers=headers, timeout=timeout) as r:
+            r.raise_for_status()
+            async for chunk in r.content.iter_chunked(CHUNK_SIZE):
+                received += len(chunk)
+                if received >= PROBE_BYTES or time.monotonic() - started >= PROBE_SECONDS:
+                    break
+    except Exception as e:
+        if LOGGER:
+            LOGGER.verbose(f"Probe of mirror {host_of(url)} failed: {e}")
+        return
+    seconds = time.monotonic() - started
+    MIRRORS.record(url, received, seconds)
+    if LOGGER:
+        LOGGER.verbose(f"Probed mirror {host_of(url)}: {received / seconds / (1024 * 1024):.2f} MB/s")
+
+async def fetch_from_mirrors_async(session, urls, file_path, expected_md5=None):
+    # Async counterpart of transfer.fetch_to_path's mirror failover
+    started = time.monotonic()
+    first_byte = None
+    moved = 0
+    failovers = 0
+    for index, url in enumerate(urls):
+        last = index == len(urls) - 1
+        try:
+            BREAKER.check(url)
+        except IOError:
+            if last:
+                raise
+            continue
+        watch = RateWatch(urls[index + 1:])
+        try:
+            received = await fetch_to_path_async(session, url, file_path, expected_md5, watch)
+        except SlowMirror:
+            BREAKER.release(url)
+            MIRRORS.record_watch(url, watch)
+            first_byte = first_byte or watch.first_byte
+            moved += watch.count
+            failovers += 1
+            if LOGGER:
+                LOGGER.verbose(f"{os.path.basename(file_path)}: {host_of(url)} too slow "
+                               f"({watch.rate() / 1024:.0f} KB/s), failing over to {host_of(urls[index + 1])}")
+            continue
+        except Exception as e:
+            BREAKER.failure(url, e)
+            raise
+        BREAKER.success(url)
+        MIRRORS.record_watch(url, watch)
+        METRICS.transferred(os.path.basename(file_path), started, first_byte or watch.first_byte, time.monotonic(),
+                            moved + watch.count, host_of(url), failovers)
+        return received
+
+class AsyncWriteStream:
+    # Gathers the event loop's small chunks into pooled buffers for the disk writer (see
+    # diskwriter.py), so file writes happen on its threads instead of on the loop. The waits that
+    # can block (a free buffer, a flush) run in the loop's executor.
+
+    def __init__(self, stream, position):
+        self.stream = stream
+        self.pool = stream.writer.pool
+        # File offset of the next byte handed in
+        self.position = position
+        self.buffer = None
+        self.length = 0
+
+    async def write(self, chunk):
+        view = memoryview(chunk)
+        while view:
+            if self.buffer is None:
+                self.buffer = self.pool.try_acquire() or await off_loop(self.pool.acquire)
+                self.length = 0
+            count = min(len(view), self.pool.size - self.length)
+            self.buffer[self.length:self.length + count] = view[:count]
+            self.length += count
+            self.position += count
+            view = view[count:]
+            if self.length == self.pool.size:
+                self.hand_off()
+
+    def hand_off(self):
+        buffer, length = self.buffer, self.length
+        if buffer is None:
+            return
+        self.buffer = None
+        if length:
+            self.stream.write(buffer, length, self.position - length)
+        else:
+            self.pool.release(buffer)
+
+    async def flush(self):
+        # Returns once everything handed in is on disk (raises if a write failed)
+        self.hand_off()
+        await off_loop(self.stream.flush)
+
+    async def drain(self):
+        # Like flush, but False instead of raising
+        self.hand_off()
+        return await off_loop(self.stream.drain)
+
+async def copy_body(response, out, file_path, hasher, watch, save, end=None):
+    # Streams the response body into out; end is the file offset the body should stop at, when
+    # known, for the progress estimate. await save(position) records the sidecar once everything before
+    # position is on disk: every STATE_INTERVAL and before the transfer holds for a pause.
+    name = os.path.basename(file_path)
+    saved = out.position
+    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+        if transfers_paused() or transfers_cancelled():
+            await out.flush()
+            await save(out.position)
+            await wait_while_paused()
+        await out.write(chunk)
+        if hasher:
+            hasher.update(chunk)
+        add_transferred(len(chunk), name)
+        # Under a bandwidth cap, the wait for the file's lane is awaited (see bandwidth.BandwidthBudget.reserve)
+        delay = BANDWIDTH.reserve(len(chunk), name)
+        if delay and watch:
+            watch.held()
+        while delay and not transfers_cancelled():
+            await asyncio.sleep(delay)
+            delay = BANDWIDTH.reserve(0, name)
+        if out.position - saved >= STATE_INTERVAL:
+            await out.flush()
+            await save(out.position)
+            saved = out.position
+        if watch:
+            watch.add(len(chunk), end - out.position if end else None)
+
+async def fetch_segment_async(session, url, file_path, state, seg, stream, hasher=None, watch=None):
+    headers = {'Accept-Encoding': 'identity', 'Range': f"bytes={seg[0] + seg[2]}-{seg[1]}"}
+    if state.get("etag"):
+        headers['If-Range'] = state["etag"]
+
+    async def save(position):
+        seg[2] = position - seg[0]
+        await off_loop(write_part_state, file_path, state)
+
+    async with session.get(url, headers=headers) as r:
+        if watch:
+            watch.responded()
+        if r.status != 206:
+            raise RangeNotHonoured(f"Server did not honour a range request for {os.path.basename(file_path)} (HTTP {r.status})")
+        out = AsyncWriteStream(stream, seg[0] + seg[2])
+        try:
+            await copy_body(r, out, file_path, hasher, watch, save, seg[1] + 1)
+        finally:
+            # Also after a dropped connection: what reached the disk is kept for the resume
+            if await out.drain():
+                await save(out.position)
+    if seg[2] < seg[1] - seg[0] + 1:
+        raise IOError(f"Segment {seg[0]}-{seg[1]} of {os.path.basename(file_path)} ended early")
+
+async def fetch_segments_async(session, url, file_path, state, expected_md5=None, watch=None):
+    # Resumes a .part the threaded engine split into byte ranges (see transfer.SegmentedTransfer),
+    # keeping every range already on disk. The missing ranges are fetched one after the other in
+    # file order over this file's one connection, so the MD5 is computed on the way and only the
+    # bytes that were already there are read back.
+    part_path, _ = part_paths(file_path)
+    loop = asyncio.get_running_loop()
+    hasher = new_hasher() if expected_md5 else None
+    with open(part_path, 'r+b') as f, disk_writer().stream(f) as stream:
+        for seg in sorted(state["segments"]):
+            if hasher and seg[2]:
+                await loop.run_in_executor(hash_pool(), update_from_file, hasher, part_path, seg[2], seg[0])
+            if seg[2] < seg[1] - seg[0] + 1:
+                await fetch_segment_async(session, url, file_path, state, seg, stream, hasher, watch)
+    received = sum(seg[2] for seg in state["segments"])
+    if received != state["total"]:
+        raise IOError(f"Incomplete download of {os.path.basename(file_path)}: {received} of {state['total']} bytes")
+    if hasher:
+        await off_loop(verify_part, file_path, hasher.hexdigest(), expected_md5)
+    await off_loop(finalize_part, file_path)
+    return received
+
+# Async counterpart of download.fetch_to_path, sharing its .part/.part.json resume format
+async def fetch_to_path_async(session, url, file_path, expected_md5=None, watch=None):
+    part_path, _ = part_paths(file_path)
+    state = await off_loop(resume_state, url, file_path)
+    if state and state.get("segments"):
+        if LOGGER:
+            LOGGER.verbose("Resuming %s across %d segments", os.path.basename(file_path), len(state['segments']))
+        try:
+            return await fetch_segments_async(session, url, file_path, state, expected_md5, watch)
+        except RangeNotHonoured:
+            # The file changed on the CDN (or ranges are no longer served): start it again from scratch
+            if LOGGER:
+                LOGGER.verbose(f"Discarding partial {os.path.basename(file_path)}, the server no longer serves its ranges")
+            state = None
+    offset = state["received"] if state else 0
+    loop = asyncio.get_running_loop()
+
+    async with session.get(url, headers=transfer_headers(state)) as r:
+        if watch:
+            watch.responded()
+        if r.status == 416 and state and state.get("total") == offset:
+            if expected_md5:
+                digest = await loop.run_in_executor(hash_pool(), md5_file, part_path)
+                await off_loop(verify_part, file_path, digest, expected_md5)
+            await off_loop(finalize_part, file_path)
+            return offset
+        r.raise_for_status()
+        if offset and r.status != 206:
+            offset = 0
+        state = {
+            "total": expected_total(r.status, r.headers, offset),
+            "received": offset,
+            "etag": r.headers.get('ETag'),
+            "host": host_of(url),
+        }
+        if offset and LOGGER:
+            LOGGER.verbose("Resuming %s at byte %d", os.path.basename(file_path), offset)
+
+        hasher = new_hasher() if expected_md5 else None
+        if hasher and offset:
+            await loop.run_in_executor(hash_pool(), update_from_file, hasher, part_path, offset)
+
+        async def save(position):
+            state["received"] = position
+            await off_loop(write_part_state, file_path, state)
+
+        with open(part_path, 'r+b' if offset else 'wb') as f:
+            f.seek(offset)
+            f.truncate()
+            await off_loop(write_part_state, file_path, state)
+            with disk_writer().stream(f) as stream:
+                out = AsyncWriteStream(stream, offset)
+                try:
+                    await copy_body(r, out, file_path, hasher, watch, save, state["total"])
+                finally:
+                    # Also after a dropped connection or a failover: what reached the disk is kept for the resume
+                    if await out.drain():
+                        await save(out.position)
+
+    if state["total"] is not None and state["received"] != state["total"]:
+        raise IOError(f"Incomplete download of {os.path.basename(file_path)}: {state['received']} of {state['total']} bytes")
+    if hasher:
+        await off_loop(verify_part, file_path, hasher.hexdigest(), expected_md5)
+    await off_loop(finalize_part, file_path)
+    return state["received"]
+
+async def download_file_async(session, game_domain, gamefolder, mod_id, file_id, current_counter, expected_md5=None):
+    download_start = time.time()
+
+    await wait_while_paused()
+    urls = await get_download_urls_async(session, game_domain, mod_id, file_id)
+    if not urls:
+        if LOGGER:
+            LOGGER.verbose("%04d\tNo download URL found for mod %s, file %s", current_counter, mod_id, file_id)
+        return
+
+    filename = filename_from_url(urls[0])
+    file_path = os.path.join(download_dir(gamefolder), filename)
+
+    # Check if the file already exists
+    size = await off_loop(existing_size, file_path)
+    existing_ok = True
+    if size and download.VERIFY_EXISTING and expected_md5:
+        digest = await asyncio.get_running_loop().run_in_executor(hash_pool(), md5_file, file_path)
+        existing_ok = digest.lower() == expected_md5.lower()
+    if size and not existing_ok:
+        forget_existing(file_path)
+        target = await off_loop(quarantine, file_path)
+        if LOGGER:
+            LOGGER.verbose("%04d\tFile %s failed MD5 verification, moved to %s and downloading again", current_counter, filename, target)
+    elif size:
+        if LOGGER:
+            LOGGER.verbose("%04d\tTime(%s)\tFile %s already exists. Skipping download.",
+                           current_counter, Elapsed(download_start), filename)
+        await off_loop(record_manifest, game_domain, mod_id, file_id, file_path, STATUS_COMPLETE, expected_md5, size)
+        if download.VERIFY_EXISTING:
+            # Just checked against the MD5, so it can go into the archive store as well
+            await off_loop(store_download, file_path, expected_md5)
+        return
+
+    await off_loop(record_manifest, game_domain, mod_id, file_id, file_path, STATUS_RESOLVED, expected_md5)
+    if LOGGER:
+        LOGGER.verbose("%04d\tTime(%s)\tDownloading %s", current_counter, Elapsed(download_start), filename)
+
+    try:
+        await fetch_from_mirrors_async(session, urls, file_path, expected_md5)
+    except Exception as e:
+        await off_loop(reject_links, urls, e)
+        raise
+    await off_loop(store_download, file_path, expected_md5)
+    await off_loop(record_manifest, game_domain, mod_id, file_id, file_path, STATUS_COMPLETE, expected_md5)
+
+    if LOGGER:
+        LOGGER.verbose("%04d\tTime(%s)\tDownloaded %s to %s", current_counter, Elapsed(download_start), filename, file_path)
+
+# How often a coroutine re-checks an adaptive limiter that is at its limit
+LIMITER_POLL_INTERVAL = 0.05
+
+async def run_downloads(mods, folders, max_concurrency, on_complete, on_error, next_counter, limiter=None, requeue=None):
+    # folders maps each game domain in mods to its folder under the downloads root.
+    # The semaphore bounds in-flight files; the connector keeps to the same per-host cap as the
+    # threaded engines' session pool (see session.configure_session)
+    semaphore = asyncio.Semaphore(int(max_concurrency))
+    connector = aiohttp.TCPConnector(limit=int(max_concurrency),
+                                     limit_per_host=max(1, min(int(max_concurrency), MAX_CONNECTIONS_PER_HOST)))
+    tasks = set()
+
+    async with aiohttp.ClientSession(connector=connector, timeout=TIMEOUT) as session:
+        async def worker(mod):
+            async with semaphore:
+                if limiter:
+                    # --maxthreads auto: the controller thread moves the limit, so poll rather than block the loop
+                    while not limiter.try_acquire():
+                        await asyncio.sleep(LIMITER_POLL_INTERVAL)
+                current_counter = next_counter()
+                try:
+                    await download_file_async(session, mod.game_domain, folders[mod.game_domain], mod.mod_id, mod.file_id, current_counter, mod.md5)
+                except Exception as e:
+                    if limiter:
+                        limiter.release(failed=True)
+                    delay = requeue(mod, e) if requeue else None
+                    if delay is not None:
+                        # Back of the queue once the backoff has passed; a transfer resumes from its .part
+                        tasks.add(asyncio.ensure_future(retry_later(mod, delay)))
+                    else:
+                        on_error(mod, e)
+                else:
+                    if limiter:
+                        limiter.release()
+                    on_complete(mod)
+
+        async def retry_later(mod, delay):
+            # Waits outside the semaphore, so a file in backoff does not hold a transfer slot
+            await sleep_unless_cancelled(delay)
+            await worker(mod)
+
+        for mod in mods:
+            tasks.add(asyncio.ensure_future(worker(mod)))
+        while tasks:
+            done, _ = await asyncio.wait(tasks)
+            tasks.difference_update(done)
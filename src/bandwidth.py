@@ -0,0 +1,145 @@
+import threading
+import time
+
+# Process-wide download bandwidth budget. Every transfer (all three engines, every segment of a
+# split file) draws the bytes it reads from one token bucket, so a cap set with --max-bandwidth,
+# or changed from the GUI while a run is going, holds however many transfers are in flight and
+# leaves the rest of the link to the machine. Under a cap the budget is shared between priority
+# lanes by weight: pinned mods first, then small files, with large archives in the background;
+# a lane with nothing to move lends its share to the others. Only transfer bytes are metered:
+# link lookups and other API calls never queue behind the bulk downloads.
+#
+# Bytes are charged after they are read (a lane may go into debt) and the reader then waits
+# until its lane is paid up. While the reader waits the socket is not read, so TCP slows the
+# sender down to the budget too.
+
+LANE_PINNED = "pinned"
+LANE_SMALL = "small"
+LANE_BULK = "bulk"
+LANES = (LANE_PINNED, LANE_SMALL, LANE_BULK)
+# Share of the cap each busy lane gets, relative to the other busy lanes
+LANE_WEIGHTS = {LANE_PINNED: 8, LANE_SMALL: 4, LANE_BULK: 1}
+# Files up to this size go in the small lane
+SMALL_FILE_SIZE = 64 * 1024 * 1024
+# A lane that drew bytes (or was waiting) this recently counts as busy
+ACTIVE_WINDOW = 1.0
+# How much of its share an idle-then-busy lane may save up and spend at once
+BURST_SECONDS = 0.25
+# Longest single wait, so a changed cap or a cancel takes effect promptly
+MAX_WAIT = 0.25
+
+def bandwidth_arg(value):
+    # argparse type for --max-bandwidth: MB/s, 0 for no cap
+    rate = float(value)
+    if rate < 0:
+        raise ValueError("--max-bandwidth cannot be negative")
+    return rate
+
+def lane_for(mod, pinned=()):
+    if mod.mod_id in pinned:
+        return LANE_PINNED
+    if mod.size and mod.size <= SMALL_FILE_SIZE:
+        return LANE_SMALL
+    return LANE_BULK
+
+class BandwidthBudget:
+    def __init__(self, rate=0.0):
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        # Bytes per second for all transfers together; 0 is no cap
+        self.rate = float(rate)
+        self.tokens = {lane: 0.0 for lane in LANES}
+        self.last_seen = {lane: 0.0 for lane in LANES}
+        self.last_refill = time.monotonic()
+        # (game, mod_id, file_id) -> lane, and archive name -> lane once the link lookup names the file
+        self.lanes = {}
+        self.by_name = {}
+        self.bytes = {lane: 0 for lane in LANES}
+        self.held = {lane: 0.0 for lane in LANES}
+
+    def set_rate(self, rate):
+        # Bytes per second; applies to the next buffer of every transfer
+        with self.changed:
+            self.rate = max(0.0, float(rate))
+            # Debt run up under the old cap is not carried over to the new one
+            self.tokens = {lane: 0.0 for lane in LANES}
+            self.last_refill = time.monotonic()
+            self.changed.notify_all()
+
+    def capped(self):
+        return self.rate > 0
+
+    def assign(self, mods, pinned=()):
+        # Lanes for a run's files; pinned holds the --pin mod IDs
+        with self.lock:
+            self.lanes = {(mod.game_domain, int(mod.mod_id), int(mod.file_id)): lane_for(mod, pinned) for mod in mods}
+            self.by_name = {}
+            self.bytes = {lane: 0 for lane in LANES}
+            self.held = {lane: 0.0 for lane in LANES}
+
+    def bind(self, filename, game_domain, mod_id, file_id):
+        # The link lookup learns the archive name the transfer will report its bytes under
+        with self.lock:
+            lane = self.lanes.get((game_domain, int(mod_id), int(file_id)))
+            if lane:
+                self.by_name[filename] = lane
+
+    def _shares(self, now):
+        # Called with the lock held
+        busy = [lane for lane in LANES if now - self.last_seen[lane] <= ACTIVE_WINDOW]
+        weight = sum(LANE_WEIGHTS[lane] for lane in busy)
+        return {lane: self.rate * LANE_WEIGHTS[lane] / weight for lane in busy}
+
+    def _refill(self, now):
+        # Called with the lock held; idle lanes keep their debt but save nothing up
+        shares = self._shares(now)
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        for lane in LANES:
+            share = shares.get(lane)
+            if share:
+                self.tokens[lane] = min(share * BURST_SECONDS, self.tokens[lane] + share * elapsed)
+            else:
+                self.tokens[lane] = min(0.0, self.tokens[lane])
+        return shares
+
+    def reserve(self, count, name=None):
+        # Charges count bytes to the file's lane and returns how long the caller should wait
+        # before reading on (at most MAX_WAIT; call again with 0 to keep waiting until it is 0).
+        # Non-blocking so the event-loop engine can await the wait instead of sleeping.
+        if not self.rate:
+            return 0.0
+        with self.lock:
+            lane = self.by_name.get(name, LANE_BULK)
+            now = time.monotonic()
+            self.last_seen[lane] = now
+            shares = self._refill(now)
+            self.tokens[lane] -= count
+            self.bytes[lane] += count
+            if self.tokens[lane] >= 0:
+                return 0.0
+            delay = min(MAX_WAIT, -self.tokens[lane] / shares[lane])
+            self.held[lane] += delay
+            return delay
+
+    def acquire(self, count, name=None, cancelled=None):
+        # Threaded counterpart of reserve: blocks until the lane is paid up, or cancelled() says
+        # to stop. Returns the seconds spent waiting.
+        waited = 0.0
+        delay = self.reserve(count, name)
+        while delay > 0 and not (cancelled and cancelled()):
+            with self.changed:
+                self.changed.wait(delay)
+            waited += delay
+            delay = self.reserve(0, name)
+        return waited
+
+    def summary(self):
+        with self.lock:
+            if not self.rate:
+                return "Bandwidth: no cap"
+            lanes = ", ".join(f"{lane} {self.bytes[lane] / (1024 ** 2):.0f} MB (held {self.held[lane]:.0f}s)"
+                              for lane in LANES if self.bytes[lane])
+            return f"Bandwidth: capped at {self.rate / (1024 ** 2):.1f} MB/s" + (f"; {lanes}" if lanes else "")
+
+BANDWIDTH = BandwidthBudget()
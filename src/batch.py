@@ -0,0 +1,124 @@
+import os
+import threading
+from dataclasses import dataclass, field
+from collection import read_collection
+
+# Batch mode: several collection files (or folders of them) run as one work set. Files are
+# deduplicated across collections by (game, modId, fileId) and grouped by game domain, then
+# everything goes through one scheduler and one worker pool, so a machine being provisioned
+# with five collections pays for one ramp-up and one tail instead of five. Progress is still
+# counted per collection: a file two collections share counts for both.
+
+@dataclass
+class CollectionPart:
+    name: str
+    path: str
+    game_domain: str
+    total: int = 0
+    total_bytes: int = 0
+
+@dataclass
+class Batch:
+    collections: list = field(default_factory=list)
+    # Deduplicated ModFile records, grouped by game domain in the order the games first appear
+    mods: list = field(default_factory=list)
+    # (game, mod_id, file_id) -> indexes into collections of every collection listing the file
+    owners: dict = field(default_factory=dict)
+    # Entries that could not be used, as log messages, and files already listed by an earlier collection
+    skipped: list = field(default_factory=list)
+    duplicates: int = 0
+
+    def game_domains(self):
+        return list(dict.fromkeys(mod.game_domain for mod in self.mods))
+
+def mod_key(mod):
+    return (mod.game_domain, int(mod.mod_id), int(mod.file_id))
+
+def collection_paths(inputs):
+    # Every collection file named: files as given, folders expanded to the .json files in them
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            names = sorted(name for name in os.listdir(item) if name.lower().endswith(".json"))
+            paths += [os.path.join(item, name) for name in names if os.path.isfile(os.path.join(item, name))]
+        else:
+            paths.append(item)
+    if not paths:
+        raise FileNotFoundError(f"No collection files found in {', '.join(inputs)}")
+    return paths
+
+def group_by_domain(mods):
+    # game domain -> its files, in the order the games first appear
+    groups = {}
+    for mod in mods:
+        groups.setdefault(mod.game_domain, []).append(mod)
+    return groups
+
+def read_batch(paths):
+    batch = Batch()
+    merged = {}
+    for path in paths:
+        collection = read_collection(path)
+        index = len(batch.collections)
+        batch.collections.append(CollectionPart(
+            os.path.splitext(os.path.basename(path))[0], path, collection.game_domain,
+            len(collection.mods), sum(mod.size for mod in collection.mods)))
+        batch.skipped += [f"{os.path.basename(path)}: {message}" for message in collection.skipped]
+        batch.duplicates += collection.duplicates
+        for mod in collection.mods:
+            key = mod_key(mod)
+            if key in merged:
+                batch.duplicates += 1
+            else:
+                merged[key] = mod
+            batch.owners.setdefault(key, []).append(index)
+    batch.mods = [mod for group in group_by_domain(merged.values()).values() for mod in group]
+    return batch
+
+class BatchProgress:
+    # Per-collection completed / failed counts for a batch run. Files skipped before the run
+    # (already on disk, linked from the store) count as completed from the start.
+    def __init__(self, batch):
+        self.batch = batch
+        self.lock = threading.Lock()
+        count = len(batch.collections)
+        self.completed = [0] * count
+        self.errors = [0] * count
+
+    def begin(self, run_mods):
+        pending = [0] * len(self.batch.collections)
+        for mod in run_mods:
+            for index in self.batch.owners.get(mod_key(mod), ()):
+                pending[index] += 1
+        with self.lock:
+            self.completed = [part.total - pending[i] for i, part in enumerate(self.batch.collections)]
+            self.errors = [0] * len(self.batch.collections)
+
+    def settle(self, mod, failed=False):
+        # Counts a file that finished (or failed for good) for every collection listing it;
+        # returns the indexes of the collections that have just settled all their files
+        finished = []
+        with self.lock:
+            for index in self.batch.owners.get(mod_key(mod), ()):
+                if failed:
+                    self.errors[index] += 1
+                else:
+                    self.completed[index] += 1
+                if self.completed[index] + self.errors[index] == self.batch.collections[index].total:
+                    finished.append(index)
+        return finished
+
+    def snapshot(self):
+        with self.lock:
+            return [{"name": part.name, "game": part.game_domain, "completed": self.completed[i],
+                     "errors": self.errors[i], "total": part.total}
+                    for i, part in enumerate(self.batch.collections)]
+
+    def collection_message(self, index):
+        part = self.batch.collections[index]
+        with self.lock:
+            completed, errors = self.completed[index], self.errors[index]
+        return f"Collection {part.name} ({part.game_domain}): {completed} of {part.total} files done, {errors} failed"
+
+    def messages(self):
+        return [self.collection_message(index) for index in range(len(self.batch.collections))]
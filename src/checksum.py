@@ -0,0 +1,68 @@
+import concurrent.futures
+import hashlib
+import os
+import threading
+
+# MD5 verification against the hashes listed in collection.json. New downloads are hashed
+# as the bytes stream through the write loop (see transfer.py), so a multi-GB archive is
+# only read back for the ranges that other connections fetched out of order. Files that are
+# already on disk are hashed on a pool sized to the CPU count: hashlib releases the GIL on
+# large buffers, so these threads really do run on separate cores.
+
+HASH_CHUNK_SIZE = 1024 * 1024
+QUARANTINE_DIR = "quarantine"
+# A file whose download fails verification is re-queued this many times before giving up
+MAX_VERIFY_RETRIES = 1
+
+_hash_pool = None
+_hash_pool_lock = threading.Lock()
+
+class ChecksumMismatch(IOError):
+    pass
+
+def new_hasher():
+    return hashlib.md5()
+
+def update_from_file(hasher, path, length=None, start=0):
+    # Feeds `length` bytes of path from offset start (to the end when None) into hasher
+    remaining = length
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while remaining is None or remaining > 0:
+            size = HASH_CHUNK_SIZE if remaining is None else min(HASH_CHUNK_SIZE, remaining)
+            chunk = f.read(size)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return hasher
+
+def md5_file(path):
+    return update_from_file(new_hasher(), path).hexdigest()
+
+def hash_pool():
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is None:
+            _hash_pool = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix="Hash")
+    return _hash_pool
+
+def verify_existing(path, expected_md5):
+    # Blocks the calling worker, but the hashing itself is bounded to one thread per core
+    return hash_pool().submit(md5_file, path).result().lower() == expected_md5.lower()
+
+def quarantine(path):
+    # Moves a file that failed verification out of the folder Vortex scans
+    quarantine_dir = os.path.join(os.path.dirname(path), QUARANTINE_DIR)
+    os.makedirs(quarantine_dir, exist_ok=True)
+    target = os.path.join(quarantine_dir, os.path.basename(path))
+    os.replace(path, target)
+    return target
+
+def check_digest(path, digest, expected_md5):
+    # Raises ChecksumMismatch (after quarantining path) when digest is not the expected hash
+    if not expected_md5 or digest.lower() == expected_md5.lower():
+        return
+    target = quarantine(path)
+    raise ChecksumMismatch(f"MD5 mismatch for {os.path.basename(path)}: got {digest}, expected {expected_md5}. Moved to {target}")
@@ -0,0 +1,167 @@
+import json
+from dataclasses import dataclass, field
+
+# Collection loader. collection.json is read once, incrementally: the "mods" array is decoded
+# one entry at a time with JSONDecoder.raw_decode as the file streams in, so a manifest with
+# tens of thousands of entries is never held as one big parsed document, and each entry is
+# immediately reduced to a small slots record. Merged collections can list the same
+# (modId, fileId) more than once; only the first is kept.
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+_decoder = json.JSONDecoder()
+
+# One downloadable file from the collection, with the per-file metadata the manifest carries
+@dataclass(slots=True)
+class ModFile:
+    mod_id: int
+    file_id: int
+    size: int = 0
+    md5: str = ""
+    logical_filename: str = ""
+    # Nexus game domain the file belongs to: the entry's own domainName, else the collection's
+    game_domain: str = ""
+
+@dataclass(slots=True)
+class Collection:
+    game_domain: str = ""
+    mods: list = field(default_factory=list)
+    # Entries that could not be used (not a Nexus file, missing ids), as log messages
+    skipped: list = field(default_factory=list)
+    duplicates: int = 0
+
+class _StreamParser:
+    # Just enough of a pull parser to walk the top-level object: values are decoded with
+    # raw_decode, refilling the buffer whenever a value runs past what has been read so far
+
+    def __init__(self, f):
+        self.f = f
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        if self.pos > READ_CHUNK_SIZE:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        chunk = self.f.read(READ_CHUNK_SIZE)
+        if chunk:
+            self.buffer += chunk
+        else:
+            self.eof = True
+        return bool(chunk)
+
+    def peek(self):
+        # Next non-whitespace character, without consuming it ("" at the end of the file)
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Malformed collection JSON: expected '{char}' at offset {self.pos}")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.eof or not self.fill():
+                    raise
+                continue
+            # A number (or true/false/null) that ends exactly at the buffer edge may continue
+            if end == len(self.buffer) and not self.eof and self.fill():
+                continue
+            self.pos = end
+            return value
+
+    def members(self):
+        # Yields the keys of the object at the current position; the caller consumes each value
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            if self.peek() == ",":
+                self.pos += 1
+                continue
+            self.expect("}")
+            return
+
+    def items(self):
+        # Yields each element of the array at the current position, decoded one at a time
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == ",":
+                self.pos += 1
+                continue
+            self.expect("]")
+            return
+
+def read_collection(file_path):
+    collection = Collection()
+    seen = set()
+    with open(file_path, 'r', encoding='utf-8-sig') as f:
+        parser = _StreamParser(f)
+        for key in parser.members():
+            if key == "info":
+                info = parser.value()
+                collection.game_domain = info.get("domainName", "") if isinstance(info, dict) else ""
+            elif key == "mods":
+                for entry in parser.items():
+                    add_entry(collection, seen, entry)
+            else:
+                parser.value()
+    # "info" may come after "mods"; entries without a domain of their own get the collection's
+    for mod in collection.mods:
+        if not mod.game_domain:
+            mod.game_domain = collection.game_domain
+    return collection
+
+def add_entry(collection, seen, entry):
+    try:
+        source = entry['source']
+        mod = ModFile(
+            mod_id=int(source['modId']),
+            file_id=int(source['fileId']),
+            size=int(source.get('fileSize') or 0),
+            md5=source.get('md5') or "",
+            logical_filename=source.get('logicalFilename') or "",
+            game_domain=entry.get('domainName') or "",
+        )
+    except (KeyError, TypeError, ValueError) as e:
+        name = entry.get('name', '') if isinstance(entry, dict) else ''
+        collection.skipped.append(f"Skipping entry {name!r} due to missing or invalid key: {e}")
+        return
+    key = (mod.mod_id, mod.file_id)
+    if key in seen:
+        collection.duplicates += 1
+        return
+    seen.add(key)
+    collection.mods.append(mod)
+
+def write_failed_collection(file_path, game_domain, failed):
+    # The files of a run that failed, as (mod, error message), in collection.json form so the
+    # file can be passed straight back to --json; the error is kept alongside each entry
+    mods = [{
+        "name": mod.logical_filename or f"Mod {mod.mod_id}",
+        "domainName": mod.game_domain or game_domain,
+        "source": {"type": "nexus", "modId": mod.mod_id, "fileId": mod.file_id, "fileSize": mod.size,
+                   "md5": mod.md5, "logicalFilename": mod.logical_filename},
+        "error": message,
+    } for mod, message in failed]
+    with open(file_path, 'w', encoding='utf-8') as f:
+        json.dump({"info": {"name": "Failed downloads", "domainName": game_domain}, "mods": mods}, f, indent=2)
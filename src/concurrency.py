@@ -0,0 +1,158 @@
+import threading
+import time
+from transfer import bytes_transferred, set_transfer_slots
+
+# --maxthreads auto: instead of a fixed thread count, the number of active transfers is
+# steered while the run is going. Every CONTROL_INTERVAL seconds the controller compares
+# aggregate throughput and the error rate with the previous interval and adjusts the limit
+# AIMD-style: add one slot while throughput keeps improving, cut by BACKOFF_FACTOR when
+# errors pile up or an increase made throughput worse.
+
+AUTO = "auto"
+AUTO_START_THREADS = 4
+AUTO_MIN_THREADS = 1
+AUTO_MAX_THREADS = 64
+CONTROL_INTERVAL = 5.0
+# Throughput must improve by at least this fraction for an increase to count as a win
+GAIN_THRESHOLD = 0.05
+# A fall of more than this fraction right after an increase is treated as congestion
+DROP_TOLERANCE = 0.10
+# Share of files failing in an interval that triggers a decrease
+ERROR_RATE_THRESHOLD = 0.10
+BACKOFF_FACTOR = 0.7
+# After a plateau or a decrease, wait this many intervals before probing upwards again
+HOLD_INTERVALS = 2
+
+def threads_arg(value):
+    # argparse type for --maxthreads: a positive integer or "auto"
+    if str(value).lower() == AUTO:
+        return AUTO
+    threads = int(value)
+    if threads < 1:
+        raise ValueError("--maxthreads must be at least 1")
+    return threads
+
+def fixed_threads(max_threads, default=10):
+    # Thread count for the parts of a run that are not adaptive (endorsing, dry runs)
+    return default if max_threads == AUTO else int(max_threads)
+
+class AdaptiveLimiter:
+    def __init__(self, start=AUTO_START_THREADS, minimum=AUTO_MIN_THREADS, maximum=AUTO_MAX_THREADS):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = max(minimum, min(maximum, start))
+        self.active = 0
+        self.completed = 0
+        self.errors = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def try_acquire(self):
+        # Non-blocking variant for the event-loop engine, which polls instead of waiting
+        with self.condition:
+            if self.active >= self.limit:
+                return False
+            self.active += 1
+            return True
+
+    def release(self, failed=False):
+        with self.condition:
+            self.active -= 1
+            if failed:
+                self.errors += 1
+            else:
+                self.completed += 1
+            self.condition.notify()
+
+    def set_limit(self, limit):
+        with self.condition:
+            self.limit = max(self.minimum, min(self.maximum, int(limit)))
+            self.condition.notify_all()
+            return self.limit
+
+    def snapshot(self):
+        with self.condition:
+            return self.limit, self.active, self.completed, self.errors
+
+    def run(self, fn, *args):
+        # Runs fn inside a slot and records whether it failed
+        self.acquire()
+        try:
+            result = fn(*args)
+        except Exception:
+            self.release(failed=True)
+            raise
+        self.release()
+        return result
+
+class ConcurrencyController(threading.Thread):
+    def __init__(self, limiter, logger=None, interval=CONTROL_INTERVAL):
+        super().__init__(name="ConcurrencyController", daemon=True)
+        self.limiter = limiter
+        self.logger = logger
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.last_rate = None
+        self.last_action = None
+        self.hold = 0
+        set_transfer_slots(limiter.limit)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def run(self):
+        last_time = time.time()
+        last_bytes = bytes_transferred()
+        _, _, last_completed, last_errors = self.limiter.snapshot()
+        while not self.stopped.wait(self.interval):
+            now = time.time()
+            total_bytes = bytes_transferred()
+            limit, active, completed, errors = self.limiter.snapshot()
+            rate = (total_bytes - last_bytes) / max(now - last_time, 1e-6)
+            finished = (completed - last_completed) + (errors - last_errors)
+            error_rate = (errors - last_errors) / finished if finished else 0.0
+            self.decide(limit, active, rate, error_rate)
+            last_time, last_bytes, last_completed, last_errors = now, total_bytes, completed, errors
+
+    def decide(self, limit, active, rate, error_rate):
+        new_limit, reason = limit, None
+        if error_rate > ERROR_RATE_THRESHOLD:
+            new_limit = int(limit * BACKOFF_FACTOR)
+            reason = f"error rate {error_rate:.0%}"
+        elif self.last_action == "increase" and self.last_rate and rate < self.last_rate * (1 - DROP_TOLERANCE):
+            new_limit = int(limit * BACKOFF_FACTOR)
+            reason = "throughput fell after the last increase"
+        elif self.hold > 0:
+            self.hold -= 1
+            reason = "holding"
+        elif active < limit:
+            reason = "not every slot is busy"
+        elif self.last_action == "increase" and self.last_rate and rate < self.last_rate * (1 + GAIN_THRESHOLD):
+            self.hold = HOLD_INTERVALS
+            reason = "throughput plateaued"
+        else:
+            new_limit = limit + 1
+            reason = "throughput still improving"
+
+        new_limit = self.limiter.set_limit(new_limit)
+        if new_limit > limit:
+            self.last_action = "increase"
+        elif new_limit < limit:
+            self.last_action = "decrease"
+            self.hold = HOLD_INTERVALS
+        else:
+            self.last_action = "hold"
+        # Idle-slot accounting for segmented transfers follows the adaptive limit
+        set_transfer_slots(new_limit)
+        self.last_rate = rate
+
+        if self.logger:
+            self.logger.verbose(
+                f"Concurrency {limit} -> {new_limit}: {rate / (1024 * 1024):.2f} MB/s, "
+                f"error rate {error_rate:.0%}, {active} active ({reason})")
@@ -29,3 +29,18 @@ def get_config() -> Config:
     
     # Return a complete Config object
     return Config(AccessControl=access_control, VortexSettings=vortex_settings)
+
+# The configuration in use by this process: loaded on first use, or injected with set_config
+# (the GUI does so after its settings dialog, so a changed API key or downloads folder
+# applies to the next request without restarting)
+_current = None
+
+def set_config(config: Config):
+    global _current
+    _current = config
+
+def current_config() -> Config:
+    global _current
+    if _current is None:
+        _current = get_config()
+    return _current
@@ -0,0 +1,155 @@
+import os
+import queue
+import shutil
+import threading
+
+# Disk writes are handed off to a few dedicated writer threads so a slow or contended disk
+# does not stall the sockets: network readers fill pooled buffers with readinto and queue
+# them, and carry on reading while the writers catch up. The pool is the bounded buffer
+# between the two stages; when it runs dry the readers wait, which is the back-pressure that
+# keeps memory flat however far the disk falls behind.
+
+BUFFER_SIZE = 256 * 1024
+POOL_BUFFERS = 128
+WRITER_THREADS = 4
+
+_writer = None
+_writer_lock = threading.Lock()
+
+class BufferPool:
+    def __init__(self, count=POOL_BUFFERS, size=BUFFER_SIZE):
+        self.size = size
+        self.free = queue.Queue()
+        for _ in range(count):
+            self.free.put(bytearray(size))
+
+    def acquire(self):
+        return self.free.get()
+
+    def try_acquire(self):
+        # A free buffer, or None instead of waiting for one (for the event-loop engine)
+        try:
+            return self.free.get_nowait()
+        except queue.Empty:
+            return None
+
+    def release(self, buffer):
+        self.free.put(buffer)
+
+class WriteStream:
+    # One open file's queue of pending writes. Every write of a stream goes to the same writer
+    # thread, so they land in order and the file object is only ever touched by that thread.
+
+    def __init__(self, writer, f, jobs):
+        self.writer = writer
+        self.f = f
+        self.jobs = jobs
+        self.condition = threading.Condition()
+        self.pending = 0
+        self.error = None
+
+    def write(self, buffer, length, offset):
+        # Takes ownership of a pooled buffer; it goes back to the pool once written
+        if self.error:
+            self.writer.pool.release(buffer)
+            raise self.error
+        with self.condition:
+            self.pending += 1
+        self.jobs.put((self, buffer, length, offset))
+
+    def wait(self):
+        with self.condition:
+            while self.pending:
+                self.condition.wait()
+
+    def flush(self):
+        # Returns once every queued write is in the file and flushed, so a sidecar written
+        # afterwards never claims bytes that are not on disk
+        if not self.drain():
+            raise self.error
+
+    def drain(self):
+        # Waits for and flushes whatever is queued without raising; False if a write failed
+        self.wait()
+        if self.error:
+            return False
+        self.f.flush()
+        return True
+
+    def finished(self, error=None):
+        with self.condition:
+            if error and not self.error:
+                self.error = error
+            self.pending -= 1
+            if not self.pending:
+                self.condition.notify_all()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Never let the caller close the file under a writer
+        self.wait()
+        if exc_type is None and self.error:
+            raise self.error
+
+class DiskWriter:
+    def __init__(self, threads=WRITER_THREADS, pool=None):
+        self.pool = pool or BufferPool()
+        self.queues = [queue.Queue() for _ in range(threads)]
+        self.next_queue = 0
+        self.lock = threading.Lock()
+        for i, jobs in enumerate(self.queues):
+            threading.Thread(target=self.work, args=(jobs,), name=f"DiskWriter-{i}", daemon=True).start()
+
+    def stream(self, f):
+        with self.lock:
+            jobs = self.queues[self.next_queue]
+            self.next_queue = (self.next_queue + 1) % len(self.queues)
+        return WriteStream(self, f, jobs)
+
+    def work(self, jobs):
+        while True:
+            stream, buffer, length, offset = jobs.get()
+            error = None
+            try:
+                if not stream.error:
+                    if stream.f.tell() != offset:
+                        stream.f.seek(offset)
+                    stream.f.write(memoryview(buffer)[:length])
+            except Exception as e:
+                error = e
+            finally:
+                self.pool.release(buffer)
+                stream.finished(error)
+
+def disk_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = DiskWriter()
+        return _writer
+
+def preallocate(f, size):
+    # Reserves the whole file up front so a multi-GB archive is not grown (and fragmented)
+    # one write at a time; posix_fallocate really allocates blocks, truncate is the portable
+    # fallback (on Windows it sets the end of file, which allocates as well)
+    f.flush()
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError:
+            pass
+    if os.fstat(f.fileno()).st_size < size:
+        f.truncate(size)
+
+def free_space(folder):
+    # Free bytes on the volume that holds folder (which may not exist yet)
+    path = os.path.abspath(folder)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return shutil.disk_usage(path).free
@@ -1,64 +1,214 @@
 import os
-import requests
 import time
 from datetime import timedelta
-from config import get_config
-
-CONFIG = get_config()
+from config import current_config
+from session import api_request, API_BASE
+from transfer import fetch_to_path, transfer_checkpoint, probe_mirror
+from mirrors import MIRRORS
+from metrics import METRICS
+from bandwidth import BANDWIDTH
+from retry import BREAKER, error_status
+from checksum import verify_existing, quarantine
+from manifest import STATUS_RESOLVED, STATUS_COMPLETE
+from linkcache import LinkRejected, REJECTED_STATUSES
 
 # Add this global variable to hold the logger instance
 LOGGER = None
+# --verify-existing: hash files that are already on disk instead of trusting them
+VERIFY_EXISTING = False
+# Run manifest (manifest.RunManifest) that remembers resolved filenames and finished files
+MANIFEST = None
+# One-pass indexes of the downloads folders (folderindex.FolderIndex) by folder, used instead of os.path.exists
+INDEXES = {}
+# Content-addressed archive store (store.ArchiveStore) that keeps every verified download, or None
+STORE = None
+# Cache of resolved download links (linkcache.LinkCache), or None to ask the API every time
+LINKS = None
 
 def set_download_logger(logger):
     global LOGGER
     LOGGER = logger
 
-def get_download_url(game_domain, mod_id, file_id):
-    header = {
-        'apikey': CONFIG.AccessControl.NexusAPIKey,
-        'Accept': 'application/json',
-    }
+def set_verify_existing(enabled):
+    global VERIFY_EXISTING
+    VERIFY_EXISTING = enabled
 
-    url = f'https://api.nexusmods.com/v1/games/{game_domain}/mods/{mod_id}/files/{file_id}/download_link.json'
-    response = requests.get(url, headers=header)
-    response.raise_for_status()
-    download_info = response.json()
+def set_download_manifest(manifest):
+    global MANIFEST
+    MANIFEST = manifest
 
-    # Pick the first CDN link
-    return download_info[0]['URI'] if download_info else None
+def set_download_index(index):
+    # Replaces every index with this one (None clears them)
+    global INDEXES
+    INDEXES = {index.folder: index} if index else {}
 
-def download_file(game_domain, gamefolder, mod_id, file_id, current_counter):
-    download_start = time.time()
+def add_download_index(index):
+    # A batch run writes to one folder per game, each with its own index
+    INDEXES[index.folder] = index
 
-    download_dir = os.path.join(CONFIG.VortexSettings.DownloadsFolderRoot, gamefolder)
-    # Get download URL
-    url = get_download_url(game_domain, mod_id, file_id)
-    if not url:
-        if LOGGER:
-            LOGGER.verbose(f"{str(current_counter).zfill(4)}\tNo download URL found for mod {mod_id}, file {file_id}")
+def index_for(file_path):
+    return INDEXES.get(os.path.normcase(os.path.dirname(os.path.abspath(file_path)))) if INDEXES else None
+
+def set_download_store(store):
+    global STORE
+    STORE = store
+
+def set_download_links(cache):
+    global LINKS
+    LINKS = cache
+
+def existing_size(file_path):
+    # Size of the finished archive at file_path, or None when there is none (zero bytes counts as none)
+    index = index_for(file_path)
+    if index:
+        return index.size(os.path.basename(file_path))
+    try:
+        return os.path.getsize(file_path) or None
+    except OSError:
+        return None
+
+def record_manifest(game_domain, mod_id, file_id, file_path, status, expected_md5=None, size=None):
+    if status == STATUS_COMPLETE:
+        if size is None:
+            size = os.path.getsize(file_path)
+        index = index_for(file_path)
+        if index:
+            index.add(os.path.basename(file_path), size)
+    if MANIFEST:
+        MANIFEST.record(game_domain, mod_id, file_id, os.path.basename(file_path), status, size or 0, expected_md5)
+
+def store_download(file_path, expected_md5=None):
+    # A download whose MD5 was checked on the way in goes into the archive store for other game folders
+    if STORE and expected_md5:
+        STORE.add(file_path, expected_md5, os.path.getsize(file_path))
+
+def forget_existing(file_path):
+    index = index_for(file_path)
+    if index:
+        index.remove(os.path.basename(file_path))
+
+class Elapsed:
+    # Log argument for the "Time(...)" column: captures the time now, but only builds the
+    # timedelta text if the line is actually written (on the log listener thread)
+    __slots__ = ("seconds",)
+
+    def __init__(self, since):
+        self.seconds = time.time() - since
+
+    def __str__(self):
+        return str(timedelta(seconds=self.seconds))
+
+def downloads_root():
+    return current_config().VortexSettings.DownloadsFolderRoot
+
+def download_dir(gamefolder):
+    return os.path.join(downloads_root(), gamefolder)
+
+def download_link_url(game_domain, mod_id, file_id):
+    return f'{API_BASE}/games/{game_domain}/mods/{mod_id}/files/{file_id}/download_link.json'
+
+def filename_from_url(url):
+    return os.path.basename(url.split('?')[0])
+
+def get_download_urls(game_domain, mod_id, file_id):
+    # Still-valid signed links from an earlier lookup need no API call
+    links = LINKS.get(game_domain, mod_id, file_id) if LINKS else None
+    api_seconds = 0.0
+    if not links:
+        url = download_link_url(game_domain, mod_id, file_id)
+        response = api_request('GET', url)
+        response.raise_for_status()
+        links = response.json() or []
+        api_seconds = response.elapsed.total_seconds()
+        if LINKS:
+            LINKS.put(game_domain, mod_id, file_id, links)
+    urls = rank_mirrors(links)
+    if urls:
+        METRICS.resolved(filename_from_url(urls[0]), mod_id, file_id, api_seconds)
+        # The transfer draws on the bandwidth budget under this name
+        BANDWIDTH.bind(filename_from_url(urls[0]), game_domain, mod_id, file_id)
+    return urls
+
+def reject_links(urls, error):
+    # A link the CDN refuses is dropped from the link cache. If the file had been given cached
+    # links, the refusal is most likely a stale signature: raise the retryable LinkRejected so
+    # the next attempt resolves a fresh link instead of failing the file for good.
+    if not LINKS or error_status(error) not in REJECTED_STATUSES:
         return
+    reused = [LINKS.reject(url) for url in urls]
+    if any(reused):
+        raise LinkRejected(f"Cached download link refused with HTTP {error_status(error)}, resolving it again") from error
+
+def mirrors_to_probe(links):
+    # Mirrors without recent history, each claimed by the first file that meets it in this run;
+    # with a single mirror there is nothing to choose
+    if len(links) < 2:
+        return []
+    return [link['URI'] for link in links if MIRRORS.claim_probe(link['URI'])]
+
+def rank_mirrors(links):
+    # Every mirror's URL, best first
+    for url in mirrors_to_probe(links):
+        probe_mirror(url)
+    return MIRRORS.rank(links, BREAKER.open_hosts())
+
+# First half of download_file: look up the CDN link and decide whether a transfer is needed.
+# Returns (urls, file_path) with the mirror URLs best first, or None when there is nothing to download.
+def resolve_file(game_domain, gamefolder, mod_id, file_id, current_counter, download_start, expected_md5=None):
+    # Blocks while the run is paused and stops here once it is cancelled
+    transfer_checkpoint()
+    # Get download URLs
+    urls = get_download_urls(game_domain, mod_id, file_id)
+    if not urls:
+        if LOGGER:
+            LOGGER.verbose("%04d\tNo download URL found for mod %s, file %s", current_counter, mod_id, file_id)
+        return None
 
-    filename = os.path.basename(url.split('?')[0])
-    file_path = os.path.join(download_dir, filename)
+    filename = filename_from_url(urls[0])
+    file_path = os.path.join(download_dir(gamefolder), filename)
 
     # Check if the file already exists
-    if os.path.exists(file_path):
+    size = existing_size(file_path)
+    if size and VERIFY_EXISTING and expected_md5 and not verify_existing(file_path, expected_md5):
+        forget_existing(file_path)
+        target = quarantine(file_path)
         if LOGGER:
-            LOGGER.verbose(
-                f"{str(current_counter).zfill(4)}\tTime({timedelta(seconds=time.time() - download_start)})\tFile {filename} already exists. Skipping download.")
-        return
+            LOGGER.verbose("%04d\tFile %s failed MD5 verification, moved to %s and downloading again", current_counter, filename, target)
+    elif size:
+        if LOGGER:
+            LOGGER.verbose("%04d\tTime(%s)\tFile %s already exists. Skipping download.",
+                           current_counter, Elapsed(download_start), filename)
+        record_manifest(game_domain, mod_id, file_id, file_path, STATUS_COMPLETE, expected_md5, size)
+        if VERIFY_EXISTING:
+            # Just checked against the MD5, so it can go into the archive store as well
+            store_download(file_path, expected_md5)
+        return None
+
+    record_manifest(game_domain, mod_id, file_id, file_path, STATUS_RESOLVED, expected_md5)
+    return urls, file_path
 
+# Second half of download_file: move the bytes
+def transfer_file(urls, file_path, current_counter, download_start, expected_md5=None):
+    filename = os.path.basename(file_path)
     if LOGGER:
-        LOGGER.verbose(
-            f"{str(current_counter).zfill(4)}\tTime({timedelta(seconds=time.time() - download_start)})\tDownloading {filename}")
+        LOGGER.verbose("%04d\tTime(%s)\tDownloading %s", current_counter, Elapsed(download_start), filename)
 
-    # Proceed with downloading if the file doesn't exist
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        with open(file_path, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                f.write(chunk)
+    # Proceed with downloading if the file doesn't exist, resuming any earlier partial transfer
+    try:
+        fetch_to_path(urls, file_path, expected_md5)
+    except Exception as e:
+        reject_links(urls, e)
+        raise
+    store_download(file_path, expected_md5)
 
     if LOGGER:
-        LOGGER.verbose(
-            f"{str(current_counter).zfill(4)}\tTime({timedelta(seconds=time.time() - download_start)})\tDownloaded {filename} to {file_path}")
+        LOGGER.verbose("%04d\tTime(%s)\tDownloaded %s to %s", current_counter, Elapsed(download_start), filename, file_path)
+
+def download_file(game_domain, gamefolder, mod_id, file_id, current_counter, expected_md5=None):
+    download_start = time.time()
+
+    resolved = resolve_file(game_domain, gamefolder, mod_id, file_id, current_counter, download_start, expected_md5)
+    if resolved:
+        urls, file_path = resolved
+        transfer_file(urls, file_path, current_counter, download_start, expected_md5)
+        record_manifest(game_domain, mod_id, file_id, file_path, STATUS_COMPLETE, expected_md5)
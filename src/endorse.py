@@ -1,8 +1,45 @@
-import requests
-from datetime import timedelta
-from config import get_config 
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from config import current_config
+from manifest import STATE_DIR
+from session import api_request, API_BASE
+from ratelimit import GOVERNOR
+from transfer import transfer_checkpoint, TransferCancelled
 
-CONFIG = get_config()
+# Endorsement pass. Nexus endorses mods, not files, so a collection is reduced to one POST per
+# mod ID, and mods the user has already endorsed (or abstained from) are not sent at all: the
+# user's endorsement list is fetched once and cached in state/endorsements.json. POSTs are spaced
+# ENDORSE_INTERVAL apart on top of the rate-limit governor, and every mod ends with one of the
+# outcomes below, which the pass counts for its report.
+
+ENDORSEMENTS_FILE = "endorsements.json"
+# The cached list is fetched again after this long; mods endorsed here are added to it as they go
+ENDORSEMENTS_MAX_AGE = 24 * 3600
+# Minimum spacing between two endorse POSTs, whatever the number of threads
+ENDORSE_INTERVAL = 1.0
+
+ENDORSED = "endorsed"
+# Already endorsed (or abstained) according to the user's list; no call made
+ALREADY_ENDORSED = "already endorsed"
+# Nexus only accepts an endorsement 24 hours after the mod was downloaded
+TOO_SOON = "too soon"
+# Never downloaded with this account, or the user's own mod
+INELIGIBLE = "ineligible"
+FAILED = "failed"
+# Not sent: the run was cancelled first
+CANCELLED = "cancelled"
+
+# Messages Nexus sends with a 403 for an endorsement it will not accept
+TOO_SOON_MESSAGES = {"TOO_SOON_AFTER_DOWNLOAD"}
+INELIGIBLE_MESSAGES = {"NOT_DOWNLOADED_MOD", "IS_OWN_MOD"}
+# Statuses in the user's endorsement list that mean the mod should not be endorsed again
+SETTLED_STATUSES = {"Endorsed", "Abstained"}
 
 LOGGER = None
 
@@ -10,18 +47,199 @@ def set_endorse_logger(logger):
     global LOGGER
     LOGGER = logger
 
-def endorse_mod(game_domain, mod_id, file_id):
+def default_endorsements_path():
+    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return os.path.join(root_dir, STATE_DIR, ENDORSEMENTS_FILE)
+
+def key_fingerprint(api_key):
+    # The cache belongs to one account; only a hash of its key is stored
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+
+class EndorsementCache:
+    def __init__(self, path=None):
+        self.path = path or default_endorsements_path()
+        self.lock = threading.Lock()
+        self.account = None
+        self.fetched = 0.0
+        # "game/mod_id" -> status from the user's endorsement list
+        self.mods = {}
+
+    def load(self, account):
+        # True when the file holds a fresh list for this account
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if not isinstance(data, dict) or data.get("account") != account:
+            return False
+        with self.lock:
+            self.account = account
+            self.fetched = float(data.get("fetched", 0))
+            self.mods = dict(data.get("mods", {}))
+        return time.time() - self.fetched < ENDORSEMENTS_MAX_AGE
+
+    def fetch(self, account):
+        response = api_request('GET', f'{API_BASE}/user/endorsements.json')
+        response.raise_for_status()
+        mods = {f"{entry['domain_name']}/{entry['mod_id']}": entry.get("status", "")
+                for entry in response.json() or [] if "domain_name" in entry and "mod_id" in entry}
+        with self.lock:
+            self.account = account
+            self.fetched = time.time()
+            self.mods = mods
+
+    def ensure(self):
+        # The user's list, from the cache file while it is fresh and from the API otherwise
+        account = key_fingerprint(current_config().AccessControl.NexusAPIKey)
+        if self.load(account):
+            return
+        try:
+            self.fetch(account)
+        except Exception as e:
+            # Not fatal: every mod is then POSTed and Nexus sorts out the ones already endorsed
+            if LOGGER:
+                LOGGER.warning(f"Could not fetch your endorsement list, endorsing without it: {e}")
+            return
+        self.save()
+
+    def settled(self, game_domain, mod_id):
+        with self.lock:
+            return self.mods.get(f"{game_domain}/{mod_id}") in SETTLED_STATUSES
+
+    def add(self, game_domain, mod_id, status="Endorsed"):
+        with self.lock:
+            self.mods[f"{game_domain}/{mod_id}"] = status
 
-    header = {
-        'apikey': CONFIG.AccessControl.NexusAPIKey,
-        'Accept': 'application/json',
-    }
+    def save(self):
+        with self.lock:
+            if self.account is None:
+                return
+            data = {"account": self.account, "fetched": self.fetched, "mods": dict(self.mods)}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
 
+class Pacer:
+    # Hands out call times at least interval apart to any number of threads
+    def __init__(self, interval=ENDORSE_INTERVAL):
+        self.lock = threading.Lock()
+        self.interval = interval
+        self.next_call = 0.0
 
-    url = f'https://api.nexusmods.com/v1/games/{game_domain}/mods/{mod_id}/endorse.json'
-    response = requests.post(url, headers=header)
+    def wait(self):
+        # Raises TransferCancelled as soon as the run is cancelled
+        with self.lock:
+            now = time.monotonic()
+            at = max(now, self.next_call)
+            self.next_call = at + self.interval
+        if at > now and GOVERNOR.cancelled.wait(at - now):
+            raise TransferCancelled("Endorsing cancelled")
+
+@dataclass
+class EndorseReport:
+    counts: Counter = field(default_factory=Counter)
+    # Files dropped because another file of the same mod is already in the pass
+    duplicates: int = 0
+    failures: list = field(default_factory=list)
+
+    def merge(self, other):
+        self.counts.update(other.counts)
+        self.duplicates += other.duplicates
+        self.failures += other.failures
+        return self
+
+    def message(self):
+        counts = self.counts
+        return (f"Endorsements: {counts[ENDORSED]} endorsed, {counts[ALREADY_ENDORSED]} skipped as already endorsed, "
+                f"{counts[TOO_SOON]} still inside the 24-hour window after download, "
+                f"{counts[INELIGIBLE]} not eligible (not downloaded with this account, or your own), "
+                f"{counts[FAILED]} failed; {self.duplicates} extra files of the same mods not sent"
+                + (f"; cancelled before {counts[CANCELLED]} mods were sent" if counts[CANCELLED] else ""))
+
+def error_message(response):
+    try:
+        return (response.json() or {}).get("message", "")
+    except ValueError:
+        return ""
+
+def endorse_mod(game_domain, mod_id):
+    # Returns ENDORSED, TOO_SOON or INELIGIBLE; any other failure raises
+    url = f'{API_BASE}/games/{game_domain}/mods/{mod_id}/endorse.json'
+    response = api_request('POST', url)
+    if response.status_code == 403:
+        message = error_message(response)
+        if message in TOO_SOON_MESSAGES:
+            return TOO_SOON
+        if message in INELIGIBLE_MESSAGES:
+            return INELIGIBLE
     response.raise_for_status()
     if LOGGER:
-        LOGGER.verbose(f"Endorsed mod {mod_id} with file {file_id} successfully.")
-        
-    return response.json()
\ No newline at end of file
+        LOGGER.verbose(f"Endorsed mod {mod_id} successfully.")
+    return ENDORSED
+
+def unique_mods(mods):
+    # First file of every mod, in collection order (mod IDs are per game, so a batch keys on both)
+    seen = set()
+    unique = []
+    for mod in mods:
+        key = (mod.game_domain, int(mod.mod_id))
+        if key not in seen:
+            seen.add(key)
+            unique.append(mod)
+    return unique
+
+def endorse_collection(game_domain, mods, max_threads=10, on_outcome=None, cache=None):
+    # Endorses every mod of the collection once. on_outcome(mod, outcome, error) is called per
+    # mod from the worker threads. Returns an EndorseReport.
+    cache = cache or EndorsementCache()
+    report = EndorseReport()
+    unique = unique_mods(mods)
+    report.duplicates = len(mods) - len(unique)
+    cache.ensure()
+    pacer = Pacer()
+    lock = threading.Lock()
+
+    def finish(mod, outcome, error=None):
+        with lock:
+            report.counts[outcome] += 1
+            if error is not None:
+                report.failures.append((mod, str(error)))
+        if on_outcome:
+            on_outcome(mod, outcome, error)
+
+    def endorse(mod):
+        try:
+            # Holds while paused; after a cancel the remaining mods are not sent
+            transfer_checkpoint()
+            pacer.wait()
+            transfer_checkpoint()
+            outcome = endorse_mod(game_domain, mod.mod_id)
+        except TransferCancelled:
+            finish(mod, CANCELLED)
+            return
+        except Exception as e:
+            if LOGGER:
+                LOGGER.error(f"Error endorsing mod {mod.mod_id}: {e}")
+            finish(mod, FAILED, e)
+            return
+        if outcome == ENDORSED:
+            cache.add(game_domain, mod.mod_id)
+        elif LOGGER:
+            LOGGER.verbose(f"Not endorsing mod {mod.mod_id}: {outcome}")
+        finish(mod, outcome)
+
+    pending = []
+    for mod in unique:
+        if cache.settled(game_domain, mod.mod_id):
+            finish(mod, ALREADY_ENDORSED)
+        else:
+            pending.append(mod)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, int(max_threads))) as executor:
+            list(executor.map(endorse, pending))
+    finally:
+        cache.save()
+    return report
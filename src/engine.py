@@ -0,0 +1,92 @@
+import threading
+import loadcollection
+from config import set_config
+from events import set_event_sink
+from transfer import pause_transfers, resume_transfers, cancel_transfers, transfers_paused
+from bandwidth import BANDWIDTH
+from session import close_session
+
+# In-process download engine for the GUI. Instead of starting a new interpreter running
+# loadcollection.py for every download and endorse pass (re-importing requests and re-reading
+# config.json each time), the GUI keeps one engine, hands it the configuration it already
+# loaded, and runs collections on a worker thread. Progress arrives through on_event as the
+# same dicts loadcollection --events prints as JSON lines.
+
+class DownloadEngine:
+    def __init__(self, config=None, on_event=None):
+        if config is not None:
+            set_config(config)
+        self.on_event = on_event
+        self.thread = None
+        self.running = threading.Event()
+        # run swaps process-wide state (event sink, counters), so one run at a time
+        self.run_lock = threading.Lock()
+
+    def configure(self, config):
+        # Takes effect from the next API call and the next file; nothing is restarted
+        set_config(config)
+
+    def load(self, json_path):
+        # (batch, logger) for one collection file or folder, or a list of them; blocking. A caller
+        # that wants to check the batch before running it hands the result to run as loaded.
+        return loadcollection.load_collections([json_path] if isinstance(json_path, str) else list(json_path))
+
+    def run(self, json_path, gamefolder, max_threads=10, endorse_only=False, on_event=None, loaded=None, **options):
+        # Blocking; call it from a worker thread. json_path is one collection file or folder, or a
+        # list of them run as one batch. options are run_collection's keyword arguments. Raises
+        # RuntimeError while another run is going.
+        sink = on_event or self.on_event
+        with self.run_lock:
+            if self.running.is_set():
+                raise RuntimeError("A download or endorsement pass is already running")
+            self.running.set()
+        loadcollection.EVENTS = sink is not None
+        set_event_sink(sink)
+        try:
+            batch, logger = loaded or self.load(json_path)
+            return loadcollection.run_collection(batch.mods, gamefolder, max_threads, endorse_only=endorse_only,
+                                                 batch=batch, logger=logger, **options)
+        finally:
+            set_event_sink(None)
+            self.running.clear()
+
+    def start(self, json_path, gamefolder, max_threads=10, endorse_only=False, on_event=None, **options):
+        # Non-blocking variant of run on a thread of its own
+        self.thread = threading.Thread(
+            target=self.run, args=(json_path, gamefolder, max_threads, endorse_only, on_event),
+            kwargs=options, name="DownloadEngine", daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def wait(self, timeout=None):
+        if self.thread:
+            self.thread.join(timeout)
+
+    def is_running(self):
+        return self.running.is_set()
+
+    def pause(self):
+        # Transfers hold at their next buffer and no new file is started until resume
+        pause_transfers()
+
+    def resume(self):
+        resume_transfers()
+
+    def is_paused(self):
+        return transfers_paused()
+
+    def set_bandwidth_limit(self, mbps):
+        # MB/s for all transfers together, 0 for no cap; a running download follows it from its
+        # next buffer, and runs started later keep it
+        BANDWIDTH.set_rate(float(mbps) * 1024 * 1024)
+
+    def cancel(self):
+        # In-flight transfers stop at their next buffer with their .part and sidecar saved, so
+        # the next run resumes them; files not started yet are skipped
+        cancel_transfers()
+
+    def close(self):
+        # Drops the keep-alive connections the engine's runs share; a later run opens new ones.
+        # Left alone while a run is still going, which ends with the app.
+        if not self.is_running():
+            close_session()
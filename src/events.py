@@ -0,0 +1,124 @@
+import json
+import sys
+import threading
+import time
+from transfer import bytes_transferred, transfers_snapshot
+
+# Machine-readable progress for the GUI (--events, or in-process through engine.py). Every event
+# is one JSON object per line on stdout, or a dict handed to the engine's callback, with an
+# "event" field: start, progress, complete, retry, error and summary (whose retry_json names
+# the collection file of the files that failed, if any). In a batch run, start, progress and
+# summary also carry "collections": {name, game, completed, errors, total} per collection file.
+# Per-file events are written as they happen; byte progress, throughput and ETA are coalesced
+# into one "progress" event per PROGRESS_INTERVAL, however many files or chunks move in
+# between, so a run of thousands of small files produces a handful of lines per second.
+
+PROGRESS_INTERVAL = 0.5
+# Weight of the newest interval in the smoothed throughput used for the ETA
+RATE_SMOOTHING = 0.3
+
+_write_lock = threading.Lock()
+# In-process consumer (engine.DownloadEngine); events go to it as dicts instead of to stdout
+_sink = None
+
+def set_event_sink(sink):
+    global _sink
+    _sink = sink
+
+def emit(event, **fields):
+    payload = {"event": event, "time": round(time.time(), 3), **fields}
+    sink = _sink
+    if sink:
+        sink(payload)
+        return
+    line = json.dumps(payload)
+    with _write_lock:
+        sys.stdout.write(line + "\n")
+        sys.stdout.flush()
+
+class ProgressReporter(threading.Thread):
+    def __init__(self, total, total_bytes, interval=PROGRESS_INTERVAL, collections=None):
+        super().__init__(name="ProgressReporter", daemon=True)
+        self.total = total
+        self.total_bytes = total_bytes
+        # Batch runs: batch.BatchProgress, whose per-collection counts go out with start, progress and summary
+        self.collections = collections
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.completed = 0
+        self.errors = 0
+        self.retries = 0
+        # Collection sizes of the files that are done, so skipped files count towards the ETA too
+        self.settled_bytes = 0
+        self.start_time = time.time()
+        self.start_bytes = bytes_transferred()
+        self.rate = None
+
+    def begin(self):
+        emit("start", total=self.total, total_bytes=self.total_bytes, **self.collection_fields())
+        self.start()
+
+    def file_complete(self, mod=None):
+        with self.lock:
+            self.completed += 1
+            self.settled_bytes += mod.size if mod else 0
+            completed = self.completed
+        emit("complete", completed=completed, total=self.total, **mod_fields(mod))
+
+    def file_error(self, mod, error):
+        with self.lock:
+            self.errors += 1
+            self.settled_bytes += mod.size if mod else 0
+            errors = self.errors
+        emit("error", errors=errors, message=str(error), **mod_fields(mod))
+
+    def file_retry(self, mod, error):
+        with self.lock:
+            self.retries += 1
+        emit("retry", message=str(error), **mod_fields(mod))
+
+    def run(self):
+        last_time = self.start_time
+        last_bytes = self.start_bytes
+        last_transfers = transfers_snapshot()
+        while not self.stopped.wait(self.interval):
+            now = time.time()
+            total_bytes = bytes_transferred()
+            transfers = transfers_snapshot()
+            elapsed = max(now - last_time, 1e-6)
+            rate = (total_bytes - last_bytes) / elapsed
+            self.rate = rate if self.rate is None else RATE_SMOOTHING * rate + (1 - RATE_SMOOTHING) * self.rate
+            # Only transfers that moved bytes in this interval
+            active = {name: round((count - last_transfers.get(name, 0)) / elapsed)
+                      for name, count in transfers.items() if count != last_transfers.get(name, 0)}
+            self.progress(total_bytes, active)
+            last_time, last_bytes, last_transfers = now, total_bytes, transfers
+
+    def progress(self, total_bytes, active):
+        with self.lock:
+            done_bytes = max(self.settled_bytes, total_bytes - self.start_bytes)
+            completed, errors = self.completed, self.errors
+        remaining = max(0, self.total_bytes - done_bytes)
+        eta = round(remaining / self.rate) if self.rate else None
+        emit("progress", completed=completed, errors=errors, total=self.total,
+             bytes=total_bytes - self.start_bytes, total_bytes=self.total_bytes,
+             bytes_per_sec=round(self.rate or 0), eta=eta, transfers=active, **self.collection_fields())
+
+    def finish(self, message="", retry_json=None):
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+        elapsed = time.time() - self.start_time
+        transferred = bytes_transferred() - self.start_bytes
+        with self.lock:
+            emit("summary", completed=self.completed, errors=self.errors, retries=self.retries, total=self.total,
+                 bytes=transferred, seconds=round(elapsed, 1),
+                 bytes_per_sec=round(transferred / elapsed) if elapsed else 0, message=message,
+                 retry_json=retry_json, **self.collection_fields())
+
+    def collection_fields(self):
+        return {"collections": self.collections.snapshot()} if self.collections else {}
+
+def mod_fields(mod):
+    return {"mod_id": mod.mod_id, "file_id": mod.file_id} if mod else {}
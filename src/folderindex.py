@@ -0,0 +1,65 @@
+import os
+import threading
+from transfer import PART_SUFFIX, STATE_SUFFIX
+
+# In-memory index of the game's downloads folder, built with a single os.scandir pass at
+# startup. Workers ask it whether an archive is already there instead of each stat'ing the
+# folder, which on a network share or a big HDD folder with tens of thousands of archives
+# means thousands of slow, contending round trips. Workers update it as files finish.
+
+class FolderIndex:
+    def __init__(self, folder):
+        self.folder = os.path.normcase(os.path.abspath(folder))
+        self.lock = threading.Lock()
+        # normcase(name) -> (size, mtime) for finished archives
+        self.files = {}
+        # Leftovers seen by the scan: resumable .part files and zero-byte archives
+        self.partials = {}
+        self.empty = []
+
+    def scan(self):
+        files, partials, empty = {}, {}, []
+        try:
+            entries = os.scandir(self.folder)
+        except FileNotFoundError:
+            entries = None
+        if entries is not None:
+            with entries:
+                for entry in entries:
+                    if not entry.is_file():
+                        continue
+                    name = entry.name
+                    if name.endswith(STATE_SUFFIX):
+                        continue
+                    st = entry.stat()
+                    if name.endswith(PART_SUFFIX):
+                        partials[name[:-len(PART_SUFFIX)]] = st.st_size
+                    elif st.st_size == 0:
+                        # An interrupted download from before .part files; it gets fetched again
+                        empty.append(name)
+                    else:
+                        files[os.path.normcase(name)] = (st.st_size, st.st_mtime)
+        with self.lock:
+            self.files, self.partials, self.empty = files, partials, empty
+        return self
+
+    def size(self, name):
+        with self.lock:
+            found = self.files.get(os.path.normcase(name))
+        return found[0] if found else None
+
+    def add(self, name, size, mtime=None):
+        with self.lock:
+            self.files[os.path.normcase(name)] = (size, mtime)
+
+    def remove(self, name):
+        with self.lock:
+            self.files.pop(os.path.normcase(name), None)
+
+    def summary(self):
+        with self.lock:
+            archive_bytes = sum(size for size, _ in self.files.values())
+            partial_bytes = sum(self.partials.values())
+            return (f"Downloads folder: {len(self.files)} archives ({archive_bytes / (1024 ** 3):.2f} GB), "
+                    f"{len(self.partials)} partial downloads to resume ({partial_bytes / (1024 ** 2):.1f} MB), "
+                    f"{len(self.empty)} zero-byte leftovers to download again")
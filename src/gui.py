@@ -2,6 +2,8 @@ import subprocess
 import sys
 import os
 import json
+from config import get_config
+from engine import DownloadEngine
 from PySide6.QtWidgets import (
     QApplication, QWidget, QLabel, QVBoxLayout, QPushButton,
     QHBoxLayout, QLineEdit, QFileDialog, QProgressBar, QMenuBar,
@@ -10,67 +12,79 @@ from PySide6.QtWidgets import (
 )
 from PySide6.QtCore import QThread, Signal
 from PySide6.QtGui import QAction
-import re
 import time
+from datetime import timedelta
+
+# Longest closing the window waits for a cancelled run to save its partial downloads
+CLOSE_WAIT_MS = 5000
 
 class DownloadThread(QThread):
     progress_update = Signal(int, int)  # current, total
     error_update = Signal(int)          # error count
-    finished_signal = Signal(str)       # signal for completion, now passes exec time message
+    throughput_update = Signal(float, int)  # bytes/sec, ETA in seconds (-1 when unknown)
+    collections_update = Signal(str)    # per-collection progress of a batch, one line each
+    rejected = Signal(str)              # the collections cannot run with one downloads folder; nothing was started
+    failed = Signal(str)                # the run stopped on an error (unreadable collection, missing folder, ...)
+    finished_signal = Signal(str)       # emitted last, however the run ended; passes the exec time message
 
-    def __init__(self, json_path, gamefolder, max_threads=10, endorse_only=False):
+    def __init__(self, engine, json_paths, gamefolder, max_threads=10, endorse_only=False):
         super().__init__()
-        self.json_path = json_path
+        self.engine = engine
+        self.json_paths = json_paths
         self.gamefolder = gamefolder
         self.max_threads = max_threads
         self.endorse_only = endorse_only
         self.exec_time_message = ""
+        self.total = 0
+        self.current = 0
 
     def run(self):
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        loadcollection_path = os.path.join(script_dir, "loadcollection.py")
-        args = [
-            sys.executable, loadcollection_path,
-            "--json", self.json_path,
-            "--gamefolder", self.gamefolder,
-            "--maxthreads", str(self.max_threads)
-        ]
-        if self.endorse_only:
-            args.append("--endorseonly")
-        process = subprocess.Popen(
-            args,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            cwd=script_dir,
-            text=True
-        )
-        total = 0
-        current = 0
-        errors = 0
-        for line in process.stdout:
-            print(line, end="")
-            if line.startswith("PROGRESS:"):
-                parts = line.strip().split()
-                if len(parts) == 2:
-                    nums = parts[1].split("/")
-                    if len(nums) == 2:
-                        current, total = int(nums[0]), int(nums[1])
-                        self.progress_update.emit(current, total)
-            elif "Completed download for file" in line:
-                match = re.search(r'Completed download for file (\d+) of (\d+)', line)
-                if match:
-                    current = int(match.group(1))
-                    total = int(match.group(2))
-                    self.progress_update.emit(current, total)
-            elif "ERRORS:" in line:
-                match = re.search(r'ERRORS:\s*(\d+)', line)
-                if match:
-                    errors = int(match.group(1))
-                    self.error_update.emit(errors)
-            elif line.startswith("Total Execution Time for download:"):
-                self.exec_time_message = line.strip()
-        process.wait()
-        self.finished_signal.emit(self.exec_time_message)
+        # The collections are read here, once, off the UI thread. The downloads folder belongs to
+        # one game, so a batch has to be for one game as well.
+        try:
+            loaded = self.engine.load(self.json_paths)
+            domains = loaded[0].game_domains()
+            if len(domains) > 1:
+                self.rejected.emit(f"The selected collections are for {len(domains)} games ({', '.join(domains)}). "
+                                   "Select collections for one game at a time, or run loadcollection.py with "
+                                   "-f <game>=<folder> for each game.")
+                return
+            # The engine runs on this thread; its events arrive from its worker threads
+            self.engine.run(self.json_paths, self.gamefolder, self.max_threads,
+                            endorse_only=self.endorse_only, on_event=self.handle_event, loaded=loaded)
+        except Exception as e:
+            self.failed.emit(str(e) or type(e).__name__)
+        finally:
+            # Also after a rejection or an error, so the window leaves its running state
+            self.finished_signal.emit(self.exec_time_message)
+
+    def handle_event(self, event):
+        # Per-file events only update these; the UI is refreshed from the coalesced
+        # "progress" events (a few per second) so big collections do not flood the event loop
+        kind = event["event"]
+        if "collections" in event:
+            self.collections_update.emit("\n".join(
+                f"{c['name']}: {c['completed']} of {c['total']}" + (f", {c['errors']} failed" if c['errors'] else "")
+                for c in event["collections"]))
+        if kind == "start":
+            self.total = event["total"]
+            self.progress_update.emit(self.current, self.total)
+        elif kind == "complete":
+            self.current = event["completed"]
+        elif kind == "error":
+            self.error_update.emit(event["errors"])
+        elif kind == "progress":
+            self.current, self.total = event["completed"], event["total"]
+            self.progress_update.emit(self.current, self.total)
+            eta = event.get("eta")
+            self.throughput_update.emit(float(event.get("bytes_per_sec", 0)), -1 if eta is None else int(eta))
+        elif kind == "summary":
+            self.progress_update.emit(event["completed"], event["total"])
+            self.throughput_update.emit(float(event.get("bytes_per_sec", 0)), 0)
+            self.exec_time_message = event.get("message", "")
+            if event.get("retry_json"):
+                self.exec_time_message += (f"\n\n{event.get('errors', 0)} files could not be downloaded. "
+                                           f"To try only those again, select {event['retry_json']} as the collection.")
 
 class SettingsDialog(QDialog):
     def __init__(self, config_path, parent=None):
@@ -143,7 +157,7 @@ class MainWindow(QWidget):
 
         # File picker row
         file_picker_layout = QHBoxLayout()
-        self.file_label = QLabel("Collection JSON File:")
+        self.file_label = QLabel("Collection JSON File(s):")
         self.file_label.setFixedWidth(160)
         self.file_path_edit = QLineEdit()
         self.file_path_edit.setReadOnly(True)
@@ -181,11 +195,25 @@ class MainWindow(QWidget):
         self.threads_combo.addItem("🚗 Turbo Lane (20)", 20)
         self.threads_combo.addItem("🛸 Hyperspeed (25)", 25)
         self.threads_combo.addItem("⚡ Ludicrous Mode (30)", 30)
+        self.threads_combo.addItem("🤖 Auto (adapts to your connection)", "auto")
         self.threads_combo.setCurrentIndex(1)  # Default to 10 - Stroll Mode
         threads_layout.addWidget(self.threads_label)
         threads_layout.addWidget(self.threads_combo)
         layout.addLayout(threads_layout)
 
+        # Bandwidth cap, applied straight away, including to a download that is running
+        bandwidth_layout = QHBoxLayout()
+        self.bandwidth_label = QLabel("Bandwidth Limit:")
+        self.bandwidth_label.setFixedWidth(160)
+        self.bandwidth_combo = QComboBox()
+        self.bandwidth_combo.setMinimumWidth(250)
+        self.bandwidth_combo.addItem("Unlimited", 0)
+        for mbps in (1, 2, 5, 10, 20, 50, 100):
+            self.bandwidth_combo.addItem(f"{mbps} MB/s (small files first)", mbps)
+        bandwidth_layout.addWidget(self.bandwidth_label)
+        bandwidth_layout.addWidget(self.bandwidth_combo)
+        layout.addLayout(bandwidth_layout)
+
         # Progress bar
         self.progress_bar = QProgressBar()
         self.progress_bar.setMinimumWidth(400)
@@ -195,6 +223,15 @@ class MainWindow(QWidget):
         self.errors_label = QLabel("Current Errors: 0")
         layout.addWidget(self.errors_label)
 
+        # Throughput label
+        self.throughput_label = QLabel("Throughput: -")
+        layout.addWidget(self.throughput_label)
+
+        # Per-collection progress, shown when several collections run as one batch
+        self.collections_label = QLabel("")
+        self.collections_label.setVisible(False)
+        layout.addWidget(self.collections_label)
+
         # Status label
         self.status_label = QLabel("Ready.")
         layout.addWidget(self.status_label)
@@ -205,6 +242,18 @@ class MainWindow(QWidget):
         layout.addWidget(self.download_button)
         self.download_button.clicked.connect(self.start_download)  # <-- Add this line
 
+        # Pause / cancel for a running download
+        run_controls_layout = QHBoxLayout()
+        self.pause_button = QPushButton("Pause")
+        self.pause_button.setEnabled(False)
+        self.pause_button.clicked.connect(self.toggle_pause)
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.setEnabled(False)
+        self.cancel_button.clicked.connect(self.cancel_download)
+        run_controls_layout.addWidget(self.pause_button)
+        run_controls_layout.addWidget(self.cancel_button)
+        layout.addLayout(run_controls_layout)
+
         layout.addWidget(QLabel("Welcome to NexusDownloader!"))
 
         self.setLayout(layout)
@@ -212,6 +261,18 @@ class MainWindow(QWidget):
         # Path to config.json (assumes it's in the same folder as this script)
         self.config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json")
 
+        # Downloads and endorsements run in this process; config.json is handed to it once it exists
+        self.engine = DownloadEngine()
+        self.bandwidth_combo.currentIndexChanged.connect(self.change_bandwidth)
+        self.download_thread = None
+        self.cancelled = False
+        # The run was rejected or failed; its finished signal only leaves the running state
+        self.stopped = False
+        # The window closes once a run that outlasted CLOSE_WAIT_MS has ended
+        self.close_pending = False
+        # Collection files picked; several run as one batch
+        self.json_paths = []
+
         # Make file_path_edit respond to click/double-click
         self.file_path_edit.mousePressEvent = lambda event: self.pick_file()
         self.file_path_edit.mouseDoubleClickEvent = lambda event: self.pick_file()
@@ -244,22 +305,26 @@ class MainWindow(QWidget):
                 "Your Nexus API key is not set or invalid. Please configure the application before proceeding."
             )
             self.open_settings()
+        else:
+            self.engine.configure(get_config())
 
     def open_settings(self):
         dlg = SettingsDialog(self.config_path, self)
         if dlg.exec():
-            # Optionally reload config or update UI if needed
-            pass
+            # Applies to the engine straight away, including a download that is running
+            self.engine.configure(get_config())
 
     def pick_file(self):
-        file_path, _ = QFileDialog.getOpenFileName(
+        # Several files can be selected; they are downloaded together with shared workers
+        file_paths, _ = QFileDialog.getOpenFileNames(
             self,
-            "Select collection.json",
+            "Select collection.json (one or more)",
             "",
             "JSON Files (*.json);;All Files (*)"
         )
-        if file_path:
-            self.file_path_edit.setText(file_path)
+        if file_paths:
+            self.json_paths = file_paths
+            self.file_path_edit.setText("; ".join(file_paths))
 
     def pick_downloads_folder(self):
         # Use the value from the config as the initial directory if available
@@ -284,9 +349,9 @@ class MainWindow(QWidget):
             self.downloads_folder_edit.setText(folder_path)
 
     def start_download(self):
-        json_path = self.file_path_edit.text()
+        json_paths = self.json_paths
         gamefolder = self.downloads_folder_edit.text()
-        if not json_path or not gamefolder:
+        if not json_paths or not gamefolder:
             return  # Add error handling as needed
 
         # Get max threads value from combo box
@@ -335,12 +400,90 @@ class MainWindow(QWidget):
                 return
 
         # Start download as normal, passing max_threads
-        self.download_thread = DownloadThread(json_path, gamefolder, max_threads=max_threads)
+        self.download_thread = DownloadThread(self.engine, json_paths, gamefolder, max_threads=max_threads)
         self.download_thread.progress_update.connect(self.update_progress)
+        self.download_thread.collections_update.connect(self.update_collections)
+        self.collections_label.setVisible(len(json_paths) > 1)
+        self.collections_label.setText("")
         self.download_thread.error_update.connect(self.update_errors)
-        self.download_thread.finished_signal.connect(self.prompt_endorse)
+        self.download_thread.throughput_update.connect(self.update_throughput)
+        self.download_thread.finished_signal.connect(self.download_finished)
+        self.download_thread.rejected.connect(self.download_rejected)
+        self.download_thread.failed.connect(self.download_failed)
+        self.cancelled = False
+        self.stopped = False
+        self.set_running(True)
         self.download_thread.start()
 
+    def set_running(self, running):
+        self.download_button.setEnabled(not running)
+        self.pause_button.setEnabled(running)
+        self.cancel_button.setEnabled(running)
+        self.pause_button.setText("Pause")
+
+    def change_bandwidth(self, index):
+        mbps = self.bandwidth_combo.itemData(index)
+        self.engine.set_bandwidth_limit(mbps)
+        if self.engine.is_running():
+            self.status_label.setText(f"Bandwidth limit: {mbps} MB/s." if mbps else "Bandwidth limit removed.")
+
+    def toggle_pause(self):
+        if self.engine.is_paused():
+            self.engine.resume()
+            self.pause_button.setText("Pause")
+            self.status_label.setText("Resumed.")
+        else:
+            self.engine.pause()
+            self.pause_button.setText("Resume")
+            self.status_label.setText("Paused.")
+
+    def cancel_download(self):
+        self.cancelled = True
+        self.engine.cancel()
+        self.cancel_button.setEnabled(False)
+        self.pause_button.setEnabled(False)
+        self.status_label.setText("Cancelling, partial downloads are kept and resume next time...")
+
+    def download_rejected(self, message):
+        # finished_signal follows and leaves the running state
+        self.stopped = True
+        self.status_label.setText("Ready.")
+        QMessageBox.warning(self, "Several Games", message)
+
+    def download_failed(self, message):
+        self.stopped = True
+        self.status_label.setText("Stopped on an error.")
+        QMessageBox.warning(self, "Error", message)
+
+    def download_finished(self, exec_time_message):
+        self.set_running(False)
+        if self.stopped:
+            return
+        if self.cancelled:
+            self.status_label.setText("Download cancelled.")
+            return
+        self.prompt_endorse(exec_time_message)
+
+    def closeEvent(self, event):
+        # Stop transfers cleanly so their .part files can be resumed. The window waits up to
+        # CLOSE_WAIT_MS; a thread still going then (a connect timeout, a rate-limit backoff) keeps
+        # the window open and closes it when it ends, as destroying a running QThread aborts the app.
+        threads = [thread for thread in (self.download_thread, getattr(self, "endorse_thread", None))
+                   if thread and thread.isRunning()]
+        if threads:
+            self.cancelled = True
+            self.engine.cancel()
+            for thread in threads:
+                if not thread.wait(CLOSE_WAIT_MS):
+                    if not self.close_pending:
+                        self.close_pending = True
+                        thread.finished.connect(self.close)
+                    self.status_label.setText("Closing once the cancelled run has saved its partial downloads...")
+                    event.ignore()
+                    return
+        self.engine.close()
+        super().closeEvent(event)
+
     def prompt_endorse(self, exec_time_message):
         msg = "Downloads complete. Would you like to endorse all mods now?"
         if exec_time_message:
@@ -353,20 +496,34 @@ class MainWindow(QWidget):
         )
         if reply == QMessageBox.Yes:
             # Start endorse-only operation
-            json_path = self.file_path_edit.text()
             gamefolder = self.downloads_folder_edit.text()
             max_threads = self.threads_combo.currentData()  # Use the same threads value
-            self.endorse_thread = DownloadThread(json_path, gamefolder, max_threads=max_threads, endorse_only=True)
+            self.endorse_thread = DownloadThread(self.engine, self.json_paths, gamefolder, max_threads=max_threads, endorse_only=True)
             self.endorse_thread.progress_update.connect(self.update_progress)
             self.endorse_thread.error_update.connect(self.update_errors)
             self.endorse_thread.finished_signal.connect(self.thank_for_endorse)
+            self.endorse_thread.rejected.connect(self.download_rejected)
+            self.endorse_thread.failed.connect(self.download_failed)
+            self.cancelled = False
+            self.stopped = False
+            self.set_running(True)
             self.endorse_thread.start()
 
-    def thank_for_endorse(self, _):
+    def thank_for_endorse(self, summary_message):
+        # summary_message: the endorsed / skipped / too soon counts from the endorsement pass
+        self.set_running(False)
+        if self.stopped:
+            return
+        if self.cancelled:
+            self.status_label.setText("Endorsing cancelled.")
+            return
+        msg = "Thank you for endorsing the mods and supporting the mod authors!"
+        if summary_message:
+            msg = f"{summary_message}\n\n{msg}"
         QMessageBox.information(
             self,
             "Thank You!",
-            "Thank you for endorsing the mods and supporting the mod authors!"
+            msg
         )
 
     def update_progress(self, current, total):
@@ -374,9 +531,18 @@ class MainWindow(QWidget):
         self.progress_bar.setValue(current)
         self.status_label.setText(f"Downloading file {current} of {total}...")
 
+    def update_collections(self, text):
+        self.collections_label.setText(text)
+
     def update_errors(self, errors):
         self.errors_label.setText(f"Current Errors: {errors}")
 
+    def update_throughput(self, bytes_per_sec, eta):
+        text = f"Throughput: {bytes_per_sec / (1024 * 1024):.1f} MB/s"
+        if eta >= 0:
+            text += f", about {timedelta(seconds=eta)} left"
+        self.throughput_label.setText(text)
+
 if __name__ == "__main__":
     app = QApplication(sys.argv)
     window = MainWindow()
@@ -0,0 +1,154 @@
+import calendar
+import json
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlsplit, parse_qs
+from manifest import STATE_DIR
+
+# Cache of resolved download links keyed by (game, modId, fileId). download_link.json hands out
+# signed CDN URLs that stay valid for a while (the signature carries the expiry), so a retry, or
+# a rerun of an interrupted collection, can reuse them instead of spending another API call.
+# Lookups hit an in-memory dict first and then state/links.sqlite3; both tiers drop a link once
+# it is within EXPIRY_MARGIN of expiring, and a link the CDN refuses is evicted from both.
+
+LINKS_FILE = "links.sqlite3"
+# A cached link is only reused while it has at least this long left
+EXPIRY_MARGIN = 120
+# Links whose URL carries no recognisable expiry are kept in memory for this long (never on disk)
+UNKNOWN_EXPIRY_TTL = 300
+# CDN answers that mean the link itself is no good any more
+REJECTED_STATUSES = {401, 403, 404, 410}
+
+class LinkRejected(IOError):
+    # A reused link was refused by the CDN; the file is retried with a freshly resolved one
+    pass
+
+def default_links_path():
+    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return os.path.join(root_dir, STATE_DIR, LINKS_FILE)
+
+def link_expiry(url):
+    # Epoch seconds at which a signed URL stops working, or None when it does not say
+    query = {key.lower(): values[-1] for key, values in parse_qs(urlsplit(url).query).items()}
+    for name in ("expires", "exp", "e"):
+        try:
+            return float(query[name])
+        except (KeyError, ValueError):
+            pass
+    # AWS SigV4: X-Amz-Date (YYYYMMDDTHHMMSSZ) plus X-Amz-Expires seconds
+    if "x-amz-date" in query and "x-amz-expires" in query:
+        try:
+            signed = calendar.timegm(time.strptime(query["x-amz-date"], "%Y%m%dT%H%M%SZ"))
+            return signed + float(query["x-amz-expires"])
+        except ValueError:
+            pass
+    return None
+
+def links_expiry(links):
+    # The links expire together as far as the cache is concerned: at the earliest of them
+    expiries = [link_expiry(link['URI']) for link in links]
+    if not expiries or None in expiries:
+        return None
+    return min(expiries)
+
+class LinkCache:
+    def __init__(self, path=None, persistent=True):
+        self.lock = threading.Lock()
+        # (game, mod_id, file_id) -> {"links": [...], "expires": epoch, "reused": bool}
+        self.memory = {}
+        # URI -> key, for evicting by the URL the CDN refused
+        self.by_url = {}
+        self.hits = 0
+        self.misses = 0
+        self.connection = None
+        if persistent:
+            self.path = path or default_links_path()
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            with self.lock:
+                self.connection.execute("PRAGMA journal_mode=WAL")
+                self.connection.execute("PRAGMA synchronous=NORMAL")
+                self.connection.execute(
+                    "CREATE TABLE IF NOT EXISTS links ("
+                    "game TEXT NOT NULL, mod_id INTEGER NOT NULL, file_id INTEGER NOT NULL, "
+                    "links TEXT NOT NULL, expires REAL NOT NULL, "
+                    "PRIMARY KEY (game, mod_id, file_id))")
+                self.connection.execute("DELETE FROM links WHERE expires < ?", (time.time() + EXPIRY_MARGIN,))
+                self.connection.commit()
+
+    def _remember(self, key, entry):
+        # Called with the lock held
+        self.memory[key] = entry
+        for link in entry["links"]:
+            self.by_url[link['URI']] = key
+
+    def _forget(self, key):
+        # Called with the lock held
+        entry = self.memory.pop(key, None)
+        if entry:
+            for link in entry["links"]:
+                self.by_url.pop(link['URI'], None)
+        if self.connection:
+            self.connection.execute("DELETE FROM links WHERE game = ? AND mod_id = ? AND file_id = ?", key)
+            self.connection.commit()
+
+    def get(self, game_domain, mod_id, file_id):
+        # The cached download_link.json answer while it is still usable, else None
+        key = (game_domain, int(mod_id), int(file_id))
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is None and self.connection:
+                row = self.connection.execute(
+                    "SELECT links, expires FROM links WHERE game = ? AND mod_id = ? AND file_id = ?", key).fetchone()
+                if row:
+                    entry = {"links": json.loads(row[0]), "expires": row[1], "reused": False}
+                    self._remember(key, entry)
+            if entry is not None and entry["expires"] - EXPIRY_MARGIN <= now:
+                self._forget(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry["reused"] = True
+            return entry["links"]
+
+    def put(self, game_domain, mod_id, file_id, links):
+        if not links:
+            return
+        key = (game_domain, int(mod_id), int(file_id))
+        expires = links_expiry(links)
+        with self.lock:
+            if expires is None:
+                self._remember(key, {"links": links, "expires": time.time() + UNKNOWN_EXPIRY_TTL, "reused": False})
+                return
+            self._remember(key, {"links": links, "expires": expires, "reused": False})
+            if self.connection:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO links (game, mod_id, file_id, links, expires) VALUES (?, ?, ?, ?, ?)",
+                    (*key, json.dumps(links), expires))
+                self.connection.commit()
+
+    def reject(self, url):
+        # Evicts the entry the URL came from. True when that entry had been served from the
+        # cache, i.e. a fresh lookup may well succeed where this link failed.
+        with self.lock:
+            key = self.by_url.get(url)
+            if key is None:
+                return False
+            reused = self.memory[key]["reused"]
+            self._forget(key)
+            return reused
+
+    def stats_message(self):
+        with self.lock:
+            return f"Download link cache: {self.hits} lookups served from the cache, {self.misses} resolved through the API"
+
+    def close(self):
+        with self.lock:
+            if self.connection:
+                self.connection.close()
+                self.connection = None
@@ -1,17 +1,50 @@
-import json
 import argparse
+import asyncio
+import atexit
 import concurrent.futures
 import logging
-from endorse import endorse_mod  # Importing the endorse function from endorse.py
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from endorse import endorse_collection, unique_mods, EndorseReport, EndorsementCache, FAILED as ENDORSE_FAILED, CANCELLED as ENDORSE_CANCELLED  # Deduplicated, cached, paced endorsement pass
 from download import download_file  # Importing the download function from download.py
 from download import set_download_logger  # Importing the set_download_logger function from download.py
+from download import set_verify_existing  # --verify-existing
+from download import set_download_manifest, set_download_index, add_download_index, download_dir  # Run manifest and folder indexes for skipping finished files
+from download import set_download_store, record_manifest, downloads_root  # Content-addressed archive store shared by all game folders
+from store import ArchiveStore
+from download import set_download_links  # Reuse of still-valid signed download links
+from linkcache import LinkCache
+from manifest import STATUS_COMPLETE
+from folderindex import FolderIndex  # One-pass scan of the downloads folder
+from diskwriter import free_space  # Free-space preflight
+from events import ProgressReporter  # --events: JSON-lines progress for the GUI
+from manifest import RunManifest, split_satisfied  # Local SQLite record of resolved/finished files
 from endorse import set_endorse_logger  # Importing the endorse function from endorse.py
+from session import configure_session, connection_stats_message, check_api_budget  # Shared keep-alive HTTP session
+from ratelimit import GOVERNOR  # Process-wide Nexus API rate-limit governor
+from transfer import set_transfer_logger, set_transfer_slots, reset_transfer_control, transfers_cancelled, TransferCancelled  # Resumable, segmented transfers
+from asyncdownload import run_downloads, set_async_logger  # Event-loop engine for --engine async
+from pipeline import run_pipeline, set_pipeline_logger  # Two-stage engine for --engine pipeline
+from concurrency import AUTO, AUTO_MAX_THREADS, AdaptiveLimiter, ConcurrencyController, threads_arg, fixed_threads  # --maxthreads auto
+from collection import read_collection, write_failed_collection  # Single-pass streaming collection loader
+from retry import RetryPolicy, RetryQueue, BREAKER, set_retry_logger  # Backoff, retry budget and per-host circuit breaking
+from mirrors import MIRRORS  # Per-mirror throughput history for CDN mirror selection
+from metrics import METRICS  # Per-transfer timing written to logs/metrics_*.csv/.json
+from scheduler import ORDERS, order_mods, pin_first, dry_run_report, DEFAULT_BANDWIDTH_MBPS  # Size-aware queue ordering
+from bandwidth import BANDWIDTH, LANE_PINNED, LANE_SMALL, bandwidth_arg, lane_for  # Global bandwidth cap with priority lanes
+from revision import read_baseline, diff_revisions, check_unchanged, superseded_archives  # --update-from revision diff
+from batch import collection_paths, read_batch, group_by_domain, BatchProgress  # Several collections in one run
 import threading
 import time
 import os
 from datetime import datetime, timedelta
 
 
+# Upper bound for --engine async with --maxthreads auto
+ASYNC_AUTO_MAX_CONCURRENCY = 512
+# Longest the threaded engine sleeps while only backed-off retries are left (so a cancel is noticed)
+RETRY_POLL_INTERVAL = 0.5
+
 lock = threading.Lock()
 COUNTER = 0
 COMPLETED_COUNTER = 0
@@ -19,6 +52,16 @@ ERROR_COUNTER = 0
 LICENSE_KEY = ""
 NEXUS_API_KEY = ""
 GAME_DOMAIN = ""
+# --events: progress goes out as JSON lines (events.py) instead of the human-readable lines
+EVENTS = False
+PROGRESS = None
+# Files that failed for good in this run, as (mod, error message), and the retry policy deciding that
+FAILED = []
+RETRIES = None
+# Writes queued log records to the run's log file on a thread of its own
+LOG_LISTENER = None
+# Batch runs (several collection files): per-collection progress (batch.BatchProgress)
+BATCH = None
 
 # Custom VERBOSE log level
 VERBOSE_LEVEL_NUM = 15
@@ -28,29 +71,75 @@ def verbose(self, message, *args, **kws):
         self._log(VERBOSE_LEVEL_NUM, message, args, **kws)
 logging.Logger.verbose = verbose
 
-def setup_logger(game_domain):
+def logs_dir():
     # Ensure logs directory exists at project root
     root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    logs_dir = os.path.join(root_dir, "logs")
-    os.makedirs(logs_dir, exist_ok=True)
+    path = os.path.join(root_dir, "logs")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+class DeferredQueueHandler(QueueHandler):
+    # The stock QueueHandler formats every record on the calling thread so it could be pickled;
+    # this queue never leaves the process, so the record goes as it is and the message, the
+    # timestamp and the file write all happen on the listener thread
+    def prepare(self, record):
+        return record
+
+def stop_log_listener():
+    # Writes out whatever is still queued and closes the log file
+    global LOG_LISTENER
+    listener, LOG_LISTENER = LOG_LISTENER, None
+    if listener:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+atexit.register(stop_log_listener)
+
+def setup_logger(game_domain):
+    global LOG_LISTENER
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-    log_filename = os.path.join(logs_dir, f"log_{game_domain}_{timestamp}.log")
+    log_filename = os.path.join(logs_dir(), f"log_{game_domain}_{timestamp}.log")
     logger = logging.getLogger("nexusdownloader")
     logger.setLevel(VERBOSE_LEVEL_NUM)
+    # A GUI session runs several collections in one process; each gets its own log file
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    stop_log_listener()
+    # Workers only put records on a queue; none of them waits on the file
     fh = logging.FileHandler(log_filename, mode='a', encoding='utf-8')
     formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(threadName)s: %(message)s')
     fh.setFormatter(formatter)
-    logger.addHandler(fh)
-    # Ensure all threads flush after each log
-    # for handler in logger.handlers:
-    #     handler.flush = True
+    log_queue = SimpleQueue()
+    LOG_LISTENER = QueueListener(log_queue, fh)
+    LOG_LISTENER.start()
+    logger.addHandler(DeferredQueueHandler(log_queue))
 
     set_download_logger(logger)  # Set the logger for download.py
     set_endorse_logger(logger) # Set the logger for endorse.py
+    set_async_logger(logger) # Set the logger for asyncdownload.py
+    set_transfer_logger(logger) # Set the logger for transfer.py
+    set_pipeline_logger(logger) # Set the logger for pipeline.py
+    set_retry_logger(logger) # Set the logger for retry.py
     logger.verbose(f"Logger initialized for game domain: {game_domain}")    
     
     return logger
 
+# Counters and progress start from zero for every run in the same process (the GUI engine)
+def reset_run_state():
+    global COUNTER, COMPLETED_COUNTER, ERROR_COUNTER, PROGRESS, FAILED, RETRIES, BATCH
+    with lock:
+        COUNTER = COMPLETED_COUNTER = ERROR_COUNTER = 0
+        FAILED = []
+    PROGRESS = None
+    RETRIES = None
+    BATCH = None
+    reset_transfer_control()
+    BREAKER.reset()
+    MIRRORS.new_run()
+    METRICS.reset()
+
 def incrementCOUNTER_ThreadSafe():
     global COUNTER
     with lock:
@@ -67,107 +156,664 @@ def incrementERROR_COUNTER_ThreadSafe():
     global ERROR_COUNTER
     with lock:
         ERROR_COUNTER += 1
-        print(f"ERRORS: {ERROR_COUNTER}", flush=True)
+        if not EVENTS:
+            print(f"ERRORS: {ERROR_COUNTER}", flush=True)
     return ERROR_COUNTER
 
-# Function to load mods from a JSON file
-def load_mods_from_json(file_path, logger=None):
+# Reads the collection once, then sets up the log file for its game and logs what the loader
+# dropped. Returns (mods, logger); mods is empty if the file could not be read.
+def load_collection(file_path):
     global GAME_DOMAIN
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        GAME_DOMAIN = data["info"]["domainName"]
-        mods = []
-        for entry in data['mods']:
-            try:
-                mod_id = entry['source']['modId']
-                file_id = entry['source']['fileId']
-                mods.append((mod_id, file_id))
-            except KeyError as e:
-                if logger:
-                    logger.error(f"Skipping entry due to missing key: {e}")
+        collection = read_collection(file_path)
+    except Exception as e:
+        logger = setup_logger("unknown")
+        logger.error(f"Error loading mods from JSON: {e}")
+        return [], logger
+    GAME_DOMAIN = collection.game_domain
+    logger = setup_logger(GAME_DOMAIN if GAME_DOMAIN else "unknown")
+    for message in collection.skipped:
+        logger.error(message)
+    if collection.duplicates:
+        logger.verbose(f"Removed {collection.duplicates} duplicate mod files from the JSON file.")
+    logger.verbose(f"Loaded {len(collection.mods)} mods from the JSON file.")
+    return collection.mods, logger
+
+# Several collection files (or folders of them) as one deduplicated batch. Returns (batch, logger);
+# the batch has no files if none of them could be read.
+def load_collections(inputs):
+    global GAME_DOMAIN
+    try:
+        batch = read_batch(collection_paths(inputs))
+    except Exception as e:
+        logger = setup_logger("unknown")
+        logger.error(f"Error loading mods from JSON: {e}")
+        print(f"Error loading mods from JSON: {e}")
+        return read_batch([]), logger
+    domains = batch.game_domains()
+    GAME_DOMAIN = domains[0] if len(domains) == 1 else "batch"
+    logger = setup_logger(GAME_DOMAIN or "unknown")
+    for message in batch.skipped:
+        logger.error(message)
+    for part in batch.collections:
+        logger.verbose(f"Loaded {part.total} mods from {part.path} ({part.game_domain}).")
+    if len(batch.collections) > 1:
+        message = (f"Batch: {len(batch.collections)} collections for {len(domains)} games, "
+                   f"{len(batch.mods)} unique files ({batch.duplicates} listed more than once)")
+        print(message)
+        logger.verbose(message)
+    return batch, logger
+
+def begin_progress(mods, batch=None):
+    global PROGRESS
+    if batch:
+        batch.begin(mods)
+    if EVENTS:
+        PROGRESS = ProgressReporter(len(mods), sum(mod.size for mod in mods), collections=batch)
+        PROGRESS.begin()
+
+# Batch runs: counts a settled file for its collections and announces the ones it completes
+def settle_batch(mod, failed=False, logger=None):
+    if BATCH is None or mod is None:
+        return
+    for index in BATCH.settle(mod, failed):
+        message = BATCH.collection_message(index)
+        if not EVENTS:
+            print(message)
+        if logger:
+            logger.verbose(message)
+
+def report_completed(total, logger=None, mod=None):
+    completed = incrementCOMPLETED_COUNTER_ThreadSafe()
+    settle_batch(mod, logger=logger)
+    if PROGRESS:
+        PROGRESS.file_complete(mod)
+    else:
+        # This print statement is intentionally left as print for progress parsing
+        print(f"0000\tCompleted download for file {completed} of {total}")
+        print(f"PROGRESS: {completed}/{total}")
+    if logger:
+        logger.verbose("Completed download for file %d of %d", completed, total)
+
+def report_error(e, logger=None, mod=None):
+    if isinstance(e, TransferCancelled):
+        # Left as a resumable .part, not a failure
+        return
+    incrementERROR_COUNTER_ThreadSafe()
+    if mod is not None:
+        with lock:
+            FAILED.append((mod, str(e)))
+    settle_batch(mod, failed=True, logger=logger)
+    if PROGRESS:
+        PROGRESS.file_error(mod, e)
+
+    if logger:
+        logger.error(f"Error downloading file: {e}")
+
+# Decides whether a failed file goes back on the queue: returns the backoff in seconds, or
+# None when the error is final (or the file and run are out of retries) and it should be reported
+def make_requeue(total, logger=None):
+    global RETRIES
+    RETRIES = RetryPolicy(total)
+
+    def requeue(mod, e):
+        delay = RETRIES.next_delay(mod, e)
+        if delay is None:
+            return None
+        if PROGRESS:
+            PROGRESS.file_retry(mod, e)
+        if logger:
+            logger.warning(f"{e}. Re-queued mod {mod.mod_id}, file {mod.file_id} in {delay:.1f}s.")
+        return delay
+
+    return requeue
+
+def report_finished(overall_start, logger=None):
+    overall_end = time.time()
+    final_message = f"Total Execution Time for download: {timedelta(seconds=(overall_end - overall_start))}. Aren't you glad you decided to download using this instead of Vortex?"
+    retry_json = report_failures(logger)
+
+    if PROGRESS:
+        PROGRESS.finish(final_message, retry_json)
+    else:
+        print(final_message)
+    if logger:
+        logger.verbose(final_message)
+        if BATCH:
+            for message in BATCH.messages():
+                logger.verbose(message)
+        if RETRIES:
+            logger.verbose(RETRIES.budget_message())
+        logger.verbose(GOVERNOR.stats_message())
+        logger.verbose(GOVERNOR.budget_message())
+
+# Lists the files that failed for good and writes them out as a collection file, so rerunning
+# with --json <that file> tries exactly those again. Returns its path, or None if nothing failed.
+def report_failures(logger=None):
+    with lock:
+        failed = list(FAILED)
+    if not failed:
+        return None
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    retry_json = os.path.join(logs_dir(), f"failed_{GAME_DOMAIN or 'unknown'}_{timestamp}.json")
+    # Each entry keeps its own domainName, so a batch's failures from several games fit in one file
+    write_failed_collection(retry_json, failed[0][0].game_domain or GAME_DOMAIN, failed)
+    lines = [f"{len(failed)} files failed:"]
+    lines += [f"  mod {mod.mod_id}, file {mod.file_id}{f' ({mod.logical_filename})' if mod.logical_filename else ''}: {message}"
+              for mod, message in failed]
+    lines.append(f"To retry only these, run again with --json \"{retry_json}\"")
+    if not EVENTS:
+        print("\n".join(lines))
+    if logger:
+        for line in lines:
+            logger.error(line)
+    return retry_json
+
+# Per-transfer timing for the run: the stage summary goes to the log, the rows next to it
+def report_metrics(logger=None):
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    metrics_path = METRICS.write(os.path.join(logs_dir(), f"metrics_{GAME_DOMAIN or 'unknown'}_{timestamp}"))
+    if logger and metrics_path:
+        logger.verbose(METRICS.summary())
+        logger.verbose(f"Transfer timing written to {metrics_path} (and .json)")
+
+# Scans the downloads folder once; workers check the index instead of stat'ing the folder per file
+def index_downloads_folder(gamefolder, logger=None, label=""):
+    scan_start = time.time()
+    index = FolderIndex(download_dir(gamefolder)).scan()
+    add_download_index(index)
+    message = f"{label}{index.summary()} (scanned in {(time.time() - scan_start) * 1000:.0f} ms)"
+    print(message)
+    if logger:
+        logger.verbose(message)
+    return index
+
+# Works out locally which files earlier runs already finished, so they cost no API calls
+def skip_from_manifest(manifest, mods, game_domain, index, logger=None, label=""):
+    satisfied, remaining = split_satisfied(manifest, mods, game_domain, index)
+    satisfied_bytes = sum(mod.size for mod in satisfied)
+    total_bytes = satisfied_bytes + sum(mod.size for mod in remaining)
+    message = (f"{label}Run manifest: {len(satisfied)} of {len(mods)} files already downloaded "
+               f"({satisfied_bytes / (1024 ** 3):.2f} of {total_bytes / (1024 ** 3):.2f} GB), "
+               f"{len(remaining)} left to check with the API")
+    print(message)
+    if logger:
+        logger.verbose(message)
+    return remaining
+
+# --update-from: compares the new revision with the old one (a collection.json or the run
+# manifest) locally, prints the diff and lists superseded archives, and returns the added and
+# changed files, plus unchanged ones that are not in the downloads folder. Nothing here touches
+# the network.
+def plan_update(baseline_path, mods, gamefolder, logger=None):
+    old_mods, from_manifest = read_baseline(baseline_path, GAME_DOMAIN)
+    diff = diff_revisions(old_mods, mods, from_manifest)
+    manifest = RunManifest(baseline_path if from_manifest else None)
+    try:
+        entries = manifest.entries(GAME_DOMAIN)
+    finally:
+        manifest.close()
+    check_unchanged(diff, entries, FolderIndex(download_dir(gamefolder)).scan())
+    archives = superseded_archives(diff, entries, download_dir(gamefolder))
+    lines = [diff.message()]
+    changed = {(mod.mod_id, mod.file_id) for mod in diff.changed}
+    for mod, path in archives:
+        reason = "changed, moved to quarantine when the new file is checked" if (mod.mod_id, mod.file_id) in changed else "no longer in the collection"
+        lines.append(f"Superseded: mod {mod.mod_id}, file {mod.file_id} ({mod.size / (1024 ** 2):.1f} MB, {reason}): {path or 'archive not found'}")
+    # A changed file is usually downloaded again under the same name, so only dropped files are listed for deletion
+    dropped = [(mod, path) for mod, path in archives if path and (mod.mod_id, mod.file_id) not in changed]
+    on_disk = [path for mod, path in dropped]
+    if on_disk:
+        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+        list_path = os.path.join(logs_dir(), f"superseded_{GAME_DOMAIN or 'unknown'}_{timestamp}.txt")
+        with open(list_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(on_disk) + "\n")
+        lines.append(f"{len(on_disk)} superseded archives ({sum(mod.size for mod, path in dropped) / (1024 ** 3):.2f} GB) "
+                     f"listed in {list_path}; delete them once Vortex no longer needs them")
+    message = "\n".join(lines)
+    print(message)
+    if logger:
+        logger.verbose(message)
+    return diff.to_download()
+
+# Hardlinks archives the store already holds (same MD5 and size, from any game folder or
+# collection) into this game folder; those files need neither a link lookup nor a download
+def link_from_store(store, mods, gamefolder, logger=None):
+    folder = download_dir(gamefolder)
+    remaining = []
+    for mod in mods:
+        target = store.link_into(mod.md5, mod.size, folder) if mod.md5 and mod.size else None
+        if target:
+            record_manifest(mod.game_domain, mod.mod_id, mod.file_id, target, STATUS_COMPLETE, mod.md5, mod.size)
+        else:
+            remaining.append(mod)
+    linked = len(mods) - len(remaining)
+    if linked:
+        message = f"Archive store: linked {linked} files ({(sum(mod.size for mod in mods) - sum(mod.size for mod in remaining)) / (1024 ** 3):.2f} GB) from other game folders instead of downloading them"
+        print(message)
+        if logger:
+            logger.verbose(message)
+    return remaining
+
+# Drops store objects that no game folder links to any more
+def collect_store_garbage(store, logger=None):
+    try:
+        removed, freed = store.gc()
+    except OSError as e:
+        if logger:
+            logger.warning(f"Archive store cleanup failed: {e}")
+        return
+    if logger:
+        logger.verbose(store.summary())
+        if removed:
+            logger.verbose(f"Archive store: removed {removed} archives no game folder uses any more ({freed / (1024 ** 3):.2f} GB)")
+
+# Compares what is left to download with the free space on the target volume before anything starts
+def check_free_space(mods, folders, logger=None):
+    # Game folders normally share the downloads root's volume; the tightest one is what counts
+    if not folders:
+        return True
+    needed = sum(mod.size for mod in mods)
+    free = min(free_space(download_dir(gamefolder)) for gamefolder in set(folders.values()))
+    message = f"Disk space: {needed / (1024 ** 3):.2f} GB to download, {free / (1024 ** 3):.2f} GB free"
+    if needed > free:
+        message += " - NOT ENOUGH SPACE, free some space or pass --skip-space-check"
+    print(message)
+    if logger:
+        logger.verbose(message)
+    return needed <= free
+
+# --max-bandwidth / --pin: cap every transfer together and say which files go ahead of the rest.
+# max_bandwidth is MB/s, 0 for no cap, or None to keep the cap already set (the GUI sets it live).
+def apply_bandwidth(mods, max_bandwidth=None, pinned=(), logger=None):
+    if max_bandwidth is not None:
+        BANDWIDTH.set_rate(max_bandwidth * 1024 * 1024)
+    BANDWIDTH.assign(mods, pinned)
+    lanes = [lane_for(mod, pinned) for mod in mods]
+    pinned_count = lanes.count(LANE_PINNED)
+    if pinned and pinned_count == 0:
+        message = f"--pin {' '.join(str(mod_id) for mod_id in sorted(pinned))}: no file of these mods is left to download"
+        print(message)
         if logger:
-            logger.verbose(f"Loaded {len(mods)} mods from the JSON file.")
-        return mods
+            logger.verbose(message)
+    if not BANDWIDTH.capped():
+        return
+    message = (f"Bandwidth capped at {BANDWIDTH.rate / (1024 * 1024):.1f} MB/s: {pinned_count} pinned and "
+               f"{lanes.count(LANE_SMALL)} small files go ahead of {len(lanes) - pinned_count - lanes.count(LANE_SMALL)} large archives")
+    print(message)
+    if logger:
+        logger.verbose(message)
+
+def report_api_budget(needed_calls, logger=None):
+    try:
+        message = check_api_budget(needed_calls)
     except Exception as e:
         if logger:
-            logger.error(f"Error loading mods from JSON: {e}")
-        return []
+            logger.error(f"Could not check the Nexus API budget: {e}")
+        return
+    print(message)
+    if logger:
+        logger.verbose(message)
+
+# For --maxthreads auto: a limiter the workers run inside, steered by the controller thread
+def start_adaptive(logger=None, maximum=AUTO_MAX_THREADS):
+    limiter = AdaptiveLimiter(maximum=maximum)
+    controller = ConcurrencyController(limiter, logger)
+    controller.start()
+    if logger:
+        logger.verbose(f"Adaptive concurrency enabled, starting at {limiter.limit} (max {maximum}).")
+    return limiter, controller
+
+def stop_adaptive(controller, logger=None):
+    controller.stop()
+    if logger:
+        logger.verbose(f"Adaptive concurrency finished at {controller.limiter.limit}.")
 
 # Main function to execute concurrent downloads
-def main(mods, gamefolder, max_threads=10, logger=None):
+def main(mods, folders, max_threads=10, logger=None):
     overall_start = time.time()
     if logger:
         logger.verbose(f"Starting downloads for {len(mods)} mods with {max_threads} threads.")
+    begin_progress(mods, BATCH)
+    limiter = controller = None
+    pool_size = max_threads
+    if max_threads == AUTO:
+        # The pool is sized for the ceiling; the limiter decides how many actually run
+        limiter, controller = start_adaptive(logger)
+        pool_size = AUTO_MAX_THREADS
+    else:
+        # Idle slots are lent to segments of large files
+        set_transfer_slots(max_threads)
+    # One pooled session for every worker, sized to the thread count
+    configure_session(pool_size)
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=int(max_threads)) as executor:
-        futures = []
-        for mod_id, file_id in mods:
+    requeue = make_requeue(len(mods), logger)
+    # Failed files waiting out their backoff before they are submitted again
+    retries = RetryQueue()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=int(pool_size)) as executor:
+        futures = {}
+
+        def submit(mod):
             current_counter = incrementCOUNTER_ThreadSafe()
-            futures.append(executor.submit(download_file, GAME_DOMAIN, gamefolder, mod_id, file_id, current_counter))
-
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                future.result()
-                incrementCOMPLETED_COUNTER_ThreadSafe()
-                # This print statement is intentionally left as print for GUI progress parsing
-                print(f"0000\tCompleted download for file {COMPLETED_COUNTER} of {len(mods)}")
-                if logger:
-                    logger.verbose(f"Completed download for file {COMPLETED_COUNTER} of {len(mods)}")
-                
-                print(f"PROGRESS: {COMPLETED_COUNTER}/{len(mods)}")
-            except Exception as e:
-                incrementERROR_COUNTER_ThreadSafe()
-
-                if logger:
-                    logger.error(f"Error downloading file: {e}")
+            args = (download_file, mod.game_domain, folders[mod.game_domain], mod.mod_id, mod.file_id, current_counter, mod.md5)
+            futures[executor.submit(limiter.run, *args) if limiter else executor.submit(*args)] = mod
 
-    overall_end = time.time()
-    final_message = f"Total Execution Time for download: {timedelta(seconds=(overall_end - overall_start))}. Aren't you glad you decided to download using this instead of Vortex?"
+        for mod in mods:
+            submit(mod)
 
-    print(final_message)
+        # Failed files are re-submitted after their backoff, so the set of futures keeps changing
+        while futures or len(retries):
+            # After a cancel the waiting files go straight through and stop at their first checkpoint
+            for mod in retries.pop_due(flush=transfers_cancelled()):
+                submit(mod)
+            if not futures:
+                time.sleep(min(retries.next_wait() or 0, RETRY_POLL_INTERVAL))
+                continue
+            done, _ = concurrent.futures.wait(futures, timeout=retries.next_wait(),
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                mod = futures.pop(future)
+                try:
+                    future.result()
+                    report_completed(len(mods), logger, mod)
+                except Exception as e:
+                    delay = requeue(mod, e)
+                    if delay is None:
+                        report_error(e, logger, mod)
+                    else:
+                        retries.add(mod, delay)
+
+    if controller:
+        stop_adaptive(controller, logger)
+    report_finished(overall_start, logger)
+    print(connection_stats_message())
     if logger:
-        logger.verbose(final_message)
+        logger.verbose(connection_stats_message())
+
+# Same per-file semantics as main, but every transfer is a coroutine on a single event loop
+def main_async(mods, folders, max_concurrency=100, logger=None):
+    overall_start = time.time()
+    if logger:
+        logger.verbose(f"Starting async downloads for {len(mods)} mods with {max_concurrency} concurrent transfers.")
+    begin_progress(mods, BATCH)
+    limiter = controller = None
+    if max_concurrency == AUTO:
+        limiter, controller = start_adaptive(logger, maximum=ASYNC_AUTO_MAX_CONCURRENCY)
+        max_concurrency = ASYNC_AUTO_MAX_CONCURRENCY
+
+    asyncio.run(run_downloads(
+        mods, folders, max_concurrency,
+        on_complete=lambda mod: report_completed(len(mods), logger, mod),
+        on_error=lambda mod, e: report_error(e, logger, mod),
+        next_counter=incrementCOUNTER_ThreadSafe,
+        limiter=limiter,
+        requeue=make_requeue(len(mods), logger),
+    ))
+
+    if controller:
+        stop_adaptive(controller, logger)
+    report_finished(overall_start, logger)
+
+# Link resolution runs in its own small pool ahead of the transfer pool
+def main_pipeline(mods, folders, max_threads=10, resolve_threads=4, queue_depth=16, logger=None):
+    overall_start = time.time()
+    if logger:
+        logger.verbose(f"Starting pipelined downloads for {len(mods)} mods with {resolve_threads} resolver threads, "
+                       f"{max_threads} transfer threads and a ready queue of {queue_depth}.")
+    begin_progress(mods, BATCH)
+    limiter = controller = None
+    transfer_threads = max_threads
+    if max_threads == AUTO:
+        limiter, controller = start_adaptive(logger)
+        transfer_threads = AUTO_MAX_THREADS
+    else:
+        set_transfer_slots(max_threads)
+    configure_session(max(int(transfer_threads), int(resolve_threads)))
+
+    stats = run_pipeline(
+        mods, folders, resolve_threads, transfer_threads, queue_depth,
+        on_complete=lambda mod: report_completed(len(mods), logger, mod),
+        on_error=lambda mod, e: report_error(e, logger, mod),
+        next_counter=incrementCOUNTER_ThreadSafe,
+        limiter=limiter,
+        requeue=make_requeue(len(mods), logger),
+    )
+
+    if controller:
+        stop_adaptive(controller, logger)
+    report_finished(overall_start, logger)
+    print(stats.summary())
+    print(connection_stats_message())
+    if logger:
+        logger.verbose(stats.summary())
+        logger.verbose(connection_stats_message())
 
 def endorse_mods(mods, max_threads=10, logger=None):
     if logger:
-        logger.verbose(f"Starting endorsement for {len(mods)} mods with {max_threads} threads.")
-    with concurrent.futures.ThreadPoolExecutor(max_workers=int(max_threads)) as executor:
-        futures = []
-        for mod_id, file_id in mods:
-            futures.append(executor.submit(endorse_mod, GAME_DOMAIN, mod_id, file_id))
+        logger.verbose(f"Starting endorsement for {len(mods)} mod files with {max_threads} threads.")
+    configure_session(max_threads)
+    # One step per mod, not per file: that is what gets endorsed
+    begin_progress(unique_mods(mods))
+
+    def on_outcome(mod, outcome, error):
+        if outcome == ENDORSE_CANCELLED:
+            return
+        if outcome == ENDORSE_FAILED:
+            incrementERROR_COUNTER_ThreadSafe()
+            if PROGRESS:
+                PROGRESS.file_error(mod, error)
+        elif PROGRESS:
+            PROGRESS.file_complete(mod)
 
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                future.result()
-            except Exception as e:
-                if logger:
-                    logger.error(f"Error endorsing mod file: {e}")
+    # Endorsements are per game; a batch goes through its games one after the other, sharing
+    # the user's endorsement list (it covers every game)
+    report = EndorseReport()
+    cache = EndorsementCache()
+    for game_domain, game_mods in group_by_domain(mods).items():
+        report.merge(endorse_collection(game_domain, game_mods, max_threads, on_outcome, cache))
+    message = report.message()
+    if PROGRESS:
+        PROGRESS.finish(message)
+    else:
+        print(message)
     if logger:
-        logger.verbose("Finished endorsing all mods.")
+        logger.verbose(message)
+        logger.verbose(connection_stats_message())
+        logger.verbose(GOVERNOR.stats_message())
+    return report
+
+# Which folder each game's files go to: gamefolder is one folder (a run of a single game) or
+# {game domain: folder}. Raises ValueError when a game has no folder.
+def game_folders(domains, gamefolder):
+    if isinstance(gamefolder, dict):
+        missing = [domain for domain in domains if domain not in gamefolder]
+        if missing:
+            raise ValueError(f"No game folder given for {', '.join(missing)}; pass -f <game>=<folder> for each game")
+        return gamefolder
+    if len(domains) > 1:
+        raise ValueError(f"The collections are for {len(domains)} games ({', '.join(domains)}); "
+                         f"pass -f <game>=<folder> for each game instead of one folder")
+    return {domain: gamefolder for domain in domains}
+
+# -f values: one plain folder, or <game>=<folder> for each game of a batch
+def gamefolder_arg(values):
+    if len(values) == 1 and "=" not in values[0]:
+        return values[0]
+    folders = {}
+    for value in values:
+        domain, separator, folder = value.partition("=")
+        if not separator or not domain or not folder:
+            raise ValueError(f"-f {value}: with several game folders each must be <game>=<folder>")
+        folders[domain] = folder
+    return folders
+
+# Everything after loading the collection: skip what is already done, check the budget and
+# space, then run the chosen engine. Shared by the command line and the GUI's in-process engine.
+# gamefolder is one folder or {game domain: folder} (see game_folders); batch is the
+# batch.Batch the mods came from, for per-collection progress; max_bandwidth and pinned are
+# --max-bandwidth and --pin (see apply_bandwidth). Returns False when the run did not start.
+def run_collection(mods, gamefolder, max_threads=10, engine='threads', resolve_threads=4, queue_depth=16,
+                   order='largest', verify_existing=False, ignore_manifest=False, skip_space_check=False,
+                   endorse_only=False, use_store=True, batch=None, max_bandwidth=None, pinned=(), logger=None):
+    global BATCH
+    reset_run_state()
+    set_verify_existing(verify_existing)
+    if not mods:
+        # An empty collection, or an --update-from revision that changes nothing
+        message = "Nothing to download: no files left to fetch"
+        print(message)
+        if logger:
+            logger.verbose(message)
+        if EVENTS:
+            begin_progress([])
+            PROGRESS.finish(message)
+        return True
+    groups = group_by_domain(mods)
+    try:
+        folders = game_folders(list(groups), gamefolder)
+    except ValueError as e:
+        print(e)
+        if logger:
+            logger.error(str(e))
+        return False
+
+    manifest = None
+    if not endorse_only:
+        set_download_index(None)
+        if not ignore_manifest:
+            manifest = RunManifest()
+            set_download_manifest(manifest)
+        store = ArchiveStore(downloads_root()) if use_store else None
+        set_download_store(store)
+        remaining = []
+        for game_domain, game_mods in groups.items():
+            # Several games: every line says which folder it is about
+            label = f"{folders[game_domain]}: " if len(groups) > 1 else ""
+            index = index_downloads_folder(folders[game_domain], logger, label)
+            # --verify-existing wants every file on disk hashed, so it does not take the manifest's word for it
+            if manifest and not verify_existing:
+                game_mods = skip_from_manifest(manifest, game_mods, game_domain, index, logger, label)
+            if store:
+                game_mods = link_from_store(store, game_mods, folders[game_domain], logger)
+            remaining += game_mods
+        mods = remaining
+        if not check_free_space(mods, folders, logger) and not skip_space_check:
+            return False
+
+    # One link lookup per file, or at most one endorsement per mod (plus fetching the user's endorsement list)
+    report_api_budget(len(unique_mods(mods)) + 1 if endorse_only else len(mods), logger)
+
+    if endorse_only:
+        if logger:
+            logger.verbose("Endorsing mods only, no downloads will be performed.")
+        endorse_mods(mods, fixed_threads(max_threads), logger)
+        return True
+    # One scheduler for the whole batch: the order spans collections and games
+    mods = pin_first(order_mods(mods, order), pinned)
+    apply_bandwidth(mods, max_bandwidth, pinned, logger)
+    BATCH = BatchProgress(batch) if batch and len(batch.collections) > 1 else None
+    # --ignore-manifest runs (and the benchmark) keep links in memory only, for retries within the run
+    links = LinkCache(persistent=not ignore_manifest)
+    set_download_links(links)
+    try:
+        if engine == 'async':
+            main_async(mods, folders, max_threads, logger)
+        elif engine == 'pipeline':
+            main_pipeline(mods, folders, max_threads, resolve_threads, queue_depth, logger)
+        else:
+            main(mods, folders, max_threads, logger)
+    finally:
+        if manifest:
+            set_download_manifest(None)
+            manifest.close()
+        set_download_links(None)
+        links.close()
+        MIRRORS.save()
+        report_metrics(logger)
+        if store:
+            set_download_store(None)
+            collect_store_garbage(store, logger)
+        if logger:
+            logger.verbose(MIRRORS.summary())
+            logger.verbose(links.stats_message())
+            logger.verbose(BANDWIDTH.summary())
+    return True
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Parse JSON and download mods asynchronously")
-    parser.add_argument('-f', '--gamefolder', help="The folder name where the downloads will be saved. This needs to match Vortex", required=True, default='', type=str)
-    parser.add_argument('-j', '--json', help="Path to the JSON file containing mod data", required=True, default='', type=str)
-    parser.add_argument('-t', '--maxthreads', help="The total number of active download threads you want, it's 1:1 for files",
-                        required=False, default=10, type=int)
+    parser.add_argument('-f', '--gamefolder', action='append', required=True, type=str,
+                        help="The folder name where the downloads will be saved. This needs to match Vortex. "
+                             "When the collections are for several games, give it once per game as <game>=<folder>, e.g. -f skyrimspecialedition=skyrimse -f fallout4=fallout4")
+    parser.add_argument('-j', '--json', action='extend', nargs='+', required=True, type=str,
+                        help="Path to the JSON file containing mod data. Several files, or folders of .json files, are merged into one run with shared workers and per-collection progress")
+    parser.add_argument('-t', '--maxthreads', help="The total number of active download threads you want, it's 1:1 for files. "
+                                                    "'auto' measures throughput and errors while running and adjusts the number of active transfers",
+                        required=False, default=10, type=threads_arg)
+    parser.add_argument('--engine', choices=['threads', 'async', 'pipeline'], default='threads',
+                        help="'threads' runs one OS thread per file; 'async' runs all transfers on one event loop, where --maxthreads is the number of concurrent transfers and can be in the hundreds; "
+                             "'pipeline' resolves download links in a separate pool ahead of the --maxthreads transfer threads")
+    parser.add_argument('--resolvethreads', type=int, default=4,
+                        help="Number of link resolution threads for --engine pipeline")
+    parser.add_argument('--queuedepth', type=int, default=16,
+                        help="How many resolved links --engine pipeline keeps ready ahead of the transfer threads")
+    parser.add_argument('--order', choices=ORDERS, default='largest',
+                        help="Queue order: 'largest' starts the biggest archives first (balances the threads using the sizes in the collection), 'interleave' alternates large and small files, 'json' keeps the collection order")
+    parser.add_argument('--dryrun', action='store_true', default=False,
+                        help="Print the predicted total download time for each queue order and exit without downloading")
+    parser.add_argument('--bandwidth', type=float, default=DEFAULT_BANDWIDTH_MBPS,
+                        help="Link speed in MB/s assumed by --dryrun")
+    parser.add_argument('--max-bandwidth', type=bandwidth_arg, default=0.0, metavar='MBPS',
+                        help="Cap on the total download speed in MB/s, shared by every transfer so the rest of the link stays usable; 0 (the default) is no cap. "
+                             "Under a cap, pinned mods and small files get most of it and large archives download in the background")
+    parser.add_argument('--pin', action='extend', nargs='+', default=[], type=int, metavar='MODID',
+                        help="Mod IDs to download first: their files go to the front of the queue and, under --max-bandwidth, get the largest share of it")
+    parser.add_argument('--verify-existing', action='store_true', default=False,
+                        help="Check files that are already downloaded against the MD5 in the collection instead of trusting them; bad files are quarantined and downloaded again")
+    parser.add_argument('--ignore-manifest', action='store_true', default=False,
+                        help="Do not use the local run manifest to skip files that earlier runs finished; look every file up through the API")
+    parser.add_argument('--events', action='store_true', default=False,
+                        help="Write progress as JSON lines (start, progress, complete, retry, error, summary) for the GUI")
+    parser.add_argument('--skip-space-check', action='store_true', default=False,
+                        help="Start even if the collection looks bigger than the free space on the downloads drive")
+    parser.add_argument('--no-store', action='store_true', default=False,
+                        help="Do not use the shared archive store: no hardlinking of archives other game folders already have, and new downloads are not added to it")
+    parser.add_argument('--update-from', default='', type=str, metavar='OLD',
+                        help="Treat --json as a new revision of OLD (the previous collection.json, or state/manifest.sqlite3): only added or changed files are downloaded, and archives the new revision no longer uses are listed")
     parser.add_argument('-e', '--endorseonly', action='store_true', help="Endorse mods only without downloading them", default=False)
     args = parser.parse_args()
+    EVENTS = args.events
 
-    # Temporary logger for loading JSON to get game domain
-    temp_logger = logging.getLogger("temp")
-    mods = load_mods_from_json(args.json, temp_logger)
-    # Now setup logger with game domain
-    logger = setup_logger(GAME_DOMAIN if GAME_DOMAIN else "unknown")
-    # Reload mods with logger for proper error logging
-    mods = load_mods_from_json(args.json, logger)
+    try:
+        gamefolder = gamefolder_arg(args.gamefolder)
+    except ValueError as e:
+        parser.error(str(e))
+    batch, logger = load_collections(args.json)
+    mods = batch.mods
+    if args.update_from:
+        if len(batch.collections) != 1:
+            parser.error("--update-from compares one collection with its previous revision; pass a single --json")
+        try:
+            update_folder = game_folders([GAME_DOMAIN], gamefolder)[GAME_DOMAIN]
+        except ValueError as e:
+            parser.error(str(e))
+        try:
+            mods = plan_update(args.update_from, mods, update_folder, logger)
+        except Exception as e:
+            print(f"Could not read the previous revision {args.update_from}: {e}")
+            logger.error(f"Could not read the previous revision {args.update_from}: {e}")
+            exit(1)
 
-    if args.endorseonly:
-        logger.verbose("Endorsing mods only, no downloads will be performed.")
-        endorse_mods(mods, args.maxthreads, logger)
+    if args.dryrun:
+        # A cap below the assumed link speed is what the run will get
+        bandwidth = min(args.bandwidth, args.max_bandwidth) if args.max_bandwidth else args.bandwidth
+        report = dry_run_report(mods, fixed_threads(args.maxthreads), args.order, bandwidth)
+        print(report)
+        logger.verbose(report)
         exit(0)
-    else:
-        main(mods, args.gamefolder, args.maxthreads, logger)
 
-    exit(0)
\ No newline at end of file
+    # --update-from: a changed file may still be on disk under the same name; hashing it is what moves it aside
+    started = run_collection(
+        mods, gamefolder, args.maxthreads, args.engine, args.resolvethreads, args.queuedepth,
+        args.order, args.verify_existing or bool(args.update_from), args.ignore_manifest, args.skip_space_check, args.endorseonly, not args.no_store,
+        batch=batch, max_bandwidth=args.max_bandwidth, pinned=set(args.pin), logger=logger)
+    exit(0 if started else 1)
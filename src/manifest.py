@@ -0,0 +1,88 @@
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+
+# Local record of every file a run has resolved or downloaded, keyed by (game, modId, fileId).
+# The download link lookup is the only way to learn a file's name, so without this a rerun of
+# a collection that is almost entirely on disk still spends one API call per file just to find
+# out it can skip it. With the manifest the skip set is worked out locally before the run starts
+# and only missing or stale files go to the API.
+
+STATE_DIR = "state"
+MANIFEST_FILE = "manifest.sqlite3"
+
+# The link was resolved (the filename is known) but the transfer has not finished
+STATUS_RESOLVED = "resolved"
+# The file is in the downloads folder with the recorded size (and hash, when the collection has one)
+STATUS_COMPLETE = "complete"
+
+@dataclass
+class ManifestEntry:
+    filename: str
+    size: int
+    md5: str
+    status: str
+
+def default_manifest_path():
+    # Next to logs/ at the project root
+    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return os.path.join(root_dir, STATE_DIR, MANIFEST_FILE)
+
+class RunManifest:
+    def __init__(self, path=None):
+        self.path = path or default_manifest_path()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.lock = threading.Lock()
+        # One connection shared by every worker thread, serialised by the lock
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "game TEXT NOT NULL, mod_id INTEGER NOT NULL, file_id INTEGER NOT NULL, "
+                "filename TEXT NOT NULL, size INTEGER NOT NULL DEFAULT 0, md5 TEXT NOT NULL DEFAULT '', "
+                "status TEXT NOT NULL, updated REAL NOT NULL, "
+                "PRIMARY KEY (game, mod_id, file_id))")
+            self.connection.commit()
+
+    def entries(self, game_domain):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT mod_id, file_id, filename, size, md5, status FROM files WHERE game = ?", (game_domain,)).fetchall()
+        return {(mod_id, file_id): ManifestEntry(filename, size, md5, status) for mod_id, file_id, filename, size, md5, status in rows}
+
+    def record(self, game_domain, mod_id, file_id, filename, status, size=0, md5=""):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO files (game, mod_id, file_id, filename, size, md5, status, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (game_domain, int(mod_id), int(file_id), filename, int(size or 0), md5 or "", status, time.time()))
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+def is_satisfied(mod, entry, index):
+    # A completed entry still counts only if the downloads folder and the collection agree with it
+    if not entry or entry.status != STATUS_COMPLETE:
+        return False
+    if mod.size and entry.size and mod.size != entry.size:
+        return False
+    if mod.md5 and entry.md5 and mod.md5.lower() != entry.md5.lower():
+        return False
+    return index.size(entry.filename) == entry.size
+
+def split_satisfied(manifest, mods, game_domain, index):
+    # (mods already complete on disk, mods that still need the API), checked against a folderindex.FolderIndex
+    entries = manifest.entries(game_domain)
+    satisfied, remaining = [], []
+    for mod in mods:
+        if is_satisfied(mod, entries.get((int(mod.mod_id), int(mod.file_id))), index):
+            satisfied.append(mod)
+        else:
+            remaining.append(mod)
+    return satisfied, remaining
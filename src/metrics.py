@@ -0,0 +1,108 @@
+import csv
+import json
+import threading
+import time
+from dataclasses import dataclass, asdict, fields
+
+# Per-transfer timing, written next to the log at the end of a run (metrics_<game>_<time>.csv
+# and .json) so a slow run can be pinned on a stage: the link lookup (API latency), the wait
+# for a transfer slot (pipeline queue), the CDN's time to first byte, or the transfer itself.
+# Files are matched between the stages by their archive name, which the link lookup learns.
+
+@dataclass
+class TransferTiming:
+    mod_id: int
+    file_id: int
+    filename: str
+    # Request to response headers for the download link lookup (rate-limit pacing not included)
+    api_seconds: float = None
+    # Link resolved to transfer started: queueing behind busy slots (the pipeline's ready queue)
+    queue_seconds: float = None
+    # Transfer started to first byte received, on the first mirror tried
+    first_byte_seconds: float = None
+    # Transfer started to last byte on disk, failovers included
+    transfer_seconds: float = None
+    # Bytes moved in this run (a resumed file does not count what was already on disk)
+    bytes: int = 0
+    # bytes / transfer_seconds
+    mean_rate: float = None
+    mirror: str = ""
+    failovers: int = 0
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+class TransferMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # filename -> (TransferTiming, monotonic time the link was resolved)
+        self.pending = {}
+        self.rows = []
+
+    def reset(self):
+        with self.lock:
+            self.pending.clear()
+            self.rows = []
+
+    def resolved(self, filename, mod_id, file_id, api_seconds):
+        timing = TransferTiming(int(mod_id), int(file_id), filename, api_seconds=round(api_seconds, 4))
+        with self.lock:
+            self.pending[filename] = (timing, time.monotonic())
+
+    def transferred(self, filename, started, first_byte, finished, byte_count, mirror, failovers=0):
+        # started, first_byte and finished are time.monotonic() values; first_byte may be None
+        with self.lock:
+            timing, resolved_at = self.pending.pop(filename, (None, None))
+            if timing is None:
+                timing = TransferTiming(0, 0, filename)
+            if resolved_at is not None:
+                timing.queue_seconds = round(max(0.0, started - resolved_at), 4)
+            timing.first_byte_seconds = round(first_byte - started, 4) if first_byte is not None else None
+            timing.transfer_seconds = round(finished - started, 4)
+            timing.bytes = byte_count
+            timing.mean_rate = round(byte_count / (finished - started)) if finished > started else None
+            timing.mirror = mirror
+            timing.failovers = failovers
+            self.rows.append(timing)
+
+    def summary(self):
+        with self.lock:
+            rows = list(self.rows)
+        if not rows:
+            return "Transfer timing: no files transferred"
+
+        def stage(name, values):
+            values = [value for value in values if value is not None]
+            if not values:
+                return f"{name} n/a"
+            return f"{name} {percentile(values, 0.5):.2f}/{percentile(values, 0.95):.2f}s"
+
+        total_bytes = sum(row.bytes for row in rows)
+        total_seconds = sum(row.transfer_seconds for row in rows)
+        rate = total_bytes / total_seconds / (1024 * 1024) if total_seconds else 0.0
+        return (f"Transfer timing (p50/p95) over {len(rows)} files: "
+                f"{stage('API', (row.api_seconds for row in rows))}, "
+                f"{stage('queued', (row.queue_seconds for row in rows))}, "
+                f"{stage('first byte', (row.first_byte_seconds for row in rows))}, "
+                f"{stage('transfer', (row.transfer_seconds for row in rows))}; "
+                f"{rate:.2f} MB/s per transfer on average")
+
+    def write(self, base_path):
+        # Writes base_path.csv (one row per file) and base_path.json (the same rows and the
+        # summary line); returns the CSV path, or None when nothing was transferred
+        with self.lock:
+            rows = [asdict(row) for row in self.rows]
+        if not rows:
+            return None
+        with open(base_path + ".csv", 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=[field.name for field in fields(TransferTiming)])
+            writer.writeheader()
+            writer.writerows(rows)
+        with open(base_path + ".json", 'w', encoding='utf-8') as f:
+            json.dump({"summary": self.summary(), "transfers": rows}, f, indent=1)
+        return base_path + ".csv"
+
+METRICS = TransferMetrics()
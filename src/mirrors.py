@@ -0,0 +1,204 @@
+import json
+import os
+import threading
+import time
+from manifest import STATE_DIR
+from retry import host_of
+
+# CDN mirror selection. download_link.json lists every mirror the account may use, in Nexus's
+# order; the first is not necessarily the fastest from here. Throughput is remembered per mirror
+# host across runs (state/mirrors.json), mirrors without recent history get one short probe per
+# run, and each file goes to the best mirror first with the others as fallbacks. A transfer that
+# slows to a crawl moves to the next mirror and carries on from the byte it had reached.
+
+MIRRORS_FILE = "mirrors.json"
+# Weight of the newest sample in a mirror's smoothed throughput
+HISTORY_SMOOTHING = 0.3
+# History older than this is ignored; without a sample this recent a mirror is probed again
+HISTORY_MAX_AGE = 7 * 24 * 3600
+PROBE_INTERVAL = 6 * 3600
+# A probe reads this much of the first file offered by the mirror, or for this long at most
+PROBE_BYTES = 256 * 1024
+PROBE_SECONDS = 2.0
+PROBE_TIMEOUT = (5, 5)
+
+# A transfer is slow when it moves less than MIN_TRANSFER_RATE, or less than FAILOVER_RATIO of
+# what a remaining mirror is known to manage, over a SLOW_WINDOW; it then fails over to the next
+# mirror, unless it is on the last one or nearly done anyway
+MIN_TRANSFER_RATE = 64 * 1024
+FAILOVER_RATIO = 0.1
+SLOW_WINDOW = 10.0
+FAILOVER_MIN_REMAINING = 4 * 1024 * 1024
+
+class SlowMirror(IOError):
+    pass
+
+def default_mirrors_path():
+    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return os.path.join(root_dir, STATE_DIR, MIRRORS_FILE)
+
+class MirrorStats:
+    def __init__(self, path=None):
+        self.path = path or default_mirrors_path()
+        self.lock = threading.Lock()
+        # host -> {"bps": smoothed bytes/sec, "samples": count, "updated": epoch seconds}
+        self.hosts = None
+        # Hosts probed (or being probed) in this run
+        self.probed = set()
+
+    def _load(self):
+        # Called with the lock held
+        if self.hosts is not None:
+            return
+        self.hosts = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if isinstance(data, dict):
+            self.hosts = {host: entry for host, entry in data.items() if isinstance(entry, dict) and "bps" in entry}
+
+    def record(self, url, byte_count, seconds):
+        if seconds <= 0 or byte_count <= 0:
+            return
+        host = host_of(url)
+        rate = byte_count / seconds
+        with self.lock:
+            self._load()
+            entry = self.hosts.get(host)
+            if entry is None or time.time() - entry["updated"] > HISTORY_MAX_AGE:
+                self.hosts[host] = {"bps": rate, "samples": 1, "updated": time.time()}
+            else:
+                entry["bps"] = HISTORY_SMOOTHING * rate + (1 - HISTORY_SMOOTHING) * entry["bps"]
+                entry["samples"] += 1
+                entry["updated"] = time.time()
+
+    def record_watch(self, url, watch):
+        # A transfer attempt's throughput, unless the bandwidth cap held it back: then it says
+        # more about the cap than about the mirror
+        if not watch.throttled:
+            self.record(url, watch.count, watch.elapsed())
+
+    def estimate(self, url):
+        # Smoothed bytes/sec for the mirror, or None when there is no usable history
+        with self.lock:
+            self._load()
+            entry = self.hosts.get(host_of(url))
+        if entry is None or time.time() - entry["updated"] > HISTORY_MAX_AGE:
+            return None
+        return entry["bps"]
+
+    def claim_probe(self, url):
+        # True for the one caller that should probe this mirror in this run
+        host = host_of(url)
+        with self.lock:
+            self._load()
+            if host in self.probed:
+                return False
+            self.probed.add(host)
+            entry = self.hosts.get(host)
+            return entry is None or time.time() - entry["updated"] > PROBE_INTERVAL
+
+    def rank(self, links, avoid_hosts=()):
+        # The links' URIs, best first: mirrors with history by throughput, then the rest in
+        # Nexus's order, and hosts whose circuit is open last
+        avoid = set(avoid_hosts)
+
+        def key(item):
+            index, link = item
+            estimate = self.estimate(link['URI'])
+            return (host_of(link['URI']) in avoid, estimate is None, -(estimate or 0), index)
+
+        return [link['URI'] for _, link in sorted(enumerate(links), key=key)]
+
+    def failover_floor(self, fallback_urls):
+        # Rate below which a transfer should give up on its mirror for one of fallback_urls, or
+        # None when there is nowhere to go
+        if not fallback_urls:
+            return None
+        best = max((self.estimate(url) or 0 for url in fallback_urls), default=0)
+        return max(MIN_TRANSFER_RATE, FAILOVER_RATIO * best)
+
+    def new_run(self):
+        with self.lock:
+            self.probed.clear()
+
+    def save(self):
+        with self.lock:
+            if not self.hosts:
+                return
+            data = dict(self.hosts)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def summary(self):
+        with self.lock:
+            self._load()
+            ranked = sorted(self.hosts.items(), key=lambda item: -item[1]["bps"])
+        if not ranked:
+            return "Mirrors: no throughput history yet"
+        return "Mirrors: " + ", ".join(f"{host} {entry['bps'] / (1024 * 1024):.1f} MB/s" for host, entry in ranked)
+
+class RateWatch:
+    # Bytes moved by one transfer attempt on one mirror (shared by its segments). Flags the
+    # attempt as slow once a whole SLOW_WINDOW passes under the failover floor for the mirrors
+    # still left to try (probes may finish meanwhile, so it is worked out at every window); every
+    # loop feeding it then stops with SlowMirror, leaving the .part resumable from where it got to.
+    # A window in which the bandwidth cap held the transfer back is never judged slow.
+    def __init__(self, fallback_urls=()):
+        self.lock = threading.Lock()
+        self.fallback_urls = list(fallback_urls)
+        self.count = 0
+        self.started = time.monotonic()
+        self.first_byte = None
+        self.window_start = self.started
+        self.window_bytes = 0
+        self.window_held = False
+        self.throttled = False
+        self.slow = False
+
+    def responded(self):
+        # The response headers are in; time to first byte ends here
+        with self.lock:
+            if self.first_byte is None:
+                self.first_byte = time.monotonic()
+
+    def held(self):
+        # The bandwidth budget made the transfer wait
+        with self.lock:
+            self.window_held = True
+            self.throttled = True
+
+    def add(self, count, remaining=None):
+        now = time.monotonic()
+        with self.lock:
+            if self.first_byte is None:
+                self.first_byte = now
+            self.count += count
+            self.window_bytes += count
+            elapsed = now - self.window_start
+            if elapsed >= SLOW_WINDOW:
+                rate = self.window_bytes / elapsed
+                if not self.window_held and (remaining is None or remaining >= FAILOVER_MIN_REMAINING):
+                    floor = MIRRORS.failover_floor(self.fallback_urls)
+                    if floor is not None and rate < floor:
+                        self.slow = True
+                self.window_start = now
+                self.window_bytes = 0
+                self.window_held = False
+            slow = self.slow
+        if slow:
+            raise SlowMirror(f"Mirror too slow ({self.rate() / 1024:.0f} KB/s)")
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def rate(self):
+        elapsed = self.elapsed()
+        return self.count / elapsed if elapsed > 0 else 0.0
+
+MIRRORS = MirrorStats()
@@ -0,0 +1,163 @@
+import concurrent.futures
+import queue
+import threading
+import time
+from download import resolve_file, transfer_file, record_manifest
+from manifest import STATUS_COMPLETE
+from transfer import transfers_cancelled
+from retry import RetryQueue
+
+# Two-stage engine used by --engine pipeline. A small pool of resolvers calls
+# download_link.json ahead of time and fills a bounded queue of ready URLs; a separate
+# pool of transfer workers only ever moves bytes. The transfer slots never sit idle
+# through an API round trip, which dominates on collections full of tiny files.
+
+# Seconds between queue depth samples (and between the periodic depth log lines)
+SAMPLE_INTERVAL = 0.5
+LOG_INTERVAL = 10
+
+LOGGER = None
+
+def set_pipeline_logger(logger):
+    global LOGGER
+    LOGGER = logger
+
+class PipelineStats:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.samples = 0
+        self.depth_total = 0
+        self.depth_max = 0
+        self.empty_samples = 0
+        self.full_samples = 0
+        # Time resolvers spent blocked on a full queue (transfers are the bottleneck) and
+        # time transfer workers spent waiting on an empty one (the API is the bottleneck)
+        self.resolver_blocked = 0.0
+        self.transfer_starved = 0.0
+
+    def sample(self, depth):
+        with self.lock:
+            self.samples += 1
+            self.depth_total += depth
+            self.depth_max = max(self.depth_max, depth)
+            if depth == 0:
+                self.empty_samples += 1
+            elif depth >= self.capacity:
+                self.full_samples += 1
+
+    def add_blocked(self, seconds):
+        with self.lock:
+            self.resolver_blocked += seconds
+
+    def add_starved(self, seconds):
+        with self.lock:
+            self.transfer_starved += seconds
+
+    def summary(self):
+        with self.lock:
+            average = self.depth_total / self.samples if self.samples else 0.0
+            empty = 100.0 * self.empty_samples / self.samples if self.samples else 0.0
+            full = 100.0 * self.full_samples / self.samples if self.samples else 0.0
+            return (f"Pipeline queue depth avg {average:.1f} / max {self.depth_max} of {self.capacity} "
+                    f"(empty {empty:.0f}% of the time, full {full:.0f}%); "
+                    f"resolvers blocked {self.resolver_blocked:.1f}s, transfer workers starved {self.transfer_starved:.1f}s")
+
+def run_pipeline(mods, folders, resolve_threads, transfer_threads, queue_depth,
+                 on_complete, on_error, next_counter, limiter=None, requeue=None):
+    # folders maps each game domain in mods to its folder under the downloads root
+    ready = queue.Queue(maxsize=max(1, int(queue_depth)))
+    stats = PipelineStats(ready.maxsize)
+    finished = threading.Event()
+    all_done = threading.Event()
+    # Files not yet completed or failed for good; re-queued files stay counted
+    outstanding = [len(mods)]
+    outstanding_lock = threading.Lock()
+    resolvers = concurrent.futures.ThreadPoolExecutor(max_workers=int(resolve_threads), thread_name_prefix="Resolve")
+    # Failed files waiting out their backoff; the sampler hands them back to the resolvers
+    retries = RetryQueue()
+
+    def settle(callback, *args):
+        callback(*args)
+        with outstanding_lock:
+            outstanding[0] -= 1
+            if outstanding[0] == 0:
+                all_done.set()
+
+    def retry_or_fail(mod, e):
+        delay = requeue(mod, e) if requeue else None
+        if delay is None:
+            settle(on_error, mod, e)
+        else:
+            # Back through the resolver after the backoff, for a fresh link; a transfer resumes from its .part
+            retries.add(mod, delay)
+
+    def resolve(mod):
+        current_counter = next_counter()
+        download_start = time.time()
+        try:
+            resolved = resolve_file(mod.game_domain, folders[mod.game_domain], mod.mod_id, mod.file_id, current_counter, download_start, mod.md5)
+        except Exception as e:
+            retry_or_fail(mod, e)
+            return
+        if not resolved:
+            # Nothing to transfer (already on disk, or no link): done at the first stage
+            settle(on_complete, mod)
+            return
+        urls, file_path = resolved
+        put_start = time.time()
+        ready.put((mod, urls, file_path, current_counter, download_start))
+        stats.add_blocked(time.time() - put_start)
+
+    def transfer_worker():
+        while True:
+            get_start = time.time()
+            item = ready.get()
+            if item is None:
+                return
+            stats.add_starved(time.time() - get_start)
+            mod, urls, file_path, current_counter, download_start = item
+            try:
+                if limiter:
+                    # --maxthreads auto: the limiter decides how many of the workers may transfer at once
+                    limiter.run(transfer_file, urls, file_path, current_counter, download_start, mod.md5)
+                else:
+                    transfer_file(urls, file_path, current_counter, download_start, mod.md5)
+            except Exception as e:
+                retry_or_fail(mod, e)
+            else:
+                record_manifest(mod.game_domain, mod.mod_id, mod.file_id, file_path, STATUS_COMPLETE, mod.md5)
+                settle(on_complete, mod)
+
+    def sampler():
+        last_log = time.time()
+        while not finished.wait(SAMPLE_INTERVAL):
+            depth = ready.qsize()
+            stats.sample(depth)
+            # After a cancel the waiting files go through at once and stop at the resolver's checkpoint
+            for mod in retries.pop_due(flush=transfers_cancelled()):
+                resolvers.submit(resolve, mod)
+            if LOGGER and time.time() - last_log >= LOG_INTERVAL:
+                LOGGER.verbose(f"Pipeline queue depth {depth}/{ready.maxsize}")
+                last_log = time.time()
+
+    workers = [threading.Thread(target=transfer_worker, name=f"Transfer-{i}", daemon=True) for i in range(int(transfer_threads))]
+    for worker in workers:
+        worker.start()
+    sampler_thread = threading.Thread(target=sampler, name="PipelineSampler", daemon=True)
+    sampler_thread.start()
+
+    for mod in mods:
+        resolvers.submit(resolve, mod)
+    if mods:
+        all_done.wait()
+    resolvers.shutdown(wait=True)
+
+    # Every file is settled; one sentinel per transfer worker drains the stage
+    for _ in workers:
+        ready.put(None)
+    for worker in workers:
+        worker.join()
+    finished.set()
+    sampler_thread.join()
+    return stats
@@ -0,0 +1,170 @@
+import threading
+import time
+from datetime import datetime
+
+# Process-wide governor for Nexus API calls (download_link.json, endorse.json, ...). Every
+# API response carries the remaining hourly/daily quota and when each window resets; the
+# governor reads them and paces calls with a token bucket: full speed while quota is
+# plentiful, spreading what is left over the rest of the window once it runs low, and
+# backing off on 429 instead of letting a burst of failures sink the run.
+#
+# Nexus allows a daily quota; once it is used up, a smaller hourly quota applies until the
+# daily window resets. The daily window is therefore the binding one while more than RESERVE
+# calls of it are left.
+
+# Ceiling on API calls per second when quota is not a concern, and the burst allowed above it
+MAX_RATE = 25.0
+BURST = 25
+# Below this many remaining calls in the binding window, pace the rest until its reset
+LOW_WATER = 200
+# Calls kept in reserve so the user can still use the site/mod manager after a run
+RESERVE = 20
+# Backoff after a 429 without a usable Retry-After or reset header
+BASE_BACKOFF = 2.0
+MAX_BACKOFF = 300.0
+
+class TransferCancelled(Exception):
+    # The run was cancelled. Defined here, below transfer.py, so a governor wait can end with it.
+    pass
+
+def parse_reset(value):
+    # Nexus sends ISO 8601 timestamps ("2024-05-01T12:00:00+00:00"); accept epoch seconds too
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
+
+def parse_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+class RateLimitGovernor:
+    def __init__(self, max_rate=MAX_RATE, burst=BURST):
+        self.lock = threading.Lock()
+        self.max_rate = max_rate
+        self.burst = burst
+        self.rate = max_rate
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self.backoff_until = 0.0
+        self.consecutive_429 = 0
+        self.hourly_limit = self.hourly_remaining = self.hourly_reset = None
+        self.daily_limit = self.daily_remaining = self.daily_reset = None
+        self.calls = 0
+        self.throttled = 0
+        # Set by transfer.cancel_transfers: a wait for the quota (up to its reset) ends at once
+        self.cancelled = threading.Event()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def reserve(self):
+        # Claims the next call slot and returns how long the caller must wait before using it.
+        # Non-blocking so the event-loop engine can await the delay instead of sleeping.
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            self.calls += 1
+            delay = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+            delay = max(delay, self.backoff_until - now)
+            if delay > 0:
+                self.throttled += 1
+            return delay
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0 and self.cancelled.wait(delay):
+            raise TransferCancelled("Download cancelled")
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def reset_cancel(self):
+        self.cancelled.clear()
+
+    def binding_window(self):
+        # (remaining, reset timestamp) for the quota currently being spent
+        if self.daily_remaining is not None and self.daily_remaining > RESERVE:
+            return self.daily_remaining, self.daily_reset
+        if self.hourly_remaining is not None:
+            return self.hourly_remaining, self.hourly_reset
+        return self.daily_remaining, self.daily_reset
+
+    def update(self, status_code, headers):
+        with self.lock:
+            for window in ("hourly", "daily"):
+                limit = parse_int(headers.get(f"X-RL-{window.capitalize()}-Limit"))
+                remaining = parse_int(headers.get(f"X-RL-{window.capitalize()}-Remaining"))
+                reset = parse_reset(headers.get(f"X-RL-{window.capitalize()}-Reset"))
+                if limit is not None:
+                    setattr(self, f"{window}_limit", limit)
+                if remaining is not None:
+                    setattr(self, f"{window}_remaining", remaining)
+                if reset is not None:
+                    setattr(self, f"{window}_reset", reset)
+
+            remaining, reset = self.binding_window()
+            seconds_to_reset = max(1.0, reset - time.time()) if reset else None
+            now = time.monotonic()
+            self._refill(now)
+
+            if status_code == 429:
+                self.consecutive_429 += 1
+                retry_after = parse_int(headers.get("Retry-After"))
+                if retry_after is not None:
+                    wait = retry_after
+                elif remaining == 0 and seconds_to_reset:
+                    wait = seconds_to_reset
+                else:
+                    wait = BASE_BACKOFF * (2 ** (self.consecutive_429 - 1))
+                self.backoff_until = max(self.backoff_until, now + min(MAX_BACKOFF, wait))
+                return
+            self.consecutive_429 = 0
+
+            if remaining is None or seconds_to_reset is None:
+                self.rate = self.max_rate
+            elif remaining <= RESERVE:
+                # Out of budget for this window: wait for the reset
+                self.rate = self.max_rate
+                self.backoff_until = max(self.backoff_until, now + seconds_to_reset)
+            elif remaining < LOW_WATER:
+                self.rate = min(self.max_rate, max(0.01, (remaining - RESERVE) / seconds_to_reset))
+            else:
+                self.rate = self.max_rate
+
+    def budget_message(self, needed_calls=None):
+        with self.lock:
+            parts = []
+            for window in ("daily", "hourly"):
+                remaining = getattr(self, f"{window}_remaining")
+                limit = getattr(self, f"{window}_limit")
+                reset = getattr(self, f"{window}_reset")
+                if remaining is None:
+                    continue
+                reset_text = datetime.fromtimestamp(reset).strftime("%Y-%m-%d %H:%M:%S") if reset else "unknown"
+                parts.append(f"{window} {remaining}/{limit} (resets {reset_text})")
+            if not parts:
+                return "Nexus API budget unknown (no rate-limit headers received)"
+            message = "Nexus API budget remaining: " + ", ".join(parts)
+            if needed_calls is not None:
+                available = (self.daily_remaining or 0) + (self.hourly_remaining or 0)
+                message += f". This run needs about {needed_calls} calls"
+                if needed_calls > available:
+                    message += " - MORE THAN REMAINS, the run will pause until the quota resets"
+            return message
+
+    def stats_message(self):
+        with self.lock:
+            return f"API calls: {self.calls}, paced by the rate-limit governor: {self.throttled}"
+
+GOVERNOR = RateLimitGovernor()
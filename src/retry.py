@@ -0,0 +1,259 @@
+import asyncio
+import errno
+import heapq
+import http.client
+import itertools
+import math
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+import aiohttp
+import requests
+import urllib3
+from checksum import ChecksumMismatch, MAX_VERIFY_RETRIES
+
+# Retry handling shared by every engine. A file that fails is classified first: a 404 or a
+# full disk will fail the same way again, while a 5xx, a timeout or a dropped connection
+# usually does not. Retryable failures go back on the queue after a jittered exponential
+# backoff (a resumed transfer continues from its .part), within a per-file limit and a
+# run-wide retry budget so a dead network cannot multiply the run time. A per-host circuit
+# breaker stops sending transfers to a CDN edge that keeps failing until it has cooled down.
+
+# Retries per file for retryable errors (MD5 mismatches have their own MAX_VERIFY_RETRIES)
+MAX_RETRIES = 3
+# Backoff before retry n is RETRY_BASE_DELAY * 2 ** (n - 1), capped, with up to half of it jittered
+RETRY_BASE_DELAY = 2.0
+RETRY_MAX_DELAY = 60.0
+# Retries allowed across the whole run: this share of the files, but at least MIN_RETRY_BUDGET
+RETRY_BUDGET_RATIO = 0.1
+MIN_RETRY_BUDGET = 10
+
+# Consecutive failures that open a host's circuit, and how long it stays open (doubling
+# after every failed probe, up to the maximum)
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30.0
+BREAKER_MAX_COOLDOWN = 300.0
+# While one probe transfer tests a half-open host, other transfers for it wait this long
+BREAKER_PROBE_WAIT = 5.0
+# Times one file may be put back because its host's circuit was open; these waits make no
+# request, so they count neither as retries nor against the budget while any budget is left
+MAX_CIRCUIT_WAITS = 5
+
+# HTTP statuses worth another attempt; every other 4xx is final
+RETRYABLE_STATUSES = {408, 425, 429}
+# Socket-level errno values that mean the network failed, not the local disk
+NETWORK_ERRNOS = {errno.ECONNRESET, errno.ECONNABORTED, errno.ECONNREFUSED, errno.ETIMEDOUT,
+                  errno.EPIPE, errno.ENETUNREACH, errno.EHOSTUNREACH, errno.ENETDOWN}
+
+LOGGER = None
+
+def set_retry_logger(logger):
+    global LOGGER
+    LOGGER = logger
+
+class CircuitOpen(IOError):
+    def __init__(self, host, retry_in):
+        super().__init__(f"Circuit open for {host}, not retrying it for {retry_in:.0f}s")
+        self.host = host
+        self.retry_in = retry_in
+
+def error_status(error):
+    # HTTP status carried by an error from either HTTP stack, or None
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status
+    return None
+
+def is_retryable(error):
+    if isinstance(error, (ChecksumMismatch, CircuitOpen)):
+        return True
+    status = error_status(error)
+    if status is not None:
+        return status >= 500 or status in RETRYABLE_STATUSES
+    if isinstance(error, (requests.Timeout, requests.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                          requests.exceptions.ContentDecodingError, requests.exceptions.JSONDecodeError)):
+        return True
+    # Transfers read response.raw directly, so a dropped connection arrives as urllib3's own error
+    if isinstance(error, (urllib3.exceptions.ProtocolError, urllib3.exceptions.TimeoutError,
+                          urllib3.exceptions.NewConnectionError, http.client.IncompleteRead)):
+        return True
+    if isinstance(error, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError)):
+        return True
+    if isinstance(error, requests.RequestException):
+        # Invalid URL, missing schema, too many redirects: nothing a retry would change
+        return False
+    if isinstance(error, OSError):
+        # The transfer's own "ended early" errors carry no errno; a local disk error (full,
+        # read-only, missing folder) does and is final
+        return error.errno is None or error.errno in NETWORK_ERRNOS
+    return False
+
+def breaker_failure(error):
+    # Whether an error says something about the host itself (counts towards its circuit)
+    status = error_status(error)
+    if status is not None:
+        return status >= 500
+    return is_retryable(error) and not isinstance(error, (ChecksumMismatch, CircuitOpen))
+
+def backoff_delay(attempt):
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+class RetryPolicy:
+    # Decides whether (and after how long) a failed file is tried again
+    def __init__(self, total, max_retries=MAX_RETRIES, budget=None):
+        self.lock = threading.Lock()
+        self.max_retries = max_retries
+        self.budget = budget if budget is not None else max(MIN_RETRY_BUDGET, math.ceil(total * RETRY_BUDGET_RATIO))
+        self.used = 0
+        self.attempts = {}
+        self.verify_attempts = {}
+        self.circuit_waits = {}
+
+    def next_delay(self, mod, error):
+        # Seconds to wait before the next attempt, or None when the file has failed for good
+        if not is_retryable(error):
+            return None
+        key = (mod.mod_id, mod.file_id)
+        with self.lock:
+            if isinstance(error, ChecksumMismatch):
+                attempts = self.verify_attempts.get(key, 0) + 1
+                if attempts > MAX_VERIFY_RETRIES or self.used >= self.budget:
+                    return None
+                self.verify_attempts[key] = attempts
+                self.used += 1
+                # A fresh link straight away; nothing suggests the host is struggling
+                return 0.0
+            if isinstance(error, CircuitOpen):
+                waits = self.circuit_waits.get(key, 0) + 1
+                if waits > MAX_CIRCUIT_WAITS or self.used >= self.budget:
+                    return None
+                self.circuit_waits[key] = waits
+                # Spread the waiting files over a little time so they do not all hit the probe together
+                return error.retry_in + random.uniform(0, RETRY_BASE_DELAY)
+            attempts = self.attempts.get(key, 0) + 1
+            if attempts > self.max_retries or self.used >= self.budget:
+                return None
+            self.attempts[key] = attempts
+            self.used += 1
+        return backoff_delay(attempts)
+
+    def budget_message(self):
+        with self.lock:
+            return f"Retries used: {self.used} of a budget of {self.budget}"
+
+class RetryQueue:
+    # Files waiting out their backoff, for the threaded engines to pick up when due
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heap = []
+        self.order = itertools.count()
+
+    def add(self, mod, delay):
+        with self.lock:
+            heapq.heappush(self.heap, (time.monotonic() + delay, next(self.order), mod))
+
+    def pop_due(self, flush=False):
+        # Files whose backoff has passed (every waiting file with flush, e.g. after a cancel)
+        now = time.monotonic()
+        due = []
+        with self.lock:
+            while self.heap and (flush or self.heap[0][0] <= now):
+                due.append(heapq.heappop(self.heap)[2])
+        return due
+
+    def next_wait(self):
+        with self.lock:
+            return max(0.0, self.heap[0][0] - time.monotonic()) if self.heap else None
+
+    def __len__(self):
+        with self.lock:
+            return len(self.heap)
+
+def host_of(url):
+    return urlsplit(url).netloc.lower()
+
+class CircuitBreaker:
+    # Per host: closed (normal) -> open after BREAKER_THRESHOLD failures in a row -> half-open
+    # once the cooldown passes, when a single probe transfer decides between closed and open
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.lock = threading.Lock()
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.hosts = {}
+
+    def reset(self):
+        with self.lock:
+            self.hosts.clear()
+
+    def _host(self, host):
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = {"failures": 0, "open_until": 0.0, "cooldown": self.cooldown, "probing": False}
+        return state
+
+    def check(self, url):
+        # Raises CircuitOpen instead of letting a transfer start against a failing host
+        host = host_of(url)
+        now = time.monotonic()
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None or state["failures"] < self.threshold:
+                return
+            if now < state["open_until"]:
+                raise CircuitOpen(host, state["open_until"] - now)
+            if state["probing"]:
+                raise CircuitOpen(host, BREAKER_PROBE_WAIT)
+            state["probing"] = True
+        if LOGGER:
+            LOGGER.verbose(f"Circuit for {host} half-open, probing with one transfer")
+
+    def success(self, url):
+        host = host_of(url)
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None:
+                return
+            reopened = state["failures"] >= self.threshold
+            state.update(failures=0, open_until=0.0, cooldown=self.cooldown, probing=False)
+        if reopened and LOGGER:
+            LOGGER.verbose(f"Circuit for {host} closed again")
+
+    def failure(self, url, error):
+        if not breaker_failure(error):
+            self.release(url)
+            return
+        host = host_of(url)
+        with self.lock:
+            state = self._host(host)
+            probe_failed = state["probing"]
+            state["failures"] += 1
+            state["probing"] = False
+            if probe_failed:
+                state["cooldown"] = min(BREAKER_MAX_COOLDOWN, state["cooldown"] * 2)
+            if state["failures"] < self.threshold:
+                return
+            if state["open_until"] > time.monotonic() and not probe_failed:
+                # Already open; transfers that were in flight when it opened do not extend it
+                return
+            state["open_until"] = time.monotonic() + state["cooldown"]
+            cooldown = state["cooldown"]
+        if LOGGER:
+            LOGGER.warning(f"Circuit for {host} open for {cooldown:.0f}s after repeated failures: {error}")
+
+    def release(self, url):
+        # A probe that ended without telling anything about the host (cancelled, bad MD5)
+        with self.lock:
+            state = self.hosts.get(host_of(url))
+            if state:
+                state["probing"] = False
+
+    def open_hosts(self):
+        now = time.monotonic()
+        with self.lock:
+            return [host for host, state in self.hosts.items()
+                    if state["failures"] >= self.threshold and state["open_until"] > now]
+
+BREAKER = CircuitBreaker()
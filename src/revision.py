@@ -0,0 +1,115 @@
+import os
+from dataclasses import dataclass, field
+from collection import ModFile, read_collection
+from manifest import RunManifest, STATUS_COMPLETE, is_satisfied
+
+# --update-from: a new revision of a collection compared with the one already downloaded, by
+# (modId, fileId) and by hash, entirely from local files. Only added and changed files go on to
+# the run; files the old revision had and the new one dropped (usually the previous file of a
+# mod that was updated) are listed as superseded so their archives can be cleaned up. An
+# unchanged file is only skipped when the manifest and the downloads folder show it is there: the
+# old revision may never have finished downloading.
+
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+@dataclass
+class RevisionDiff:
+    # ModFile records of the new revision
+    added: list = field(default_factory=list)
+    changed: list = field(default_factory=list)
+    unchanged: list = field(default_factory=list)
+    # Unchanged files that are not in the downloads folder (see check_unchanged)
+    missing: list = field(default_factory=list)
+    # ModFile records of the old revision that the new one replaces or no longer lists
+    superseded: list = field(default_factory=list)
+    old_bytes: int = 0
+    new_bytes: int = 0
+
+    def to_download(self):
+        return self.added + self.changed + self.missing
+
+    def message(self):
+        download_bytes = sum(mod.size for mod in self.to_download())
+        delta = (self.new_bytes - self.old_bytes) / (1024 ** 3)
+        return (f"Revision diff: {len(self.added)} added, {len(self.changed)} changed, "
+                f"{len(self.unchanged)} unchanged (skipped), {len(self.missing)} unchanged but not on disk, "
+                f"{len(self.superseded)} superseded; "
+                f"{download_bytes / (1024 ** 3):.2f} GB to download, collection "
+                f"{self.old_bytes / (1024 ** 3):.2f} -> {self.new_bytes / (1024 ** 3):.2f} GB ({delta:+.2f} GB)")
+
+def is_manifest_file(file_path):
+    with open(file_path, 'rb') as f:
+        return f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+def read_baseline(file_path, game_domain):
+    # The old revision as ModFile records: an earlier collection.json, or a run manifest
+    # (state/manifest.sqlite3), whose completed files for the game stand for what is on disk.
+    # Returns (mods, from_manifest).
+    if not is_manifest_file(file_path):
+        return read_collection(file_path).mods, False
+    manifest = RunManifest(file_path)
+    try:
+        entries = manifest.entries(game_domain)
+    finally:
+        manifest.close()
+    mods = [ModFile(mod_id, file_id, entry.size, entry.md5)
+            for (mod_id, file_id), entry in entries.items() if entry.status == STATUS_COMPLETE]
+    return mods, True
+
+def same_content(old, new):
+    # The hash decides when both sides have one, the size when only that is known
+    if old.md5 and new.md5:
+        return old.md5.lower() == new.md5.lower()
+    if old.size and new.size:
+        return old.size == new.size
+    return True
+
+def diff_revisions(old_mods, new_mods, from_manifest=False):
+    # A manifest holds every collection ever downloaded for the game, so there a file only counts
+    # as superseded when the new revision lists another file of the same mod
+    diff = RevisionDiff()
+    old_by_key = {(mod.mod_id, mod.file_id): mod for mod in old_mods}
+    new_keys = set()
+    new_mod_ids = set()
+    for mod in new_mods:
+        key = (mod.mod_id, mod.file_id)
+        new_keys.add(key)
+        new_mod_ids.add(mod.mod_id)
+        diff.new_bytes += mod.size
+        old = old_by_key.get(key)
+        if old is None:
+            diff.added.append(mod)
+        elif same_content(old, mod):
+            diff.unchanged.append(mod)
+        else:
+            diff.changed.append(mod)
+            diff.superseded.append(old)
+    for key, old in old_by_key.items():
+        if key in new_keys:
+            diff.old_bytes += old.size
+        elif not from_manifest or old.mod_id in new_mod_ids:
+            diff.old_bytes += old.size
+            diff.superseded.append(old)
+    return diff
+
+def check_unchanged(diff, entries, index):
+    # Moves the unchanged files the manifest entries and the folderindex.FolderIndex do not show
+    # as complete on disk (the old revision's run stopped early, or they were deleted) to missing
+    present = []
+    for mod in diff.unchanged:
+        if is_satisfied(mod, entries.get((mod.mod_id, mod.file_id)), index):
+            present.append(mod)
+        else:
+            diff.missing.append(mod)
+    diff.unchanged = present
+    return diff
+
+def superseded_archives(diff, entries, folder):
+    # (old ModFile, path of its archive in folder or None) for every superseded file; the manifest
+    # entries are the only record of which archive name a (modId, fileId) was downloaded as
+    archives = []
+    for mod in diff.superseded:
+        entry = entries.get((mod.mod_id, mod.file_id))
+        path = os.path.join(folder, entry.filename) if entry else None
+        archives.append((mod, path if path and os.path.isfile(path) else None))
+    return archives
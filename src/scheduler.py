@@ -0,0 +1,66 @@
+import heapq
+from datetime import timedelta
+
+# Orders the download queue using the per-file sizes from collection.json. The thread pool
+# hands the next queued file to whichever worker frees up first, so submitting largest
+# first is LPT (longest processing time) list scheduling: big archives start early and the
+# run ends on small files instead of one worker crawling through a 6 GB archive alone.
+
+ORDERS = ('largest', 'interleave', 'json')
+
+# Defaults for --dryrun predictions when the real link speed is unknown
+DEFAULT_BANDWIDTH_MBPS = 50.0
+DEFAULT_API_LATENCY = 0.3
+
+def order_mods(mods, order='largest'):
+    if order == 'largest':
+        # sorted() is stable, so files without a known size keep their JSON order at the end
+        return sorted(mods, key=lambda mod: mod.size, reverse=True)
+    if order == 'interleave':
+        # Alternate the largest remaining with the smallest remaining: the big ones keep the
+        # bandwidth busy while the small ones keep link resolution on the API flowing
+        by_size = sorted(mods, key=lambda mod: mod.size, reverse=True)
+        ordered = []
+        low, high = 0, len(by_size) - 1
+        while low <= high:
+            ordered.append(by_size[low])
+            if low != high:
+                ordered.append(by_size[high])
+            low += 1
+            high -= 1
+        return ordered
+    return list(mods)
+
+def pin_first(mods, pinned=()):
+    # --pin: the pinned mods' files go to the front of the queue, in the order already chosen
+    if not pinned:
+        return list(mods)
+    return sorted(mods, key=lambda mod: mod.mod_id not in pinned)
+
+def predict_makespan(mods, workers, bandwidth_mbps=DEFAULT_BANDWIDTH_MBPS, api_latency=DEFAULT_API_LATENCY):
+    # Simulate the pool: each file goes to the worker that frees up first, and every active
+    # transfer gets an equal share of the link
+    workers = max(1, int(workers))
+    per_worker = bandwidth_mbps * 1024 * 1024 / workers
+    finish_times = [0.0] * workers
+    for mod in mods:
+        start = heapq.heappop(finish_times)
+        heapq.heappush(finish_times, start + api_latency + mod.size / per_worker)
+    return max(finish_times)
+
+def dry_run_report(mods, workers, chosen_order, bandwidth_mbps=DEFAULT_BANDWIDTH_MBPS, api_latency=DEFAULT_API_LATENCY):
+    total_bytes = sum(mod.size for mod in mods)
+    unknown = sum(1 for mod in mods if not mod.size)
+    lines = [
+        f"Dry run: {len(mods)} files, {total_bytes / (1024 ** 3):.2f} GB total, {workers} workers, "
+        f"assuming {bandwidth_mbps:g} MB/s and {api_latency:g}s per link lookup",
+    ]
+    if unknown:
+        lines.append(f"{unknown} files have no size in the collection and are counted as 0 bytes")
+    lower_bound = total_bytes / (bandwidth_mbps * 1024 * 1024)
+    lines.append(f"Lower bound (link saturated the whole time): {timedelta(seconds=round(lower_bound))}")
+    for order in ORDERS:
+        makespan = predict_makespan(order_mods(mods, order), workers, bandwidth_mbps, api_latency)
+        marker = " <- selected" if order == chosen_order else ""
+        lines.append(f"Predicted makespan with --order {order}: {timedelta(seconds=round(makespan))}{marker}")
+    return "\n".join(lines)
@@ -0,0 +1,141 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from config import current_config
+from ratelimit import GOVERNOR
+
+# Shared HTTP layer used by every download and endorse worker. One requests.Session
+# with a connection pool sized to --maxthreads, so API calls and CDN transfers reuse
+# keep-alive connections instead of paying a TCP/TLS handshake per request.
+
+# NEXUS_API_BASE points the downloader at another server, such as bench/mocknexus.py
+API_BASE = os.environ.get('NEXUS_API_BASE', 'https://api.nexusmods.com/v1').rstrip('/')
+# (connect, read) timeout for API calls
+API_TIMEOUT = (15, 60)
+# How many times one API call is retried after a 429, each time after the governor's backoff
+MAX_RATE_LIMIT_RETRIES = 5
+
+# Cap on pooled connections to any single host (api.nexusmods.com, each CDN edge)
+MAX_CONNECTIONS_PER_HOST = 32
+# Number of distinct host pools kept alive at once (API + a handful of CDN edges)
+MAX_HOST_POOLS = 16
+
+_session = None
+_session_lock = threading.Lock()
+_api_headers = None
+_stats_lock = threading.Lock()
+_handshakes = 0
+_requests = 0
+
+def _count_handshake():
+    global _handshakes
+    with _stats_lock:
+        _handshakes += 1
+
+def _count_request(response, *args, **kwargs):
+    global _requests
+    with _stats_lock:
+        _requests += 1
+
+# urllib3 re-connects a pooled connection object in place when the server dropped it,
+# so handshakes are counted at connect() rather than when the pool creates a connection
+class CountingHTTPConnection(HTTPConnection):
+    def connect(self):
+        _count_handshake()
+        super().connect()
+
+class CountingHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        _count_handshake()
+        super().connect()
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CountingHTTPConnection
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CountingHTTPSConnection
+
+class PooledAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        # Swap in pool classes whose connections count every (re)connect, i.e. every handshake
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CountingHTTPConnectionPool,
+            "https": CountingHTTPSConnectionPool,
+        }
+
+def configure_session(max_threads=10, max_per_host=MAX_CONNECTIONS_PER_HOST):
+    global _session
+    pool_size = max(1, min(int(max_threads), int(max_per_host)))
+    session = requests.Session()
+    # pool_block makes workers wait for a free connection instead of opening throwaway ones
+    adapter = PooledAdapter(pool_connections=MAX_HOST_POOLS, pool_maxsize=pool_size, pool_block=True)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.hooks["response"].append(_count_request)
+    with _session_lock:
+        old_session = _session
+        _session = session
+    if old_session is not None:
+        old_session.close()
+    return session
+
+def get_session():
+    with _session_lock:
+        session = _session
+    if session is None:
+        session = configure_session()
+    return session
+
+def api_headers():
+    global _api_headers
+    # Reused until the configuration is replaced (e.g. a new API key from the GUI settings)
+    config = current_config()
+    if _api_headers is None or _api_headers[0] is not config:
+        _api_headers = (config, {
+            'apikey': config.AccessControl.NexusAPIKey,
+            'Accept': 'application/json',
+        })
+    return _api_headers[1]
+
+def api_request(method, url):
+    # Every Nexus API call goes through the rate-limit governor, which paces it and learns
+    # the remaining quota from the response headers
+    for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+        GOVERNOR.acquire()
+        response = get_session().request(method, url, headers=api_headers(), timeout=API_TIMEOUT)
+        GOVERNOR.update(response.status_code, response.headers)
+        if response.status_code != 429 or attempt == MAX_RATE_LIMIT_RETRIES:
+            return response
+        response.close()
+
+def check_api_budget(needed_calls=None):
+    # One cheap call before a run so the remaining quota is known up front
+    response = api_request('GET', f'{API_BASE}/users/validate.json')
+    response.raise_for_status()
+    return GOVERNOR.budget_message(needed_calls)
+
+def get_handshake_count():
+    with _stats_lock:
+        return _handshakes
+
+def get_request_count():
+    with _stats_lock:
+        return _requests
+
+def connection_stats_message():
+    with _stats_lock:
+        handshakes, total = _handshakes, _requests
+    reused = max(0, total - handshakes)
+    return f"HTTP connections opened: {handshakes} for {total} requests ({reused} reused keep-alive)"
+
+def close_session():
+    global _session
+    with _session_lock:
+        session = _session
+        _session = None
+    if session is not None:
+        session.close()
@@ -0,0 +1,126 @@
+import errno
+import os
+import threading
+
+# Content-addressed archive store shared by every game folder under DownloadsFolderRoot.
+# Frameworks, script extenders and presets turn up in many collections (and game editions);
+# once one copy has been downloaded and its MD5 checked, the store keeps a hardlink to it under
+# its MD5 and size, and any later collection that lists the same MD5 and size gets a hardlink
+# in its own game folder instead of a download (and without a link lookup). Hardlinks cost no
+# extra disk space, so the store only works on a volume that supports them; elsewhere it turns
+# itself off. An object whose only remaining link is the store's own is no longer in any game
+# folder (Vortex or the user deleted it) and is removed by gc().
+
+STORE_DIR = ".nexusdownloader-store"
+OBJECTS_DIR = "objects"
+# errno values meaning "no hardlinks here" (other volume, FAT/exFAT, network share) rather than a one-off failure
+UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP, errno.ENOSYS}
+
+class ArchiveStore:
+    def __init__(self, downloads_root):
+        self.root = os.path.join(downloads_root, STORE_DIR, OBJECTS_DIR)
+        self.lock = threading.Lock()
+        self.enabled = True
+        self.reason = ""
+        self.linked = 0
+        self.linked_bytes = 0
+        self.added = 0
+
+    def object_dir(self, md5, size):
+        # objects/<first two hex digits>/<md5>-<size>/<archive name as downloaded>
+        md5 = md5.lower()
+        return os.path.join(self.root, md5[:2], f"{md5}-{int(size)}")
+
+    def find(self, md5, size):
+        # Path of the stored archive with this MD5 and size, or None
+        if not self.enabled or not md5 or not size:
+            return None
+        try:
+            with os.scandir(self.object_dir(md5, size)) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        return entry.path
+        except FileNotFoundError:
+            pass
+        return None
+
+    def disable(self, reason):
+        with self.lock:
+            self.enabled = False
+            self.reason = reason
+
+    def add(self, file_path, md5, size):
+        # Keeps a hardlink to a freshly downloaded, MD5-checked archive. Returns True if stored.
+        if not self.enabled or not md5 or not size or self.find(md5, size):
+            return False
+        folder = self.object_dir(md5, size)
+        try:
+            os.makedirs(folder, exist_ok=True)
+            os.link(file_path, os.path.join(folder, os.path.basename(file_path)))
+        except FileExistsError:
+            # Another thread stored the same content first
+            return False
+        except OSError as e:
+            if e.errno in UNSUPPORTED_ERRNOS:
+                self.disable(f"hardlinks are not supported here ({e.strerror})")
+            return False
+        with self.lock:
+            self.added += 1
+        return True
+
+    def link_into(self, md5, size, folder):
+        # Hardlinks the stored archive into folder under its original name. Returns the new
+        # path, or None when the store does not have it (or the link could not be made).
+        source = self.find(md5, size)
+        if source is None:
+            return None
+        target = os.path.join(folder, os.path.basename(source))
+        try:
+            os.link(source, target)
+        except OSError as e:
+            if e.errno in UNSUPPORTED_ERRNOS:
+                self.disable(f"hardlinks are not supported here ({e.strerror})")
+            return None
+        with self.lock:
+            self.linked += 1
+            self.linked_bytes += int(size)
+        return target
+
+    def gc(self):
+        # Removes objects no game folder links to any more. Returns (objects removed, bytes freed).
+        removed = freed = 0
+        try:
+            prefixes = list(os.scandir(self.root))
+        except FileNotFoundError:
+            return 0, 0
+        for prefix in prefixes:
+            if not prefix.is_dir():
+                continue
+            with os.scandir(prefix.path) as objects:
+                object_dirs = [entry.path for entry in objects if entry.is_dir()]
+            for object_dir in object_dirs:
+                with os.scandir(object_dir) as entries:
+                    files = [entry for entry in entries if entry.is_file()]
+                for entry in files:
+                    # Not entry.stat(): on Windows that leaves st_nlink at zero
+                    st = os.stat(entry.path)
+                    if st.st_nlink <= 1:
+                        os.remove(entry.path)
+                        removed += 1
+                        freed += st.st_size
+                try:
+                    os.rmdir(object_dir)
+                except OSError:
+                    pass
+            try:
+                os.rmdir(prefix.path)
+            except OSError:
+                pass
+        return removed, freed
+
+    def summary(self):
+        with self.lock:
+            if not self.enabled:
+                return f"Archive store off: {self.reason}"
+            return (f"Archive store: {self.linked} files ({self.linked_bytes / (1024 ** 3):.2f} GB) linked in "
+                    f"instead of downloaded, {self.added} new archives stored")
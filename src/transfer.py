@@ -0,0 +1,554 @@
+import json
+import os
+import threading
+import time
+from checksum import new_hasher, update_from_file, md5_file, check_digest
+from session import get_session
+from diskwriter import disk_writer, preallocate
+from retry import BREAKER, host_of
+from mirrors import MIRRORS, RateWatch, SlowMirror, PROBE_BYTES, PROBE_SECONDS, PROBE_TIMEOUT
+from metrics import METRICS
+from bandwidth import BANDWIDTH
+from ratelimit import GOVERNOR, TransferCancelled
+
+LOGGER = None
+
+# Transfers land in "<file>.part" with a small "<file>.part.json" sidecar recording how many
+# bytes are safely on disk, and are only renamed to the real name once complete. A file
+# that exists under its final name is therefore always a finished download.
+PART_SUFFIX = ".part"
+STATE_SUFFIX = ".part.json"
+# How often (in bytes written) the sidecar is refreshed during a transfer
+STATE_INTERVAL = 8 * 1024 * 1024
+# (connect, read) timeout; a stalled CDN connection fails and leaves a resumable .part
+TRANSFER_TIMEOUT = (30, 120)
+
+# Large files are fetched as byte-range segments over several connections, each written
+# at its own offset into a preallocated .part. Segments are only created while download
+# slots are idle, so a busy pool keeps one connection per file and the tail of a run
+# (one huge archive, everyone else done) spreads that archive across the free slots.
+MIN_SEGMENT_SIZE = 32 * 1024 * 1024
+MAX_SEGMENTS = 8
+
+TRANSFER_SLOTS = 10
+_slots_lock = threading.Lock()
+_active_transfers = 0
+# Running total of bytes written by every transfer, sampled by the adaptive concurrency controller,
+# and the same per file for the progress events
+_bytes_lock = threading.Lock()
+_bytes_transferred = 0
+_bytes_by_transfer = {}
+# Run control for the in-process engine: transfers check these between buffers, so a pause
+# holds them where they are and a cancel stops them with their .part and sidecar up to date
+_not_paused = threading.Event()
+_not_paused.set()
+_cancelled = threading.Event()
+
+def set_transfer_logger(logger):
+    global LOGGER
+    LOGGER = logger
+
+def set_transfer_slots(slots):
+    global TRANSFER_SLOTS
+    TRANSFER_SLOTS = max(1, int(slots))
+
+def _take_slot(only_if_idle=False):
+    global _active_transfers
+    with _slots_lock:
+        if only_if_idle and _active_transfers >= TRANSFER_SLOTS:
+            return False
+        _active_transfers += 1
+        return True
+
+def _release_slot():
+    global _active_transfers
+    with _slots_lock:
+        _active_transfers -= 1
+
+def idle_slots():
+    with _slots_lock:
+        return max(0, TRANSFER_SLOTS - _active_transfers)
+
+def add_transferred(count, name=None):
+    global _bytes_transferred
+    with _bytes_lock:
+        _bytes_transferred += count
+        if name:
+            _bytes_by_transfer[name] = _bytes_by_transfer.get(name, 0) + count
+
+def bytes_transferred():
+    with _bytes_lock:
+        return _bytes_transferred
+
+def transfers_snapshot():
+    with _bytes_lock:
+        return dict(_bytes_by_transfer)
+
+def pause_transfers():
+    _not_paused.clear()
+
+def resume_transfers():
+    _not_paused.set()
+
+def cancel_transfers():
+    _cancelled.set()
+    # A paused transfer has to wake up to notice the cancel, and so does a wait for API quota
+    _not_paused.set()
+    GOVERNOR.cancel()
+
+def reset_transfer_control():
+    _cancelled.clear()
+    _not_paused.set()
+    GOVERNOR.reset_cancel()
+
+def transfers_paused():
+    return not _not_paused.is_set()
+
+def transfers_cancelled():
+    return _cancelled.is_set()
+
+def transfer_checkpoint():
+    # Blocks while paused; raises TransferCancelled once the run is cancelled
+    _not_paused.wait()
+    if _cancelled.is_set():
+        raise TransferCancelled("Download cancelled")
+
+def part_paths(file_path):
+    return file_path + PART_SUFFIX, file_path + STATE_SUFFIX
+
+def read_part_state(file_path):
+    part_path, state_path = part_paths(file_path)
+    if not os.path.exists(part_path) or not os.path.exists(state_path):
+        return None
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get("segments"):
+        # A segmented .part is preallocated, so only the first segment is a contiguous prefix;
+        # that is what a single-stream resume can continue from (the async engine resumes the segments)
+        first = min(state["segments"])
+        state["received"] = first[2] if first[0] == 0 else 0
+        return state
+    # Never trust the sidecar beyond what actually reached the disk
+    state["received"] = min(int(state.get("received", 0)), os.path.getsize(part_path))
+    return state
+
+def write_part_state(file_path, state):
+    _, state_path = part_paths(file_path)
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+def finalize_part(file_path):
+    part_path, state_path = part_paths(file_path)
+    os.replace(part_path, file_path)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+
+def verify_part(file_path, digest, expected_md5):
+    # On a mismatch the .part goes to quarantine and its sidecar is dropped, so the next
+    # attempt starts clean instead of resuming corrupt data
+    if expected_md5 and digest.lower() != expected_md5.lower():
+        _, state_path = part_paths(file_path)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+    check_digest(part_paths(file_path)[0], digest, expected_md5)
+
+def transfer_headers(state):
+    # Byte offsets only line up with the file on disk if the CDN does not re-encode it
+    headers = {'Accept-Encoding': 'identity'}
+    if not state or not state.get("received"):
+        return headers
+    headers['Range'] = f"bytes={state['received']}-"
+    # If-Range makes the server send the whole file instead if it changed since the .part was started
+    if state.get("etag"):
+        headers['If-Range'] = state["etag"]
+    return headers
+
+def expected_total(status_code, headers, offset):
+    # Content-Range is "bytes start-end/total" on a 206; otherwise Content-Length is the whole file
+    content_range = headers.get('Content-Range', '')
+    if status_code == 206 and '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        return int(total) if total.isdigit() else None
+    length = headers.get('Content-Length')
+    return int(length) + (offset if status_code == 206 else 0) if length and length.isdigit() else None
+
+def plan_segment_count(total):
+    by_size = total // MIN_SEGMENT_SIZE
+    return max(1, min(MAX_SEGMENTS, by_size, 1 + idle_slots()))
+
+def split_range(total, count):
+    size = total // count
+    bounds = [i * size for i in range(count)] + [total]
+    return [[bounds[i], bounds[i + 1] - 1, 0] for i in range(count)]
+
+def read_buffer(response, limit=None):
+    # Fills one pooled buffer from the response with readinto. Returns (buffer, length), or None
+    # at the end of the body; the caller hands the buffer to a WriteStream, which returns it to
+    # the pool once it is on disk
+    pool = disk_writer().pool
+    size = pool.size if limit is None else min(pool.size, limit)
+    if size <= 0:
+        return None
+    # Decode here in the unlikely case the CDN ignores Accept-Encoding: identity
+    response.raw.decode_content = True
+    buffer = pool.acquire()
+    try:
+        length = response.raw.readinto(memoryview(buffer)[:size])
+    except BaseException:
+        pool.release(buffer)
+        raise
+    if not length:
+        pool.release(buffer)
+        return None
+    return buffer, length
+
+class RangeNotHonoured(IOError):
+    pass
+
+class SegmentedTransfer:
+    # state["segments"] holds [start, end, done] per segment; the owning thread may shrink
+    # its own segment's end when it hands the back half of its range to an idle slot.
+    # The segment starting at byte 0 arrives in order, so it is hashed as it is written: a file
+    # that never split needs no read-back at all, one that did only for the later segments.
+
+    def __init__(self, url, file_path, state, watch=None, hasher=None):
+        self.url = url
+        self.file_path = file_path
+        self.part_path, _ = part_paths(file_path)
+        self.state = state
+        self.watch = watch
+        self.lock = threading.Lock()
+        self.threads = []
+        self.errors = []
+        self.hasher = hasher
+        # Bytes from the start of the file already fed to hasher
+        self.hashed = 0
+        if hasher and state["segments"][0][2]:
+            # Resumed: the first segment's prefix on disk is hashed once, up front
+            update_from_file(hasher, self.part_path, state["segments"][0][2])
+            self.hashed = state["segments"][0][2]
+
+    def save(self):
+        with self.lock:
+            write_part_state(self.file_path, self.state)
+
+    def run(self, first_response=None):
+        pending = [seg for seg in self.state["segments"] if seg[2] < seg[1] - seg[0] + 1]
+        own = pending.pop(0) if pending else None
+        # Resumed segments go to idle slots; whatever does not get one is fetched here afterwards
+        leftovers = []
+        for seg in pending:
+            if _take_slot(only_if_idle=True):
+                self.spawn(seg)
+            else:
+                leftovers.append(seg)
+
+        try:
+            if own is not None:
+                self.fetch_segment(own, first_response)
+            elif first_response is not None:
+                first_response.close()
+            for seg in leftovers:
+                self.fetch_segment(seg)
+        finally:
+            # Helpers may have split off further helpers while we waited, hence the indexed walk
+            index = 0
+            while True:
+                with self.lock:
+                    if index >= len(self.threads):
+                        break
+                    thread = self.threads[index]
+                thread.join()
+                index += 1
+        if self.errors:
+            raise self.errors[0]
+
+        received = sum(seg[2] for seg in self.state["segments"])
+        if received != self.state["total"]:
+            raise IOError(f"Incomplete download of {os.path.basename(self.file_path)}: {received} of {self.state['total']} bytes")
+        return received
+
+    def spawn(self, seg):
+        thread = threading.Thread(target=self.helper, args=(seg,), daemon=True)
+        with self.lock:
+            self.threads.append(thread)
+        thread.start()
+
+    def helper(self, seg):
+        try:
+            self.fetch_segment(seg)
+        except Exception as e:
+            with self.lock:
+                self.errors.append(e)
+        finally:
+            _release_slot()
+
+    def maybe_split(self, seg):
+        with self.lock:
+            remaining = seg[1] + 1 - (seg[0] + seg[2])
+            if remaining < 2 * MIN_SEGMENT_SIZE or len(self.state["segments"]) >= MAX_SEGMENTS:
+                return
+            if not _take_slot(only_if_idle=True):
+                return
+            middle = seg[0] + seg[2] + remaining // 2
+            new_seg = [middle, seg[1], 0]
+            seg[1] = middle - 1
+            self.state["segments"].append(new_seg)
+            write_part_state(self.file_path, self.state)
+        if LOGGER:
+            LOGGER.verbose(f"Splitting {os.path.basename(self.file_path)} at byte {middle} onto an idle slot")
+        self.spawn(new_seg)
+
+    def fetch_segment(self, seg, response=None):
+        owns_response = response is None
+        if owns_response:
+            headers = {'Accept-Encoding': 'identity', 'Range': f"bytes={seg[0] + seg[2]}-{seg[1]}"}
+            if self.state.get("etag"):
+                headers['If-Range'] = self.state["etag"]
+            response = get_session().get(self.url, stream=True, headers=headers, timeout=TRANSFER_TIMEOUT)
+            if self.watch:
+                self.watch.responded()
+            if response.status_code != 206:
+                response.close()
+                raise RangeNotHonoured(f"Server did not honour a range request for {os.path.basename(self.file_path)} (HTTP {response.status_code})")
+        position = seg[0] + seg[2]
+        inline = self.hasher is not None and seg[0] == 0 and position == self.hashed
+        try:
+            with open(self.part_path, 'r+b') as f, disk_writer().stream(f) as out:
+                try:
+                    # seg[1] is re-read every time round: maybe_split may have moved it
+                    while position <= seg[1]:
+                        transfer_checkpoint()
+                        filled = read_buffer(response, seg[1] + 1 - position)
+                        if not filled:
+                            break
+                        buffer, length = filled
+                        # Hashed before the hand-off: the writer recycles the buffer once it is written
+                        if inline:
+                            self.hasher.update(memoryview(buffer)[:length])
+                            self.hashed += length
+                        out.write(buffer, length, position)
+                        add_transferred(length, os.path.basename(self.file_path))
+                        # Under a bandwidth cap, waits here until the file's lane has paid for the buffer
+                        if BANDWIDTH.acquire(length, os.path.basename(self.file_path), transfers_cancelled) and self.watch:
+                            self.watch.held()
+                        position += length
+                        if self.watch:
+                            self.watch.add(length, seg[1] + 1 - position)
+                        if position - (seg[0] + seg[2]) >= STATE_INTERVAL:
+                            # The sidecar only ever records bytes that have been flushed
+                            out.flush()
+                            with self.lock:
+                                seg[2] = position - seg[0]
+                            self.save()
+                            self.maybe_split(seg)
+                finally:
+                    # Also after a dropped connection: what reached the disk is kept for the resume
+                    if out.drain():
+                        with self.lock:
+                            seg[2] = position - seg[0]
+                        self.save()
+        finally:
+            # Closing early (after a split, or the first response's full-file stream) drops that connection
+            response.close()
+        if position <= seg[1]:
+            raise IOError(f"Segment {seg[0]}-{seg[1]} of {os.path.basename(self.file_path)} ended early")
+
+    def digest(self):
+        # MD5 of the finished .part: the inline hash of the first segment, completed from disk
+        # with whatever came after it (nothing when the file never split)
+        first = self.state["segments"][0]
+        if self.hasher is None or self.hashed != first[1] + 1:
+            return md5_file(self.part_path)
+        update_from_file(self.hasher, self.part_path, start=self.hashed)
+        return self.hasher.hexdigest()
+
+def fetch_to_path(urls, file_path, expected_md5=None):
+    # urls: the file's mirror URLs, best first (or a single URL). A transfer that turns slow moves
+    # on to the next mirror and resumes there from the byte it had reached.
+    urls = [urls] if isinstance(urls, str) else list(urls)
+    _take_slot()
+    started = time.monotonic()
+    first_byte = None
+    moved = 0
+    failovers = 0
+    try:
+        for index, url in enumerate(urls):
+            last = index == len(urls) - 1
+            # A CDN host whose circuit is open is not contacted at all; the file is retried later
+            # unless another mirror can take it
+            try:
+                BREAKER.check(url)
+            except IOError:
+                if last:
+                    raise
+                continue
+            watch = RateWatch(urls[index + 1:])
+            try:
+                received = _fetch_to_path(url, file_path, expected_md5, watch)
+            except SlowMirror:
+                # Slow is not broken: the mirror's history takes the hit, its circuit does not
+                BREAKER.release(url)
+                MIRRORS.record_watch(url, watch)
+                first_byte = first_byte or watch.first_byte
+                moved += watch.count
+                failovers += 1
+                if LOGGER:
+                    LOGGER.verbose(f"{os.path.basename(file_path)}: {host_of(url)} too slow "
+                                   f"({watch.rate() / 1024:.0f} KB/s), failing over to {host_of(urls[index + 1])}")
+                continue
+            except Exception as e:
+                BREAKER.failure(url, e)
+                raise
+            BREAKER.success(url)
+            MIRRORS.record_watch(url, watch)
+            METRICS.transferred(os.path.basename(file_path), started, first_byte or watch.first_byte, time.monotonic(),
+                                moved + watch.count, host_of(url), failovers)
+            return received
+    finally:
+        _release_slot()
+
+def probe_mirror(url):
+    # Reads the start of a file from a mirror and records its throughput (time to first byte included)
+    started = time.monotonic()
+    received = 0
+    headers = {'Accept-Encoding': 'identity', 'Range': f"bytes=0-{PROBE_BYTES - 1}"}
+    try:
+        with get_session().get(url, stream=True, headers=headers, timeout=PROBE_TIMEOUT) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(64 * 1024):
+                received += len(chunk)
+                if received >= PROBE_BYTES or time.monotonic() - started >= PROBE_SECONDS:
+                    break
+    except Exception as e:
+        if LOGGER:
+            LOGGER.verbose(f"Probe of mirror {host_of(url)} failed: {e}")
+        return None
+    seconds = time.monotonic() - started
+    MIRRORS.record(url, received, seconds)
+    if LOGGER:
+        LOGGER.verbose(f"Probed mirror {host_of(url)}: {received / seconds / (1024 * 1024):.2f} MB/s")
+    return received / seconds if seconds else None
+
+def resume_state(url, file_path):
+    # The sidecar of an earlier attempt. An ETag only identifies the file on the mirror that sent
+    # it, so resuming on another mirror drops it and relies on the size and the MD5 instead.
+    state = read_part_state(file_path)
+    if state and state.get("host", host_of(url)) != host_of(url):
+        state["etag"] = None
+    if state:
+        state["host"] = host_of(url)
+    return state
+
+def _finish_segmented(transfer, received, expected_md5):
+    if expected_md5:
+        verify_part(transfer.file_path, transfer.digest(), expected_md5)
+    finalize_part(transfer.file_path)
+    return received
+
+def _fetch_to_path(url, file_path, expected_md5=None, watch=None):
+    part_path, _ = part_paths(file_path)
+    state = resume_state(url, file_path)
+    if state and state.get("segments"):
+        if LOGGER:
+            LOGGER.verbose("Resuming %s across %d segments", os.path.basename(file_path), len(state['segments']))
+        try:
+            transfer = SegmentedTransfer(url, file_path, state, watch, new_hasher() if expected_md5 else None)
+            return _finish_segmented(transfer, transfer.run(), expected_md5)
+        except RangeNotHonoured:
+            # The file changed on the CDN (or ranges are no longer served): start it again from scratch
+            if LOGGER:
+                LOGGER.verbose(f"Discarding partial {os.path.basename(file_path)}, the server no longer serves its ranges")
+            state = None
+    offset = state["received"] if state else 0
+
+    with get_session().get(url, stream=True, headers=transfer_headers(state), timeout=TRANSFER_TIMEOUT) as r:
+        if watch:
+            watch.responded()
+        if r.status_code == 416 and state and state.get("total") == offset:
+            # Everything was already received before the interruption, only the rename was missed
+            if expected_md5:
+                verify_part(file_path, md5_file(part_path), expected_md5)
+            finalize_part(file_path)
+            return offset
+        r.raise_for_status()
+        if offset and r.status_code != 206:
+            # Server ignored the Range request (or the file changed), start over
+            offset = 0
+        state = {
+            "total": expected_total(r.status_code, r.headers, offset),
+            "received": offset,
+            "etag": r.headers.get('ETag'),
+            "host": host_of(url),
+        }
+        if offset and LOGGER:
+            LOGGER.verbose("Resuming %s at byte %d", os.path.basename(file_path), offset)
+
+        total = state["total"]
+        if offset == 0 and total and r.headers.get('Accept-Ranges', '').lower() == 'bytes' and total >= 2 * MIN_SEGMENT_SIZE:
+            # Range-capable and big enough to be split: preallocate and switch to segments. This
+            # response keeps streaming the first segment; the rest are fetched with Range requests.
+            # It stays a single segment while no slot is idle, but can still split later.
+            segments = split_range(total, plan_segment_count(total))
+            state = {"total": total, "etag": state["etag"], "host": state["host"], "segments": segments}
+            with open(part_path, 'wb') as f:
+                preallocate(f, total)
+            write_part_state(file_path, state)
+            if LOGGER and len(segments) > 1:
+                LOGGER.verbose("Fetching %s as %d segments", os.path.basename(file_path), len(segments))
+            transfer = SegmentedTransfer(url, file_path, state, watch, new_hasher() if expected_md5 else None)
+            return _finish_segmented(transfer, transfer.run(first_response=r), expected_md5)
+
+        # The hash is computed on the bytes as they are written; a resumed transfer only has
+        # to re-read the prefix it already has on disk
+        hasher = new_hasher() if expected_md5 else None
+        if hasher and offset:
+            update_from_file(hasher, part_path, offset)
+
+        with open(part_path, 'r+b' if offset else 'wb') as f:
+            f.seek(offset)
+            f.truncate()
+            if total:
+                preallocate(f, total)
+                f.seek(offset)
+            write_part_state(file_path, state)
+            position = offset
+            with disk_writer().stream(f) as out:
+                try:
+                    while True:
+                        transfer_checkpoint()
+                        filled = read_buffer(r)
+                        if not filled:
+                            break
+                        buffer, length = filled
+                        # Hashed before the hand-off: the writer recycles the buffer once it is written
+                        if hasher:
+                            hasher.update(memoryview(buffer)[:length])
+                        out.write(buffer, length, position)
+                        add_transferred(length, os.path.basename(file_path))
+                        if BANDWIDTH.acquire(length, os.path.basename(file_path), transfers_cancelled) and watch:
+                            watch.held()
+                        position += length
+                        if watch:
+                            watch.add(length, total - position if total else None)
+                        if position - state["received"] >= STATE_INTERVAL:
+                            out.flush()
+                            state["received"] = position
+                            write_part_state(file_path, state)
+                finally:
+                    # Also after a dropped connection: what reached the disk is kept for the resume
+                    if out.drain():
+                        state["received"] = position
+                        write_part_state(file_path, state)
+
+    if state["total"] is not None and state["received"] != state["total"]:
+        raise IOError(f"Incomplete download of {os.path.basename(file_path)}: {state['received']} of {state['total']} bytes")
+    if hasher:
+        verify_part(file_path, hasher.hexdigest(), expected_md5)
+    finalize_part(file_path)
+    return state["received"]